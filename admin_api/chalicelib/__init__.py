@@ -7,6 +7,7 @@ import datetime
 import json
 import hashlib
 
+from . import athena_executor, athena_scheduler
 from .script_generator import ScriptGenerator
 from .upload import S3Uploader
 
@@ -37,28 +38,42 @@ def get_current_user_name():
     return os.environ.get('TEST_USER') or 'root'
 
 
-def execute_athena_query(query, token=None):
-    response = athena_client.start_query_execution(
-        QueryString=query,
-        QueryExecutionContext={
-            'Database': os.environ.get('STATS_ATHENA_DATABASE')
-        },
-        ResultConfiguration={
-            'OutputLocation': 's3://%s/' % (os.environ.get('STATS_ATHENA_RESULT_BUCKET')),
-            'EncryptionConfiguration': {
-                'EncryptionOption': 'SSE_S3'
-            }
-        },
-        ClientRequestToken='%s_%s_%s' % (
-            token or uuid.uuid4(),
-            datetime.datetime.now().strftime('%Y%m%d'),
-            hashlib.sha1(query.encode('utf-8')).hexdigest()
-        )
+query_executor = athena_executor.AthenaExecutor(athena_client, {
+    'OutputLocation': 's3://%s/' % (os.environ.get('STATS_ATHENA_RESULT_BUCKET')),
+    'EncryptionConfiguration': {
+        'EncryptionOption': 'SSE_S3'
+    }
+}, os.environ.get('STATS_ATHENA_DATABASE'))
+
+
+query_scheduler = athena_scheduler.AthenaScheduler(query_executor)
+
+
+def execute_athena_query(query, token=None, org=None):
+    # the clients poll the execution by query_result_*, so the API doesn't wait for it
+    token = '%s_%s_%s' % (
+        token or uuid.uuid4(),
+        datetime.datetime.now().strftime('%Y%m%d'),
+        hashlib.sha1(query.encode('utf-8')).hexdigest()
     )
-    return response['QueryExecutionId']
+    if org and athena_scheduler.enabled():
+        # the query waits for a slot of the org, the execution id can be `queued-...`
+        return query_scheduler.submit(org, query, token)
+    return query_executor.start(query, token)
+
+
+def get_query_execution(org, execution_id):
+    """
+    get_query_execution of the execution id of execute_athena_query,
+    `QueryExecutionId` of the response is the Athena execution id when the query is started
+    """
+    if athena_scheduler.enabled():
+        return query_scheduler.execution(org, execution_id)
+    return athena_client.get_query_execution(QueryExecutionId=execution_id)
 
 
 def save_athena_usage_report(org, tid, result_athena):
+    athena_executor.record(result_athena)
     scanned = result_athena['QueryExecution']['Statistics']['DataScannedInBytes']
     usage_key = 'org={0}/tid={1}/{2}/{3}.json'.format(org, tid,
                                                       datetime.datetime.now().strftime('year=%Y/month=%-m/day=%-d'),
@@ -0,0 +1 @@
+../../common/athena_executor.py
\ No newline at end of file
@@ -1,7 +1,8 @@
 from chalice import Blueprint, Response
-from . import app, authorizer, athena_client, execute_athena_query, save_athena_usage_report
+from . import app, authorizer, athena_client, execute_athena_query, get_query_execution, save_athena_usage_report
 from .dynamodb import get_container_table
 from .decorator import check_org_permission, check_json_body
+from .collect_columns import columns
 import os
 import datetime
 
@@ -10,7 +11,7 @@ users_routes = Blueprint(__name__)
 
 def users_query(org, tid, stime, etime):
     return """SELECT
-JSON_EXTRACT_SCALAR(qs, '$.cid') as cid,
+{cid} as cid,
 JSON_EXTRACT_SCALAR(qs, '$.uid') as uid,
 COUNT(qs) as c
 FROM {0}
@@ -18,10 +19,10 @@ WHERE org = '{1}'
 AND tid = '{2}'
 AND year * 10000 + month * 100 + day >= {3}
 AND year * 10000 + month * 100 + day <= {4}
-AND JSON_EXTRACT_SCALAR(qs, '$.o_s') IS NOT NULL
+AND {o_s} IS NOT NULL
 AND datetime >= timestamp '{5}'
 AND datetime <= timestamp '{6}'
-GROUP BY JSON_EXTRACT_SCALAR(qs, '$.cid'),
+GROUP BY {cid},
 JSON_EXTRACT_SCALAR(qs, '$.uid')
 ORDER BY c DESC
 """.format(
@@ -32,15 +33,16 @@ ORDER BY c DESC
         datetime.datetime.utcfromtimestamp(etime / 1000).strftime('%Y%m%d'),
         datetime.datetime.utcfromtimestamp(stime / 1000).strftime('%Y-%m-%d %H:%M:%S'),
         datetime.datetime.utcfromtimestamp(etime / 1000).strftime('%Y-%m-%d %H:%M:%S'),
+        **columns()
     )
 
 
 def user_query(org, tid, cid, stime, etime, hash_key):
     return """SELECT datetime,
-JSON_EXTRACT_SCALAR(qs, '$.o_s') AS state,
-JSON_EXTRACT_SCALAR(qs, '$.dt') AS dt, 
-JSON_EXTRACT_SCALAR(qs, '$.dl') AS dl, 
-JSON_EXTRACT_SCALAR(qs, '$.o_psid') AS psid,
+{o_s} AS state,
+{dt} AS dt, 
+{dl} AS dl, 
+{o_psid} AS psid,
 JSON_EXTRACT_SCALAR(qs, '$.uid') AS uid,
 JSON_EXTRACT_SCALAR(qs, '$.uhash') AS uhash,
 TO_HEX(hmac_sha256(TO_UTF8(JSON_EXTRACT_SCALAR(qs, '$.uid')), TO_UTF8('{0}'))) = upper(JSON_EXTRACT_SCALAR(qs, '$.uhash')) as is_verified,
@@ -50,10 +52,10 @@ WHERE org = '{2}'
 AND tid = '{3}'
 AND year * 10000 + month * 100 + day >= {4}
 AND year * 10000 + month * 100 + day <= {5}
-AND JSON_EXTRACT_SCALAR(qs, '$.o_s') IS NOT NULL
+AND {o_s} IS NOT NULL
 AND datetime >= timestamp '{6}'
 AND datetime <= timestamp '{7}'
-AND JSON_EXTRACT_SCALAR(qs, '$.cid') = '{8}'
+AND {cid} = '{8}'
 ORDER BY  datetime DESC 
 """.format(
         hash_key or '',
@@ -64,7 +66,8 @@ ORDER BY  datetime DESC
         datetime.datetime.utcfromtimestamp(etime / 1000).strftime('%Y%m%d'),
         datetime.datetime.utcfromtimestamp(stime / 1000).strftime('%Y-%m-%d %H:%M:%S'),
         datetime.datetime.utcfromtimestamp(etime / 1000).strftime('%Y-%m-%d %H:%M:%S'),
-        cid
+        cid,
+        **columns()
     )
 
 
@@ -97,7 +100,7 @@ def container_users_start_query(org, name):
     stime = int(body['stime'])
     etime = int(body['etime'])
 
-    execution_id = execute_athena_query(users_query(org, name, stime, etime), token='user')
+    execution_id = execute_athena_query(users_query(org, name, stime, etime), token='user', org=org)
     return {'execution_id': execution_id}
 
 
@@ -105,9 +108,9 @@ def container_users_start_query(org, name):
 @check_org_permission('read')
 def container_users(org, name, execution_id):
     next_key = get_next_key()
-    state_result = athena_client.get_query_execution(
-        QueryExecutionId=execution_id
-    )
+    state_result = get_query_execution(org, execution_id)
+    # the Athena execution id of a queued query
+    execution_id = state_result['QueryExecution']['QueryExecutionId']
     # QUEUED | RUNNING | SUCCEEDED | FAILED | CANCELLED
     state = state_result['QueryExecution']['Status']['State']
     items = []
@@ -161,7 +164,8 @@ def container_user_start_query(org, name, cid):
 
     stime = int(body['stime'])
     etime = int(body['etime'])
-    execution_id = execute_athena_query(user_query(org, name, cid, stime, etime, hash_key), token='user_detail')
+    execution_id = execute_athena_query(user_query(org, name, cid, stime, etime, hash_key), token='user_detail',
+                                        org=org)
     return {'execution_id': execution_id}
 
 
@@ -169,9 +173,9 @@ def container_user_start_query(org, name, cid):
 @check_org_permission('read')
 def container_users(org, name, cid, execution_id):
     next_key = get_next_key()
-    state_result = athena_client.get_query_execution(
-        QueryExecutionId=execution_id
-    )
+    state_result = get_query_execution(org, execution_id)
+    # the Athena execution id of a queued query
+    execution_id = state_result['QueryExecution']['QueryExecutionId']
     # QUEUED | RUNNING | SUCCEEDED | FAILED | CANCELLED
     state = state_result['QueryExecution']['Status']['State']
     items = []
@@ -23,3 +23,7 @@ def get_container_table():
 
 def get_usage_table():
     return resource.Table(str(os.environ.get('OTM_USAGE_DYNAMODB_TABLE')))
+
+
+def get_stats_result_table():
+    return resource.Table(str(os.environ.get('OTM_STATS_RESULT_DYNAMODB_TABLE')))
@@ -122,7 +122,8 @@ def delete_container_goals(org, name, goal):
 @check_org_permission('write')
 @check_json_body({
     'startdate': {'type': 'string', 'required': True, 'empty': False},
-    'enddate': {'type': 'string', 'required': True, 'empty': False}
+    'enddate': {'type': 'string', 'required': True, 'empty': False},
+    'approx': {'type': 'boolean'}
 })
 def update_goal_request(org, name, goal):
     request = app.current_request
@@ -146,7 +147,9 @@ def update_goal_request(org, name, goal):
                 {'name': 'TID', 'value': name},
                 {'name': 'GOAL_ID', 'value': goal},
                 {'name': 'STARTDATE', 'value': body['startdate']},
-                {'name': 'ENDDATE', 'value': body['enddate']}
+                {'name': 'ENDDATE', 'value': body['enddate']},
+                # APPROX_DISTINCT of the users
+                {'name': 'OTM_GOAL_APPROX', 'value': '1' if body.get('approx') else '0'}
             ]}
         )
         return Response(body={'queue': job['jobId']}, status_code=201)
@@ -0,0 +1,99 @@
+"""
+Approximate mode of the stats queries, for a fast first answer of the dashboard
+
+`approx: true` of start_query_url_table / start_query_pageview_time_series (and their query_result_*):
+
+- the distinct counts are APPROX_DISTINCT (HyperLogLog, standard error 2.3%) instead of COUNT(DISTINCT)
+- `sample` (percent, STATS_APPROX_SAMPLE_PERCENT by default, 100 is no sampling) reads the events of
+  the sampled clients, the clients are sampled by the hash of cid so that every count
+  (also the distinct counts) is extrapolated by 100 / sample
+
+The approximate artifact has its own name (`<type>_approx<sample>`) and its own chunks / daily counts,
+so it's never mixed with the exact one. `meta.approx` of the artifact:
+
+    {"sample": 10, "standard_error": 0.023,
+     "relative_error": {"count": 0.004, "session_count": 0.046, ...}}
+
+`relative_error` is the 95% bound of the total of each column, the bound of a value v of a column is
+1.96 * sqrt(se^2 + (100 / sample - 1) / v) (se is `standard_error` for the distinct counts, 0 for the others).
+"""
+import math
+import os
+
+# default max standard error of APPROX_DISTINCT
+STANDARD_ERROR = 0.023
+Z_95 = 1.96
+
+
+def default_sample():
+    return int(os.environ.get('STATS_APPROX_SAMPLE_PERCENT') or 100)
+
+
+def requested(body):
+    """
+    Approx of the request body, or None for the exact query
+    """
+    if not body.get('approx'):
+        return None
+    return Approx(body.get('sample') or default_sample())
+
+
+class Approx:
+    def __init__(self, sample=100):
+        # percent of the clients
+        self.sample = sample
+
+    def suffix(self, suffix):
+        # artifact / chunk suffix of the approximate query
+        return '%s_approx%d' % (suffix, self.sample)
+
+    def distinct(self, expression):
+        return 'APPROX_DISTINCT(%s)' % expression
+
+    def extrapolated(self, expression):
+        """
+        SQL expression of the count `expression` of the sampled clients scaled to all the clients
+        """
+        if self.sample >= 100:
+            return expression
+        return 'ROUND(%s * 100.0 / %d)' % (expression, self.sample)
+
+    def criteria(self, query_columns):
+        """
+        condition of the sampled clients, appended to the base criteria
+        """
+        if self.sample >= 100:
+            return ''
+        # events without cid are sampled by the session
+        return " AND ABS(FROM_BIG_ENDIAN_64(XXHASH64(TO_UTF8(COALESCE({cid}, {o_psid}, '')))) % 10000) < {0}".format(
+            self.sample * 100, **query_columns)
+
+    def extrapolate(self, pd_data, count_columns):
+        """
+        counts of the sampled clients scaled to all the clients
+        """
+        if self.sample >= 100 or pd_data.empty:
+            return pd_data
+        pd_data = pd_data.copy()
+        for name in count_columns:
+            values = (pd_data[name] * 100.0 / self.sample).round()
+            # integers like the exact counts, NaN (null) stays float
+            pd_data[name] = values if values.isnull().any() else values.astype('int64')
+        return pd_data
+
+    def meta(self, pd_data, count_columns, distinct_columns):
+        """
+        meta.approx of the artifact of the rows `pd_data` (DataFrame), `count_columns` are counts of events
+        or clients (not sums of values)
+        """
+        relative_error = {}
+        for name in count_columns:
+            total = float(pd_data[name].sum()) if name in pd_data else 0.0
+            se = STANDARD_ERROR if name in distinct_columns else 0.0
+            if self.sample < 100 and total <= 0:
+                # nothing was sampled
+                relative_error[name] = None
+                continue
+            sampling = (100.0 / self.sample - 1) / total if self.sample < 100 else 0.0
+            relative_error[name] = round(Z_95 * math.sqrt(se ** 2 + sampling), 4)
+        return {'sample': self.sample, 'standard_error': STANDARD_ERROR, 'relative_error': relative_error}
@@ -0,0 +1,89 @@
+"""
+Cache of the stats query results
+
+The artifact written under `generate_object_name` is the cache entry.
+Its S3 metadata keeps the hash of the query and the Athena execution id that made it:
+
+- start_query_*: the execution id of the artifact is returned when the query is the same and the entry is fresh
+- query_result_*: the artifact is returned as it is when it was made by the execution id (stats_result)
+"""
+from botocore.exceptions import ClientError
+from . import s3_client
+import datetime
+import hashlib
+import json
+import os
+import re
+import time
+
+
+def ttl():
+    # TTL of the entries whose window is not closed (includes today)
+    return int(os.environ.get('STATS_CACHE_TTL') or 300)
+
+
+def late_log_seconds():
+    # CloudFront log of a window is delivered until this time after the end of the window
+    return int(os.environ.get('STATS_CACHE_LATE_LOG_SECONDS') or 2 * 3600)
+
+
+def enabled():
+    return os.environ.get('STATS_CACHE_DISABLED') != '1'
+
+
+def query_hash(query):
+    # the query is normalized by whitespace, so that the indentation doesn't change the hash
+    return hashlib.sha1(re.sub(r'\s+', ' ', query).strip().encode('utf-8')).hexdigest()
+
+
+def metadata(query, execution_id):
+    """
+    S3 metadata of the artifact, put with the artifact
+    """
+    return {
+        'query-hash': query_hash(query),
+        'execution-id': execution_id,
+        'created-at': str(int(time.time()))
+    }
+
+
+def _epoch(dt):
+    # stime / etime are naive UTC datetime
+    return int(dt.replace(tzinfo=datetime.timezone.utc).timestamp())
+
+
+def is_fresh(meta, etime):
+    created_at = int(meta.get('created-at') or 0)
+    if created_at >= _epoch(etime) + late_log_seconds():
+        # the window was closed when the artifact was made, it never expires
+        return True
+    return time.time() - created_at < ttl()
+
+
+def _head(key):
+    try:
+        return s3_client.head_object(Bucket=os.environ.get('OTM_STATS_BUCKET'), Key=key)
+    except ClientError as e:
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
+            return None
+        raise
+
+
+def lookup(key, query, etime):
+    """
+    Execution id of the cached artifact of the query, or None
+    """
+    if not enabled():
+        return None
+    head = _head(key)
+    execution_id = None
+    if head:
+        meta = head.get('Metadata', {})
+        if meta.get('query-hash') == query_hash(query) and is_fresh(meta, etime):
+            execution_id = meta.get('execution-id')
+    print(json.dumps({'message': 'stats cache', 'key': key, 'hit': execution_id is not None}))
+    return execution_id
+
+
+def presigned_url(key):
+    return s3_client.generate_presigned_url('get_object', {'Key': key, 'Bucket': os.environ.get('OTM_STATS_BUCKET')})
@@ -0,0 +1,385 @@
+"""
+Day-chunked evaluation of the stats queries
+
+The requested window is split into chunks: whole days (UTC), and hours or a part of an hour at the edges.
+The rows of a closed chunk are stored in the stats bucket as a partial result,
+so only the chunks that are missing or still open are queried again.
+
+The partial rows are the rows of the query before the merge in Python (or the rows of the chunk merged by
+stats_rows when the result is streamed), so the stored rows and the queried rows are merged by the same code.
+
+DailyCounts stores the counts of each closed day in the same way, for the rolling sums of the time series.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from . import s3_client, stats_cache
+import bisect
+import datetime
+import functools
+import hashlib
+import json
+import os
+import numpy as np
+import pandas as pd
+
+ONE_SECOND = datetime.timedelta(seconds=1)
+ONE_HOUR = datetime.timedelta(hours=1)
+ONE_DAY = datetime.timedelta(days=1)
+TIME_FORMAT = '%Y%m%d%H%M%S'
+LABEL_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def enabled():
+    return os.environ.get('STATS_CHUNKS_DISABLED') != '1'
+
+
+def split(stime, etime):
+    """
+    Chunks [(start, end)] of the window, both ends are included like `generate_base_criteria`
+    """
+    chunks = []
+    current = stime
+    while current <= etime:
+        day_end = datetime.datetime(current.year, current.month, current.day) + ONE_DAY
+        hour_end = current.replace(minute=0, second=0, microsecond=0) + ONE_HOUR
+        if current == day_end - ONE_DAY and day_end - ONE_SECOND <= etime:
+            next_start = day_end
+        elif current == hour_end - ONE_HOUR and hour_end - ONE_SECOND <= etime:
+            next_start = hour_end
+        else:
+            # a part of an hour at the edges
+            next_start = min(hour_end, etime + ONE_SECOND)
+        chunks.append((current, next_start - ONE_SECOND))
+        current = next_start
+    return chunks
+
+
+def is_day(chunk):
+    return chunk[1] - chunk[0] == ONE_DAY - ONE_SECOND
+
+
+def label_expression(stime, etime):
+    """
+    SQL expression of the chunk label: the start of the day for whole days, the start of the hour at the edges
+    """
+    days = [x for x in split(stime, etime) if is_day(x)]
+    if not days:
+        return "format_datetime(datetime, 'yyyy-MM-dd HH:00:00')"
+    return """(CASE
+WHEN datetime >= timestamp '{0}' AND datetime <= timestamp '{1}' THEN format_datetime(datetime, 'yyyy-MM-dd 00:00:00')
+ELSE format_datetime(datetime, 'yyyy-MM-dd HH:00:00')
+END)""".format(days[0][0].strftime(LABEL_FORMAT), days[-1][1].strftime(LABEL_FORMAT))
+
+
+def _hour(dt):
+    return dt.replace(minute=0, second=0, microsecond=0)
+
+
+def _rows(data):
+    """
+    rows of DataFrame as python values, NaN is None like in JSON
+    """
+    return data.astype(object).where(data.notna(), None).to_dict('records')
+
+
+def _load(key):
+    try:
+        body = s3_client.get_object(Bucket=os.environ.get('OTM_STATS_BUCKET'), Key=key)['Body'].read()
+    except s3_client.exceptions.NoSuchKey:
+        # the span of the query doesn't have the rows of the chunk, the report has to be started again
+        raise Exception('Stored chunk is missing: %s' % key)
+    return json.loads(body)
+
+
+class ChunkedQuery:
+    """
+    `query(org, tid, stime, etime)` is evaluated by chunk.
+    `time_column` of each row is the hour (or the chunk label) of the row, `yyyy-MM-dd HH:00:00...`.
+    """
+
+    def __init__(self, org, tid, suffix, stime, etime, query, time_column):
+        self.org = org
+        self.tid = tid
+        self.suffix = suffix
+        self.query = query
+        self.time_column = time_column
+        self.chunks = split(stime, etime)
+        self.etime = etime
+        self._starts = [_hour(x[0]) for x in self.chunks]
+        self._stored = None
+
+    def _prefix(self):
+        return '%s%s/chunks/%s/' % ('' if self.org == 'root' else self.org + '/', self.tid, self.suffix)
+
+    def key(self, chunk):
+        # the hash of the query changes the key when the query (table, columns, ...) is changed
+        query_hash = stats_cache.query_hash(self.query(self.org, self.tid, chunk[0], chunk[1]))
+        return '%s%s_%s_%s.json' % (self._prefix(), chunk[0].strftime(TIME_FORMAT), chunk[1].strftime(TIME_FORMAT),
+                                    query_hash[:16])
+
+    def stored(self):
+        """
+        set of the keys of the stored chunks in the window
+        """
+        if self._stored is None:
+            prefix = self._prefix()
+            last = prefix + (self.etime + ONE_SECOND).strftime(TIME_FORMAT)
+            self._stored = set()
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=os.environ.get('OTM_STATS_BUCKET'), Prefix=prefix,
+                                           StartAfter=prefix + (self.chunks[0][0] - ONE_SECOND).strftime(TIME_FORMAT)):
+                keys = [x['Key'] for x in page.get('Contents', [])]
+                self._stored.update(x for x in keys if x < last)
+                if keys and keys[-1] >= last:
+                    break
+        return self._stored
+
+    def is_closed(self, chunk):
+        # late CloudFront log is not delivered anymore
+        late = datetime.timedelta(seconds=stats_cache.late_log_seconds())
+        return chunk[1] + late < datetime.datetime.utcnow()
+
+    def _is_reusable(self, chunk):
+        return self.is_closed(chunk) and self.key(chunk) in self.stored()
+
+    def span_start(self):
+        """
+        start of the window that has to be queried, None when all the chunks are stored
+        """
+        if not enabled():
+            return self.chunks[0][0]
+        for chunk in self.chunks:
+            if not self._is_reusable(chunk):
+                return chunk[0]
+        return None
+
+    def execution_id(self):
+        # id of the result that is made only from the stored chunks
+        return 'chunks-' + hashlib.sha1('\n'.join(self.key(x) for x in self.chunks).encode('utf-8')).hexdigest()
+
+    def index_of(self, value):
+        """
+        index of the chunk of the time column value, -1 when it's not in a chunk
+        """
+        if not isinstance(value, str):
+            return -1
+        try:
+            dt = datetime.datetime.strptime(value[:19], LABEL_FORMAT)
+        except ValueError:
+            return -1
+        index = bisect.bisect_right(self._starts, dt) - 1
+        if index >= 0 and dt <= self.chunks[index][1]:
+            return index
+        return -1
+
+    def chunk_of(self, value):
+        index = self.index_of(value)
+        return self.chunks[index] if index >= 0 else None
+
+    def _load(self, chunk):
+        return _load(self.key(chunk))
+
+    def _save(self, chunk, rows):
+        s3_client.put_object(Bucket=os.environ.get('OTM_STATS_BUCKET'), Key=self.key(chunk),
+                             Body=json.dumps(rows, ensure_ascii=False), ContentType='application/json; charset=utf-8')
+
+    def merge(self, pd_data=None, span_start=None):
+        """
+        Rows of the whole window as DataFrame: the stored chunks before the queried span and the queried rows.
+        Closed chunks of the queried rows are stored.
+        `span_start` is the start of the queried span when the query was started, the stored chunks before it
+        are merged (a missing one is an error), it's computed again when it's not given.
+        """
+        if not enabled():
+            return pd_data
+
+        if span_start is None:
+            span_start = self.span_start()
+        if span_start is None:
+            span_start = self.etime + ONE_SECOND
+        columns = list(pd_data.columns) if pd_data is not None else None
+
+        queried = {}
+        rest = []
+        if pd_data is not None:
+            for row in _rows(pd_data):
+                chunk = self.chunk_of(row.get(self.time_column))
+                if chunk is None:
+                    # not expected, the row is used but not stored
+                    rest.append(row)
+                elif chunk[0] >= span_start:
+                    queried.setdefault(chunk, []).append(row)
+                # the other rows are in the chunks that are stored by another request meanwhile
+
+        stored_chunks = [x for x in self.chunks if x[0] < span_start]
+        new_chunks = [x for x in self.chunks if x[0] >= span_start and self.is_closed(x) and pd_data is not None]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            loaded = list(executor.map(self._load, stored_chunks))
+            list(executor.map(lambda x: self._save(x, queried.get(x, [])), new_chunks))
+
+        rows = [row for chunk_rows in loaded for row in chunk_rows]
+        for chunk in self.chunks:
+            rows.extend(queried.get(chunk, []))
+        rows.extend(rest)
+
+        print(json.dumps({'message': 'stats chunks', 'suffix': self.suffix, 'chunks': len(self.chunks),
+                          'stored': len(stored_chunks), 'saved': len(new_chunks), 'rows': len(rows)}))
+        return pd.DataFrame(rows, columns=columns)
+
+    def stream(self, frames, merge, span_start=None):
+        """
+        Merged rows of the whole window as DataFrame for a result that is read by chunks (stats_stream).
+        `merge(merged, frame)` merges the rows of `frame` into `merged` (None at first), like stats_rows.merge_*.
+        The queried frames are merged by chunk, and the closed chunks are stored as their merged rows,
+        so only the merged rows of each chunk are kept in memory.
+        `span_start` is the same as merge().
+        """
+        if not enabled():
+            merged = functools.reduce(merge, frames, None)
+            return pd.DataFrame() if merged is None else merged
+
+        if span_start is None:
+            span_start = self.span_start()
+        if span_start is None:
+            span_start = self.etime + ONE_SECOND
+
+        merged = None
+        stored_chunks = [x for x in self.chunks if x[0] < span_start]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            for i in range(0, len(stored_chunks), 16):
+                for rows in executor.map(self._load, stored_chunks[i:i + 16]):
+                    merged = merge(merged, pd.DataFrame(rows))
+
+        queried = {}
+        rest = None
+        for frame in frames:
+            indices = frame[self.time_column].map(self.index_of)
+            for index in indices.unique():
+                rows = frame[(indices == index).values]
+                if index < 0:
+                    # not expected, the rows are used but not stored
+                    rest = merge(rest, rows)
+                elif self.chunks[index][0] >= span_start:
+                    queried[index] = merge(queried.get(index), rows)
+                # the other rows are in the chunks that are stored by another request meanwhile
+
+        new_chunks = [i for i, x in enumerate(self.chunks) if x[0] >= span_start and self.is_closed(x)]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            list(executor.map(lambda x: self._save(self.chunks[x], _rows(queried[x]) if x in queried else []),
+                              new_chunks))
+
+        for index in sorted(queried):
+            merged = merge(merged, queried.pop(index))
+        if rest is not None:
+            merged = merge(merged, rest)
+
+        print(json.dumps({'message': 'stats chunks stream', 'suffix': self.suffix, 'chunks': len(self.chunks),
+                          'stored': len(stored_chunks), 'saved': len(new_chunks)}))
+        return pd.DataFrame() if merged is None else merged
+
+
+class DailyCounts:
+    """
+    Counts of each day (UTC) for the rolling sums of `windows` days: the days from `windows[-1] - 1` days before stime.
+    `query(org, tid, stime, etime)` returns the rows of `date` (yyyy-MM-dd) and the counts, closed days are stored.
+    """
+
+    def __init__(self, org, tid, suffix, stime, etime, query, counts, windows):
+        self.org = org
+        self.tid = tid
+        self.suffix = suffix
+        self.query = query
+        self.counts = counts
+        self.windows = windows
+        self.stime = stime
+        self.etime = etime
+        first = datetime.datetime(stime.year, stime.month, stime.day) - (windows[-1] - 1) * ONE_DAY
+        self.days = [first + i * ONE_DAY for i in range((etime - first).days + 1)]
+        self._stored = None
+
+    def _prefix(self):
+        return '%s%s/daily/%s/' % ('' if self.org == 'root' else self.org + '/', self.tid, self.suffix)
+
+    def key(self, day):
+        query_hash = stats_cache.query_hash(self.query(self.org, self.tid, day, day + ONE_DAY - ONE_SECOND))
+        return '%s%s_%s.json' % (self._prefix(), day.strftime('%Y%m%d'), query_hash[:16])
+
+    def stored(self):
+        if self._stored is None:
+            prefix = self._prefix()
+            last = prefix + (self.days[-1] + ONE_DAY).strftime('%Y%m%d')
+            self._stored = set()
+            paginator = s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=os.environ.get('OTM_STATS_BUCKET'), Prefix=prefix,
+                                           StartAfter=prefix + (self.days[0] - ONE_DAY).strftime('%Y%m%d')):
+                keys = [x['Key'] for x in page.get('Contents', [])]
+                self._stored.update(x for x in keys if x < last)
+                if keys and keys[-1] >= last:
+                    break
+        return self._stored
+
+    def is_closed(self, day):
+        day_end = day + ONE_DAY - ONE_SECOND
+        late = datetime.timedelta(seconds=stats_cache.late_log_seconds())
+        return day_end <= self.etime and day_end + late < datetime.datetime.utcnow()
+
+    def span_start(self):
+        """
+        start of the days that have to be queried, None when all the days are stored
+        """
+        if not enabled():
+            return self.days[0]
+        for day in self.days:
+            if not (self.is_closed(day) and self.key(day) in self.stored()):
+                return day
+        return None
+
+    def execution_id(self):
+        return 'daily-' + hashlib.sha1('\n'.join(self.key(x) for x in self.days).encode('utf-8')).hexdigest()
+
+    def _load(self, day):
+        return _load(self.key(day))
+
+    def _save(self, day, counts):
+        s3_client.put_object(Bucket=os.environ.get('OTM_STATS_BUCKET'), Key=self.key(day), Body=json.dumps(counts),
+                             ContentType='application/json; charset=utf-8')
+
+    def series(self, pd_data=None, span_start=None):
+        """
+        Rows of the days from stime: the counts and the rolling sums (`<count>_<n>days`) of each count.
+        `span_start` is the same as ChunkedQuery.merge().
+        """
+        if span_start is None:
+            span_start = self.span_start()
+        if span_start is None:
+            span_start = self.days[-1] + ONE_DAY
+
+        queried = {}
+        if pd_data is not None:
+            for row in _rows(pd_data):
+                queried[row['date']] = {name: row[name] or 0 for name in self.counts}
+
+        stored_days = [x for x in self.days if x < span_start]
+        new_days = [x for x in self.days if x >= span_start and self.is_closed(x) and pd_data is not None]
+        zero = {name: 0 for name in self.counts}
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            loaded = dict(zip(stored_days, executor.map(self._load, stored_days)))
+            if enabled():
+                list(executor.map(lambda x: self._save(x, queried.get(x.strftime('%Y-%m-%d'), zero)), new_days))
+
+        daily = [loaded[x] if x in loaded else queried.get(x.strftime('%Y-%m-%d'), zero) for x in self.days]
+        start = self.days.index(datetime.datetime(self.stime.year, self.stime.month, self.stime.day))
+        result = [{'date': x.strftime('%Y-%m-%d')} for x in self.days[start:]]
+        for name in self.counts:
+            values = np.array([x[name] for x in daily], dtype=np.int64)
+            cumulative = np.concatenate([[0], np.cumsum(values)])
+            index = np.arange(start, len(self.days))
+            for row, value in zip(result, values[start:]):
+                row[name] = int(value)
+            for n in self.windows:
+                sums = cumulative[index + 1] - cumulative[np.maximum(index + 1 - n, 0)]
+                for row, value in zip(result, sums):
+                    row['%s_%ddays' % (name, n)] = int(value)
+
+        print(json.dumps({'message': 'stats daily', 'suffix': self.suffix, 'days': len(self.days),
+                          'stored': len(stored_days), 'saved': len(new_days)}))
+        return result
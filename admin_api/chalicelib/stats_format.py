@@ -0,0 +1,75 @@
+"""
+Formats of the stats artifacts
+
+- json: row-oriented JSON (meta.version 4)
+- compact: columnar JSON (meta.version 5), gzip compressed (Content-Encoding: gzip)
+
+A table of the compact format is a list of blocks of columns, URL / title / state / label strings are
+indices of the dictionaries of the artifact:
+
+    {"meta": {..., "version": 5},
+     "table": [{"length": 2, "columns": {"url": {"dictionary": "url", "index": [0, 1]}, "count": [3, 1]}}],
+     "dictionaries": {"url": ["https://example.com/", "https://example.com/a"]}}
+
+The client requests the format by `format` of start_query_* / query_result_*, json is the default,
+so the clients that don't send `format` get the same artifacts as before.
+"""
+FORMATS = ['json', 'compact']
+DEFAULT_FORMAT = 'json'
+VERSIONS = {'json': 4, 'compact': 5}
+
+# column: dictionary, url and p_url share the dictionary
+DICTIONARY_COLUMNS = {
+    'url': 'url',
+    'p_url': 'url',
+    'title': 'title',
+    'state': 'state',
+    'p_state': 'state',
+    'label': 'label',
+}
+
+
+def requested(body):
+    return body.get('format') or DEFAULT_FORMAT
+
+
+def object_name(name, fmt):
+    # `<...>.json` of the json format, `<...>.v5.json` of the compact format
+    if fmt == 'json':
+        return name
+    return '%s.v%d.json' % (name[:-len('.json')], VERSIONS[fmt])
+
+
+class Encoder:
+    """
+    columnar blocks of the records, the dictionaries are shared by the blocks of the artifact
+    """
+
+    def __init__(self):
+        self.dictionaries = {}
+        self._indices = {}
+
+    def column(self, dictionary, values):
+        words = self.dictionaries.setdefault(dictionary, [])
+        indices = self._indices.setdefault(dictionary, {})
+        index = []
+        for value in values:
+            if value is None:
+                index.append(None)
+                continue
+            i = indices.get(value)
+            if i is None:
+                i = indices[value] = len(words)
+                words.append(value)
+            index.append(i)
+        return {'dictionary': dictionary, 'index': index}
+
+    def block(self, records):
+        columns = {}
+        for name in records[0].keys():
+            values = [x.get(name) for x in records]
+            if name in DICTIONARY_COLUMNS:
+                columns[name] = self.column(DICTIONARY_COLUMNS[name], values)
+            else:
+                columns[name] = values
+        return {'length': len(records), 'columns': columns}
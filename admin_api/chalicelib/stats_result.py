@@ -0,0 +1,131 @@
+"""
+Materialization state of the stats query results
+
+The artifacts of an execution are made once, by the first query_result_* that sees SUCCEEDED.
+The state of (execution_id, artifact) is kept in OTM_STATS_RESULT_DYNAMODB_TABLE:
+
+- pending: the query was started by start_query_*, `span_start` is the start of the queried span of a chunked
+  report (the chunks before it were stored when the query was started)
+- materializing: a request is transforming the Athena result, until `lease_until`
+- done: `artifact_keys` are written, query_result_* returns their presigned URLs without reading the result again
+
+`artifact` is the first key of the artifacts of the report, `event_graph` of url_links has its own key.
+A request that fails or times out while materializing gives the execution back to the next poll.
+"""
+from botocore.exceptions import ClientError
+from .dynamodb import get_stats_result_table
+from . import stats_cache
+import datetime
+import json
+import os
+import time
+
+TIME_FORMAT = '%Y%m%d%H%M%S'
+PENDING = 'pending'
+MATERIALIZING = 'materializing'
+DONE = 'done'
+
+
+def lease_seconds():
+    # longer than the timeout of the API function
+    return int(os.environ.get('STATS_RESULT_LEASE_SECONDS') or 900)
+
+
+def expire_seconds():
+    # DynamoDB TTL of the items
+    return int(os.environ.get('STATS_RESULT_EXPIRE_SECONDS') or 7 * 86400)
+
+
+def _key(keys, execution_id):
+    return {'execution_id': execution_id, 'artifact': keys[0]}
+
+
+def pending(keys, execution_id, span_start=None):
+    item = dict(_key(keys, execution_id), state=PENDING, expires_at=int(time.time()) + expire_seconds())
+    if span_start is not None:
+        item['span_start'] = span_start.strftime(TIME_FORMAT)
+    try:
+        get_stats_result_table().put_item(Item=item, ConditionExpression='attribute_not_exists(execution_id)')
+    except ClientError as e:
+        if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+            raise
+
+
+def done(keys, execution_id):
+    get_stats_result_table().put_item(
+        Item=dict(_key(keys, execution_id), state=DONE, artifact_keys=keys,
+                  expires_at=int(time.time()) + expire_seconds())
+    )
+
+
+def files(keys, execution_id):
+    """
+    Presigned URLs of the artifacts when they are done, or None
+    """
+    item = get_stats_result_table().get_item(Key=_key(keys, execution_id), ConsistentRead=True).get('Item')
+    if not item or item.get('state') != DONE:
+        return None
+    return [stats_cache.presigned_url(x) for x in item['artifact_keys']]
+
+
+def span_start(keys, execution_id):
+    """
+    `span_start` of pending(), None when it's not known
+    """
+    item = get_stats_result_table().get_item(Key=_key(keys, execution_id), ConsistentRead=True).get('Item')
+    if not item or 'span_start' not in item:
+        return None
+    return datetime.datetime.strptime(item['span_start'], TIME_FORMAT)
+
+
+def claim(keys, execution_id):
+    """
+    True when this request materializes the artifacts, False when another request does (or did)
+    """
+    now = int(time.time())
+    try:
+        get_stats_result_table().update_item(
+            Key=_key(keys, execution_id),
+            UpdateExpression='SET #state = :materializing, lease_until = :lease_until, expires_at = :expires_at',
+            ConditionExpression='attribute_not_exists(execution_id) OR #state = :pending'
+                                ' OR (#state = :materializing AND lease_until < :now)',
+            ExpressionAttributeNames={'#state': 'state'},
+            ExpressionAttributeValues={
+                ':materializing': MATERIALIZING,
+                ':pending': PENDING,
+                ':now': now,
+                ':lease_until': now + lease_seconds(),
+                ':expires_at': now + expire_seconds()
+            }
+        )
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def release(keys, execution_id):
+    get_stats_result_table().update_item(
+        Key=_key(keys, execution_id),
+        UpdateExpression='SET #state = :pending REMOVE lease_until',
+        ExpressionAttributeNames={'#state': 'state'},
+        ExpressionAttributeValues={':pending': PENDING}
+    )
+
+
+def materialize(keys, execution_id, make):
+    """
+    Run make() once for the execution, it writes the artifacts `keys` and returns their presigned URLs.
+    None is returned when another request is materializing them.
+    """
+    if not claim(keys, execution_id):
+        print(json.dumps({'message': 'stats result busy', 'execution_id': execution_id, 'artifact': keys[0]}))
+        return None
+    try:
+        result = make()
+    except Exception:
+        release(keys, execution_id)
+        raise
+    done(keys, execution_id)
+    return result
@@ -0,0 +1,75 @@
+"""
+Nightly rollups of the collect log
+
+data_retriever/rollup.py aggregates each closed day (UTC) of each container by hour into Parquet tables:
+
+- otm_rollup_url_hour: the (hour, url, p_url) rows of the url table
+- otm_rollup_event_hour: the (hour, url, title, state, label) counts of the event table
+
+`_SUCCESS_2` is written into the partition of the day when the day of the container is finished,
+the number is the version of the rows (2: url_event_count of otm_rollup_url_hour).
+The url table and the event table read the rollups instead of the collect log
+when the window is made of whole hours and every day of the window is rolled up.
+"""
+from . import s3_client
+from botocore.exceptions import ClientError
+import datetime
+import os
+
+URL_TABLE = 'otm_rollup_url_hour'
+EVENT_TABLE = 'otm_rollup_event_hour'
+PREFIX = 'rollups/'
+MARKER = '_SUCCESS_2'
+
+ONE_SECOND = datetime.timedelta(seconds=1)
+ONE_HOUR = datetime.timedelta(hours=1)
+ONE_DAY = datetime.timedelta(days=1)
+
+
+def enabled():
+    return os.environ.get('STATS_ROLLUP_ENABLED') == '1'
+
+
+def marker_key(table, org, tid, day):
+    return '%s%s/org=%s/tid=%s/year=%d/month=%d/day=%d/%s' % (
+        PREFIX, table, org, tid, day.year, day.month, day.day, MARKER)
+
+
+def _exists(key):
+    try:
+        s3_client.head_object(Bucket=os.environ.get('OTM_STATS_BUCKET'), Key=key)
+        return True
+    except ClientError:
+        return False
+
+
+def covers(table, org, tid, stime, etime):
+    """
+    True when the rows of the window can be read from the rollup
+    """
+    if not enabled():
+        return False
+    # hours at the edges are whole hours, like the chunks of stats_chunks
+    if stime != stime.replace(minute=0, second=0, microsecond=0):
+        return False
+    if etime < etime.replace(minute=0, second=0, microsecond=0) + ONE_HOUR - ONE_SECOND:
+        return False
+
+    day = datetime.datetime(stime.year, stime.month, stime.day)
+    while day <= etime:
+        if not _exists(marker_key(table, org, tid, day)):
+            return False
+        day += ONE_DAY
+    return True
+
+
+def criteria(org, tid, stime, etime):
+    # `datetime` of the rollup is the start of the hour
+    q = ''
+    q += " org = '%s'" % org
+    q += " AND tid = '%s'" % tid
+    q += ' AND year * 10000 + month * 100 + day >= %s' % stime.strftime('%Y%m%d')
+    q += ' AND year * 10000 + month * 100 + day <= %s' % etime.strftime('%Y%m%d')
+    q += " AND datetime >= timestamp '%s'" % (stime.strftime('%Y-%m-%d %H:%M:%S'))
+    q += " AND datetime <= timestamp '%s'" % (etime.strftime('%Y-%m-%d %H:%M:%S'))
+    return q
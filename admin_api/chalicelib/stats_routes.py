@@ -1,25 +1,23 @@
-from chalice import Blueprint
-from . import app, authorizer, s3, s3_client, athena_client, execute_athena_query, save_athena_usage_report
+from chalice import Blueprint, Rate
+from . import app, authorizer, s3, execute_athena_query, get_query_execution, save_athena_usage_report
+from . import athena_scheduler, query_scheduler
 from .decorator import check_org_permission, check_json_body
-from urllib.parse import urlparse
+from .collect_columns import columns
+from . import stats_approx, stats_cache, stats_chunks, stats_format, stats_result, stats_rollup, stats_rows, stats_stream
+from . import stats_window
 import pandas as pd
 import os
-import json
 import datetime
 
 stats_routes = Blueprint(__name__)
 
-
-def normalize_url(url):
-    if isinstance(url, str):
-        if url and url.lower() == 'undefined':
-            return url
-
-        if url:
-            parsedurl = urlparse(url)
-            return "{0}://{1}{2}".format(parsedurl.scheme, parsedurl.netloc, parsedurl.path)
-
-    return None
+# counts of the approximate queries that are extrapolated from the sampled clients
+URL_TABLE_APPROX_COUNTS = [x for x in stats_rows.URL_TABLE_SUM_COLUMNS if x != 'max_plt']
+URL_TABLE_APPROX_ERRORS = ['count', 'session_count', 'user_count', 's_count', 'event_count', 'w_click_count',
+                           't_click_count', 'plt_count']
+URL_TABLE_APPROX_DISTINCT = ['session_count', 'user_count', 's_count']
+PAGEVIEW_COUNTS = ['pageview_count', 'session_count', 'user_count']
+PAGEVIEW_APPROX_DISTINCT = ['session_count', 'user_count']
 
 
 def generate_base_criteria(org, tid, stime, etime):
@@ -30,7 +28,7 @@ def generate_base_criteria(org, tid, stime, etime):
     q += ' AND year * 10000 + month * 100 + day <= %s' % etime.strftime('%Y%m%d')
     q += " AND datetime >= timestamp '%s'" % (stime.strftime('%Y-%m-%d %H:%M:%S'))
     q += " AND datetime <= timestamp '%s'" % (etime.strftime('%Y-%m-%d %H:%M:%S'))
-    q += " AND JSON_EXTRACT_SCALAR(qs, '$.o_s') IS NOT NULL"
+    q += " AND {0} IS NOT NULL".format(columns()['o_s'])
     return q
 
 
@@ -44,14 +42,58 @@ def generate_object_name(org, tid, stime, etime, suffix):
     )
 
 
-def url_link_query(org, tid, stime, etime):
+def artifact_name(org, tid, stime, etime, suffix, fmt):
+    return stats_format.object_name(generate_object_name(org, tid, stime, etime, suffix), fmt)
+
+
+def artifact_writer(org, tid, stime, etime, suffix, query, execution_id, fmt, approx_meta=None):
+    meta = {
+        'stime': int(stime.timestamp() * 1000),
+        'etime': int(etime.timestamp() * 1000),
+        'tid': tid,
+        'version': stats_format.VERSIONS[fmt],
+        'type': suffix
+    }
+    if approx_meta is not None:
+        meta['approx'] = approx_meta
+    return stats_stream.ArtifactWriter(artifact_name(org, tid, stime, etime, suffix, fmt), meta,
+                                       stats_cache.metadata(query, execution_id), fmt)
+
+
+def approx_suffix(suffix, approx):
+    return approx.suffix(suffix) if approx else suffix
+
+
+def source(window):
+    """
+    (table, columns) of the report queries: the collect log, or the extract of the window
+    """
+    if window:
+        return window.table, window.columns()
+    return os.environ.get('STATS_ATHENA_TABLE'), columns()
+
+
+@stats_routes.schedule(Rate(1, unit=Rate.HOURS))
+def drop_expired_stats_windows(event):
+    stats_window.drop_expired()
+
+
+@stats_routes.schedule(Rate(1, unit=Rate.MINUTES))
+def sweep_athena_queries(event):
+    # stop the queries whose client stopped polling
+    if athena_scheduler.enabled():
+        query_scheduler.sweep()
+
+
+def url_link_query(org, tid, stime, etime, window=None):
+    table, query_columns = source(window)
     return """SELECT 
-JSON_EXTRACT_SCALAR(qs, '$.dl') AS url,
-JSON_EXTRACT_SCALAR(qs, '$.o_pl') AS p_url,
-JSON_EXTRACT_SCALAR(qs, '$.dt') AS title,
-JSON_EXTRACT_SCALAR(qs, '$.o_s') AS state,
+{dl} AS url,
+{o_pl} AS p_url,
+{dt} AS title,
+{o_s} AS state,
 JSON_EXTRACT_SCALAR(qs, '$.o_ps') AS p_state,
-JSON_EXTRACT_SCALAR(qs, '$.el') AS label,
+{el} AS label,
 JSON_EXTRACT_SCALAR(qs, '$.o_a_id') AS a_id,
 arbitrary(JSON_EXTRACT_SCALAR(qs, '$.o_xpath')) AS xpath,
 arbitrary(JSON_EXTRACT_SCALAR(qs, '$.o_a_class')) AS class,
@@ -59,39 +101,98 @@ COUNT(*) as count
 FROM {0}
 WHERE {1}
 GROUP BY 
-JSON_EXTRACT_SCALAR(qs, '$.dl'), 
-JSON_EXTRACT_SCALAR(qs, '$.o_pl'),
-JSON_EXTRACT_SCALAR(qs, '$.dt'),
-JSON_EXTRACT_SCALAR(qs, '$.o_s'),
+{dl}, 
+{o_pl},
+{dt},
+{o_s},
 JSON_EXTRACT_SCALAR(qs, '$.o_ps'),
-JSON_EXTRACT_SCALAR(qs, '$.el'),
+{el},
 JSON_EXTRACT_SCALAR(qs, '$.o_a_id')
-""".format(os.environ.get('STATS_ATHENA_TABLE'), generate_base_criteria(org, tid, stime, etime))
+""".format(table, generate_base_criteria(org, tid, stime, etime), **query_columns)
 
 
 @stats_routes.route('/start_query_url_links', methods=['POST'], cors=True, authorizer=authorizer)
 @check_org_permission('read')
 @check_json_body({
     'stime': {'type': 'integer', 'required': True},
-    'etime': {'type': 'integer', 'required': True}
+    'etime': {'type': 'integer', 'required': True},
+    'format': {'type': 'string', 'allowed': stats_format.FORMATS}
 })
 def make_container_stats_start_query_url_links(org, name):
     request = app.current_request
     body = request.json_body
     stime = datetime.datetime.utcfromtimestamp(int(body['stime']) / 1000)
     etime = datetime.datetime.utcfromtimestamp(int(body['etime']) / 1000)
-
-    execution_id = execute_athena_query(url_link_query(org, name, stime, etime), token='url_links')
+    fmt = stats_format.requested(body)
+
+    query = url_link_query(org, name, stime, etime)
+    keys = url_links_keys(org, name, stime, etime, fmt)
+    # event_graph is the last artifact of url_links
+    execution_id = stats_cache.lookup(keys[-1], query, etime)
+    if execution_id:
+        stats_result.done(keys, execution_id)
+        return {'execution_id': execution_id}
+
+    if stats_window.enabled():
+        execution_id = stats_window.start(org, name, stime, etime, generate_base_criteria)
+    else:
+        execution_id = execute_athena_query(query, token='url_links', org=org)
+    stats_result.pending(keys, execution_id)
 
     return {'execution_id': execution_id}
 
 
+def url_links_keys(org, name, stime, etime, fmt):
+    return [artifact_name(org, name, stime, etime, 'url_links', fmt),
+            artifact_name(org, name, stime, etime, 'event_graph', fmt)]
+
+
+def save_url_links(org, name, stime, etime, pd_data, execution_id, fmt):
+    urls, url_links = stats_rows.url_links(pd_data)
+    query = url_link_query(org, name, stime, etime)
+
+    with artifact_writer(org, name, stime, etime, 'url_links', query, execution_id, fmt) as links:
+        links.values('urls', urls, 'url')
+        links.field('url_links')
+        links.extend(url_links)
+
+    # event_graph is the last artifact of url_links
+    with artifact_writer(org, name, stime, etime, 'event_graph', query, execution_id, fmt) as graph:
+        graph.field('data')
+        graph.extend(stats_rows.event_graph(pd_data))
+    return links.url, graph.url
+
+
+def save_url_links_stream(org, name, stime, etime, body, execution_id, fmt):
+    # the edges of the event graph are merged while the url links are merged, in one pass of the result
+    query = url_link_query(org, name, stime, etime)
+    edges = {'merged': None}
+
+    def frames():
+        for frame in stats_stream.read_csv(body):
+            edges['merged'] = stats_rows.merge_event_graph(edges['merged'], frame)
+            yield frame
+
+    urls, url_links = stats_rows.url_links_frames(frames())
+    with artifact_writer(org, name, stime, etime, 'url_links', query, execution_id, fmt) as links:
+        links.values('urls', urls, 'url')
+        links.field('url_links')
+        links.extend(stats_rows.iter_records(url_links))
+
+    # event_graph is the last artifact of url_links
+    with artifact_writer(org, name, stime, etime, 'event_graph', query, execution_id, fmt) as graph:
+        graph.field('data')
+        graph.extend(stats_rows.iter_records(stats_rows.compact_event_graph(edges['merged'])))
+    return links.url, graph.url
+
+
 @stats_routes.route('/query_result_url_links', methods=['POST'], cors=True, authorizer=authorizer)
 @check_org_permission('read')
 @check_json_body({
     'execution_id': {'type': 'string', 'required': True},
     'stime': {'type': 'integer', 'required': True},
-    'etime': {'type': 'integer', 'required': True}
+    'etime': {'type': 'integer', 'required': True},
+    'format': {'type': 'string', 'allowed': stats_format.FORMATS}
 })
 def make_container_query_result_url_links(org, name):
     request = app.current_request
@@ -99,10 +200,24 @@ def make_container_query_result_url_links(org, name):
     execution_id = body['execution_id']
     stime = datetime.datetime.utcfromtimestamp(int(body['stime']) / 1000)
     etime = datetime.datetime.utcfromtimestamp(int(body['etime']) / 1000)
+    fmt = stats_format.requested(body)
 
-    state_result = athena_client.get_query_execution(
-        QueryExecutionId=execution_id,
-    )
+    keys = url_links_keys(org, name, stime, etime, fmt)
+    files = stats_result.files(keys, execution_id)
+    if files:
+        return {'state': 'SUCCEEDED', 'file_url_links': files[0], 'file_event_graph': files[1]}
+
+    report_execution_id = execution_id
+    if stats_window.is_window(execution_id):
+        # the report query is started when the extract of the window is made
+        state, report_execution_id = stats_window.resolve(
+            org, execution_id, lambda window, query_stime: url_link_query(org, name, query_stime, etime, window), 'url_links')
+        if report_execution_id is None:
+            return {'state': state, 'file_url_links': None, 'file_event_graph': None}
+
+    state_result = get_query_execution(org, report_execution_id)
+    # the Athena execution id of a queued query
+    report_execution_id = state_result['QueryExecution']['QueryExecutionId']
 
     file_url_url_links = None
     file_url_event_graph = None
@@ -110,64 +225,22 @@ def make_container_query_result_url_links(org, name):
     # QUEUED | RUNNING | SUCCEEDED | FAILED | CANCELLED
     state = state_result['QueryExecution']['Status']['State']
     if state == 'SUCCEEDED':
-        result_data = s3.Bucket(os.environ.get('STATS_ATHENA_RESULT_BUCKET')).Object('%s.csv' % (execution_id)).get()
-        pd_data = pd.read_csv(result_data['Body'], encoding='utf-8')
-
-        urls = []
-        url_links_map = {}
-        result = []
-        for index, row in pd_data.iterrows():
-            event = json.loads(row.to_json())
-            result.append(event)
-            url = normalize_url(event['url'])
-            p_url = normalize_url(event['p_url'])
-            if url and url not in urls:
-                urls.append(url)
-            if p_url and p_url not in urls:
-                urls.append(p_url)
-
-        for index, row in pd_data.iterrows():
-            event = json.loads(row.to_json())
-            url = normalize_url(event['url'])
-            p_url = normalize_url(event['p_url'])
-            key = "{0}-{1}".format(url, p_url)
-            if key in url_links_map:
-                url_links_map[key]['count'] += event['count']
+        def make():
+            result_data = s3.Bucket(os.environ.get('STATS_ATHENA_RESULT_BUCKET')).Object('%s.csv' % (report_execution_id)).get()
+            if stats_stream.is_large(result_data):
+                files = save_url_links_stream(org, name, stime, etime, result_data['Body'], execution_id, fmt)
             else:
-                url_links_map[key] = {'count': event['count'], 'url': url, 'p_url': p_url,
-                                      'title': event['title']}
-
-        url_links = []
-        for key in url_links_map:
-            url_links.append(url_links_map[key])
-
-        target = s3.Object(os.environ.get('OTM_STATS_BUCKET'), generate_object_name(org, name, stime, etime, 'url_links'))
-        target.put(Body=json.dumps({
-            'meta': {
-                'stime': int(stime.timestamp() * 1000),
-                'etime': int(etime.timestamp() * 1000),
-                'tid': name,
-                'version': 4,
-                'type': 'url_links'
-            },
-            'urls': urls,
-            'url_links': url_links
-        }, ensure_ascii=False), ContentType='application/json; charset=utf-8')
-        file_url_url_links = s3_client.generate_presigned_url('get_object', {'Key': target.key, 'Bucket': target.bucket_name})
-
-        target_graph = s3.Object(os.environ.get('OTM_STATS_BUCKET'), generate_object_name(org, name, stime, etime, 'event_graph'))
-        target_graph.put(Body=json.dumps({
-            'meta': {
-                'stime': int(stime.timestamp() * 1000),
-                'etime': int(etime.timestamp() * 1000),
-                'tid': name,
-                'version': 4,
-                'type': 'event_graph'
-            },
-            'data': result
-        }, ensure_ascii=False), ContentType='application/json; charset=utf-8')
-        file_url_event_graph = s3_client.generate_presigned_url('get_object', {'Key': target.key, 'Bucket': target.bucket_name})
-        save_athena_usage_report(org, name, state_result)
+                pd_data = pd.read_csv(result_data['Body'], encoding='utf-8')
+                files = save_url_links(org, name, stime, etime, pd_data, execution_id, fmt)
+            save_athena_usage_report(org, name, state_result)
+            stats_window.save_usage_report(org, name, execution_id)
+            return files
+
+        files = stats_result.materialize(keys, execution_id, make)
+        if files is None:
+            # another request is writing the artifacts
+            return {'state': 'RUNNING', 'file_url_links': None, 'file_event_graph': None}
+        file_url_url_links, file_url_event_graph = files
 
     return {
         'state': state,
@@ -176,210 +249,211 @@ def make_container_query_result_url_links(org, name):
     }
 
 
-def url_table_query(org, tid, stime, etime):
-    return """
-WITH 
-title as (
-SELECT
-datet, url, FIRST_VALUE(title) OVER (PARTITION BY url ORDER BY datet) as title
-FROM
-(
+URL_HOUR_EXACT = """
+client AS (
 SELECT
-format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') as datet,
-JSON_EXTRACT_SCALAR(qs, '$.dl') as url,
-JSON_EXTRACT_SCALAR(qs, '$.dt') as title
+format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') AS datet,
+{dl} AS url,
+{o_pl} AS p_url,
+{cid} AS cid,
+MIN(datetime) AS first_datetime,
+MIN_BY({dt}, datetime) AS first_title,
+COUNT_IF({o_s} = 'pageview') AS pageview_count,
+ARRAY_AGG(CASE WHEN {o_s} = 'pageview' THEN {o_psid} END) AS psids,
+MAX(CASE WHEN {o_s_kind} = 'scroll' THEN {o_e_y} END) AS y,
+COUNT(datetime) AS event_count,
+COUNT_IF({o_s_kind} = 'click_widget') AS w_click_count,
+COUNT_IF({o_s_kind} = 'click_trivial') AS t_click_count,
+COUNT(CASE WHEN {o_s_kind} = 'pageview' AND {plt} > 0 AND {plt} <= 30000 THEN {plt} END) AS plt_count,
+SUM(CASE WHEN {o_s_kind} = 'pageview' AND {plt} > 0 AND {plt} <= 30000 THEN {plt} END) AS sum_plt,
+MAX(CASE WHEN {o_s_kind} = 'pageview' AND {plt} > 0 AND {plt} <= 30000 THEN {plt} END) AS max_plt
 FROM {0}
 WHERE {1}
-) tmp
+GROUP BY format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'), {dl}, {o_pl}, {cid}
 ),
 
-scroll as (
-SELECT 
-datet, url, p_url, COUNT(y) as s_count, SUM(CAST(y as decimal)) as sum_scroll_y, MAX(CAST(y as decimal)) as max_scroll_y
-FROM 
-(
+url_hour AS (
 SELECT
-format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') as datet,
-JSON_EXTRACT_SCALAR(qs, '$.dl') as url,
-JSON_EXTRACT_SCALAR(qs, '$.o_pl') AS p_url,
-MAX(JSON_EXTRACT_SCALAR(qs, '$.o_e_y')) as y,
-JSON_EXTRACT_SCALAR(qs, '$.cid') as cid
-FROM {0}
-WHERE JSON_EXTRACT_SCALAR(qs, '$.o_s') LIKE 'scroll_%' AND {1}
-GROUP BY format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'), JSON_EXTRACT_SCALAR(qs, '$.dl'), JSON_EXTRACT_SCALAR(qs, '$.o_pl'), JSON_EXTRACT_SCALAR(qs, '$.cid')
-) tmp 
+datet, url, p_url,
+MIN(first_datetime) AS first_datetime,
+MIN_BY(first_title, first_datetime) AS first_title,
+SUM(pageview_count) AS pageview_count,
+CARDINALITY(ARRAY_DISTINCT(FILTER(FLATTEN(ARRAY_AGG(psids)), x -> x IS NOT NULL))) AS session_count,
+COUNT_IF(cid IS NOT NULL AND pageview_count > 0) AS user_count,
+COUNT(y) AS s_count,
+SUM(y) AS sum_scroll_y,
+MAX(y) AS max_scroll_y,
+SUM(event_count) AS event_count,
+SUM(w_click_count) AS w_click_count,
+SUM(t_click_count) AS t_click_count,
+SUM(plt_count) AS plt_count,
+SUM(sum_plt) AS sum_plt,
+MAX(max_plt) AS max_plt
+FROM client
 GROUP BY datet, url, p_url
-),
+)"""
 
-event as (
-SELECT 
-format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') as datet,
-JSON_EXTRACT_SCALAR(qs, '$.dl') as url,
-JSON_EXTRACT_SCALAR(qs, '$.o_pl') AS p_url,
-COUNT(datetime) as event_count
+URL_HOUR_APPROX = """
+url_hour AS (
+SELECT
+format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') AS datet,
+{dl} AS url,
+{o_pl} AS p_url,
+MIN(datetime) AS first_datetime,
+MIN_BY({dt}, datetime) AS first_title,
+COUNT_IF({o_s} = 'pageview') AS pageview_count,
+APPROX_DISTINCT(CASE WHEN {o_s} = 'pageview' THEN {o_psid} END) AS session_count,
+APPROX_DISTINCT(CASE WHEN {o_s} = 'pageview' THEN {cid} END) AS user_count,
+APPROX_DISTINCT(CASE WHEN {o_s_kind} = 'scroll' AND {o_e_y} IS NOT NULL THEN {cid} END) AS s_count,
+AVG(CASE WHEN {o_s_kind} = 'scroll' THEN {o_e_y} END)
+* APPROX_DISTINCT(CASE WHEN {o_s_kind} = 'scroll' AND {o_e_y} IS NOT NULL THEN {cid} END) AS sum_scroll_y,
+MAX(CASE WHEN {o_s_kind} = 'scroll' THEN {o_e_y} END) AS max_scroll_y,
+COUNT(datetime) AS event_count,
+COUNT_IF({o_s_kind} = 'click_widget') AS w_click_count,
+COUNT_IF({o_s_kind} = 'click_trivial') AS t_click_count,
+COUNT(CASE WHEN {o_s_kind} = 'pageview' AND {plt} > 0 AND {plt} <= 30000 THEN {plt} END) AS plt_count,
+SUM(CASE WHEN {o_s_kind} = 'pageview' AND {plt} > 0 AND {plt} <= 30000 THEN {plt} END) AS sum_plt,
+MAX(CASE WHEN {o_s_kind} = 'pageview' AND {plt} > 0 AND {plt} <= 30000 THEN {plt} END) AS max_plt
 FROM {0}
 WHERE {1}
-GROUP BY format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'), JSON_EXTRACT_SCALAR(qs, '$.dl'), JSON_EXTRACT_SCALAR(qs, '$.o_pl') 
-),
-
-widget_click as (
-SELECT 
-format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') as datet,
-JSON_EXTRACT_SCALAR(qs, '$.dl') as url,
-JSON_EXTRACT_SCALAR(qs, '$.o_pl') AS p_url,
-COUNT(datetime) as w_click_count
-FROM {0}
-WHERE JSON_EXTRACT_SCALAR(qs, '$.o_s') LIKE 'click_widget_%' AND {1}
-GROUP BY format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'), JSON_EXTRACT_SCALAR(qs, '$.dl'), JSON_EXTRACT_SCALAR(qs, '$.o_pl')
-),
-
-trivial_click as (
-SELECT 
-format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') as datet,
-JSON_EXTRACT_SCALAR(qs, '$.dl') as url,
-JSON_EXTRACT_SCALAR(qs, '$.o_pl') AS p_url,
-COUNT(datetime) as t_click_count
-FROM {0}
-WHERE JSON_EXTRACT_SCALAR(qs, '$.o_s') LIKE 'click_trivial_%' AND {1}
-GROUP BY format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'), JSON_EXTRACT_SCALAR(qs, '$.dl'), JSON_EXTRACT_SCALAR(qs, '$.o_pl')
-),
+GROUP BY format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'), {dl}, {o_pl}
+)"""
+
+
+def url_table_query(org, tid, stime, etime, window=None, approx=None):
+    table, query_columns = source(window)
+    criteria = generate_base_criteria(org, tid, stime, etime)
+    url_events = 'SUM(event_count) OVER (PARTITION BY datet, url)'
+    url_hour = URL_HOUR_EXACT
+    if approx:
+        criteria += approx.criteria(query_columns)
+        # count is extrapolated after the query, the events of the url are extrapolated here
+        url_events = approx.extrapolated(url_events)
+        url_hour = URL_HOUR_APPROX
+    # one scan of the window:
+    # - client: aggregates of each (hour, url, p_url, cid), the scroll depth is the max of each client
+    # - url_hour: aggregates of each (hour, url, p_url)
+    # - title is the title of the first event of the url in the window
+    # the approximate url_hour is aggregated from the scan without `client`: the distinct counts are APPROX_DISTINCT,
+    # and the scroll depth of a client is the average of the scroll events of the url instead of the max of the client
+    # metrics other than count and the distinct counts are for the (url, p_url) that are not null,
+    # same as the join of the per-metric aggregates
+    # count is the pageview count multiplied by the event count of the url in the hour (all p_url),
+    # the title join of the previous query had a row for each event of the url, the API keeps its count
+    return """
+WITH 
+{0}
 
-plt as (
-SELECT 
-format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') as datet,
-JSON_EXTRACT_SCALAR(qs, '$.dl') as url,
-JSON_EXTRACT_SCALAR(qs, '$.o_pl') AS p_url,
-COUNT(JSON_EXTRACT_SCALAR(qs, '$.plt')) as plt_count,
-SUM(CAST(JSON_EXTRACT_SCALAR(qs, '$.plt') as decimal)) as sum_plt,
-MAX(CAST(JSON_EXTRACT_SCALAR(qs, '$.plt') as decimal)) as max_plt
+SELECT * FROM (
+SELECT
+datet AS datetime,
+url,
+CASE WHEN url IS NOT NULL THEN MIN_BY(first_title, first_datetime) OVER (PARTITION BY url) END AS title,
+p_url,
+CASE WHEN url IS NOT NULL THEN pageview_count * {1} ELSE pageview_count END AS count,
+session_count,
+user_count,
+CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN s_count END AS s_count,
+CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN sum_scroll_y END AS sum_scroll_y,
+CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN max_scroll_y END AS max_scroll_y,
+CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN event_count END AS event_count,
+CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN w_click_count END AS w_click_count,
+CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN t_click_count END AS t_click_count,
+CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN plt_count END AS plt_count,
+CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN sum_plt END AS sum_plt,
+CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN max_plt END AS max_plt
+FROM url_hour
+) tmp
+WHERE count > 0
+ORDER BY count DESC
+""".format(url_hour.format(table, criteria, **query_columns).strip(), url_events)
+
+
+def pageview_daily_query(org, tid, stime, etime, window=None, approx=None):
+    table, query_columns = source(window)
+    criteria = generate_base_criteria(org, tid, stime, etime)
+    if approx:
+        sessions = approx.distinct(query_columns['o_psid'])
+        users = approx.distinct(query_columns['cid'])
+        criteria += approx.criteria(query_columns)
+    else:
+        sessions = 'COUNT(DISTINCT {o_psid})'.format(**query_columns)
+        users = 'COUNT(DISTINCT {cid})'.format(**query_columns)
+    return """SELECT
+FORMAT_DATETIME(datetime, 'Y-MM-dd') as date,
+COUNT(*) as pageview_count,
+{2} as session_count,
+{3} as user_count
 FROM {0}
-WHERE JSON_EXTRACT_SCALAR(qs, '$.o_s') = 'pageview'
-AND CAST(JSON_EXTRACT_SCALAR(qs, '$.plt') as decimal) > 0 
-AND CAST(JSON_EXTRACT_SCALAR(qs, '$.plt') as decimal) <= 30000 
+WHERE {o_s} = 'pageview'
 AND {1}
-GROUP BY format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'), JSON_EXTRACT_SCALAR(qs, '$.dl'), JSON_EXTRACT_SCALAR(qs, '$.o_pl')
-)
+GROUP BY FORMAT_DATETIME(datetime, 'Y-MM-dd')
+""".format(table, criteria, sessions, users, **query_columns)
 
-SELECT
-format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') as datetime,
-JSON_EXTRACT_SCALAR(qs, '$.dl') as url,
-title.title,
-JSON_EXTRACT_SCALAR(qs, '$.o_pl') AS p_url,
-COUNT(qs) as count,
-COUNT(DISTINCT JSON_EXTRACT_SCALAR(qs, '$.o_psid')) as session_count,
-COUNT(DISTINCT JSON_EXTRACT_SCALAR(qs, '$.cid')) as user_count,
-scroll.s_count,
-scroll.sum_scroll_y,
-scroll.max_scroll_y,
-event.event_count,
-widget_click.w_click_count,
-trivial_click.t_click_count,
-plt.plt_count,
-plt.sum_plt,
-plt.max_plt
-FROM 
-{0}
-LEFT OUTER JOIN
-title ON (title.url = JSON_EXTRACT_SCALAR(qs, '$.dl') AND title.datet = format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'))
-LEFT OUTER JOIN 
-scroll ON (scroll.url = JSON_EXTRACT_SCALAR(qs, '$.dl') AND scroll.p_url = JSON_EXTRACT_SCALAR(qs, '$.o_pl') AND scroll.datet = format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'))
-LEFT OUTER JOIN 
-event ON (event.url = JSON_EXTRACT_SCALAR(qs, '$.dl') AND event.p_url = JSON_EXTRACT_SCALAR(qs, '$.o_pl') AND event.datet = format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'))
-LEFT OUTER JOIN 
-widget_click ON (widget_click.url = JSON_EXTRACT_SCALAR(qs, '$.dl') AND widget_click.p_url = JSON_EXTRACT_SCALAR(qs, '$.o_pl') AND widget_click.datet = format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'))
-LEFT OUTER JOIN 
-trivial_click ON (trivial_click.url = JSON_EXTRACT_SCALAR(qs, '$.dl') AND trivial_click.p_url = JSON_EXTRACT_SCALAR(qs, '$.o_pl') AND trivial_click.datet = format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'))
-LEFT OUTER JOIN
-plt ON (plt.url = JSON_EXTRACT_SCALAR(qs, '$.dl') AND plt.p_url = JSON_EXTRACT_SCALAR(qs, '$.o_pl') AND plt.datet = format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'))
-WHERE JSON_EXTRACT_SCALAR(qs, '$.o_s') = 'pageview' AND {1}
-GROUP BY format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ'), 
-JSON_EXTRACT_SCALAR(qs, '$.dl'),
-JSON_EXTRACT_SCALAR(qs, '$.o_pl'),
-title,
-s_count, sum_scroll_y, max_scroll_y, event_count, w_click_count, t_click_count, plt_count, sum_plt, max_plt
-ORDER BY count DESC
-""".format(os.environ.get('STATS_ATHENA_TABLE'), generate_base_criteria(org, tid, stime, etime))
 
+def pageview_daily_counts(org, tid, stime, etime, approx=None):
+    # rolling sums of 3, 7, 14 and 30 days, the approximate counts are stored apart
+    return stats_chunks.DailyCounts(org, tid, approx_suffix('pageview', approx), stime, etime,
+                                    lambda *args: pageview_daily_query(*args, approx=approx),
+                                    PAGEVIEW_COUNTS, [3, 7, 14, 30])
 
-def pageview_time_series(org, tid, stime, etime):
-    return """
-WITH
-date_range as (SELECT 
-  FORMAT_DATETIME(dt, 'Y-MM-dd') as date
-FROM (SELECT 1)
-CROSS JOIN UNNEST(
-  sequence(
-    CAST('{0}' AS date),
-    CAST('{1}' AS date),
-    INTERVAL '1' DAY
-  )
-) AS t(dt)),
-pageview AS (
-  SELECT FORMAT_DATETIME(datetime, 'Y-MM-dd') as date, JSON_EXTRACT_SCALAR(qs, '$.o_psid') as psid, JSON_EXTRACT_SCALAR(qs, '$.cid') as cid 
-  FROM {2}
-  WHERE JSON_EXTRACT_SCALAR(qs, '$.o_s') = 'pageview' 
-  AND {3}
-),
 
-daily AS (SELECT dr.date as date, 
-COUNT(pageview.date) as pageview_count,
-COUNT(DISTINCT pageview.psid) as session_count,
-COUNT(DISTINCT pageview.cid) as user_count
-FROM 
-date_range dr
-LEFT OUTER JOIN pageview ON (pageview.date = dr.date)
-GROUP BY dr.date
-)
+def pageview_time_series(org, tid, stime, etime, approx=None):
+    # query of all the days of the series, for the cache
+    return pageview_daily_query(org, tid, pageview_daily_counts(org, tid, stime, etime, approx).days[0], etime,
+                                approx=approx)
 
-SELECT
-*
-FROM (
-SELECT
-date,
-pageview_count,
-SUM(pageview_count) OVER (ORDER BY date ROWS BETWEEN 2 PRECEDING AND CURRENT ROW) as pageview_count_3days,
-SUM(pageview_count) OVER (ORDER BY date ROWS BETWEEN 6 PRECEDING AND CURRENT ROW) as pageview_count_7days,
-SUM(pageview_count) OVER (ORDER BY date ROWS BETWEEN 13 PRECEDING AND CURRENT ROW) as pageview_count_14days,
-SUM(pageview_count) OVER (ORDER BY date ROWS BETWEEN 29 PRECEDING AND CURRENT ROW) as pageview_count_30days,
-session_count,
-SUM(session_count) OVER (ORDER BY date ROWS BETWEEN 2 PRECEDING AND CURRENT ROW) as session_count_3days,
-SUM(session_count) OVER (ORDER BY date ROWS BETWEEN 6 PRECEDING AND CURRENT ROW) as session_count_7days,
-SUM(session_count) OVER (ORDER BY date ROWS BETWEEN 13 PRECEDING AND CURRENT ROW) as session_count_14days,
-SUM(session_count) OVER (ORDER BY date ROWS BETWEEN 29 PRECEDING AND CURRENT ROW) as session_count_30days,
-user_count,
-SUM(user_count) OVER (ORDER BY date ROWS BETWEEN 2 PRECEDING AND CURRENT ROW) as user_count_3days,
-SUM(user_count) OVER (ORDER BY date ROWS BETWEEN 6 PRECEDING AND CURRENT ROW) as user_count_7days,
-SUM(user_count) OVER (ORDER BY date ROWS BETWEEN 13 PRECEDING AND CURRENT ROW) as user_count_14days,
-SUM(user_count) OVER (ORDER BY date ROWS BETWEEN 29 PRECEDING AND CURRENT ROW) as user_count_30days
-FROM
-daily
-) 
-WHERE date >= '{4}'
-ORDER BY date ASC
-""".format(
-        (stime - datetime.timedelta(days=30)).strftime('%Y-%m-%d'),
-        etime.strftime('%Y-%m-%d'),
-        os.environ.get('STATS_ATHENA_TABLE'),
-        generate_base_criteria(org, tid, (stime - datetime.timedelta(days=30)), etime),
-        stime.strftime('%Y-%m-%d')
-    )
+
+def save_pageview_time_series(org, name, stime, etime, result, execution_id, fmt, approx=None):
+    query = pageview_time_series(org, name, stime, etime, approx)
+    approx_meta = approx.meta(pd.DataFrame(result), PAGEVIEW_COUNTS, PAGEVIEW_APPROX_DISTINCT) if approx else None
+    suffix = approx_suffix('pageview_time_series', approx)
+    with artifact_writer(org, name, stime, etime, suffix, query, execution_id, fmt, approx_meta) as writer:
+        writer.field('table')
+        writer.extend(result)
+    return writer.url
 
 
 @stats_routes.route('/start_query_pageview_time_series', methods=['POST'], cors=True, authorizer=authorizer)
 @check_org_permission('read')
 @check_json_body({
     'stime': {'type': 'integer', 'required': True},
-    'etime': {'type': 'integer', 'required': True}
+    'etime': {'type': 'integer', 'required': True},
+    'format': {'type': 'string', 'allowed': stats_format.FORMATS},
+    'approx': {'type': 'boolean'},
+    'sample': {'type': 'integer', 'min': 1, 'max': 100}
 })
 def make_container_stats_start_pageview_time_series(org, name):
     request = app.current_request
     body = request.json_body
     stime = datetime.datetime.utcfromtimestamp(int(body['stime']) / 1000)
     etime = datetime.datetime.utcfromtimestamp(int(body['etime']) / 1000)
-
-
-    q = pageview_time_series(org, name, stime, etime)
-    execution_id = execute_athena_query(q, token='pageview_time_series')
+    fmt = stats_format.requested(body)
+    approx = stats_approx.requested(body)
+
+    q = pageview_time_series(org, name, stime, etime, approx)
+    keys = [artifact_name(org, name, stime, etime, approx_suffix('pageview_time_series', approx), fmt)]
+    execution_id = stats_cache.lookup(keys[0], q, etime)
+    if execution_id:
+        stats_result.done(keys, execution_id)
+        return {'execution_id': execution_id}
+
+    # closed days are stored, only the rest of the days is queried
+    daily = pageview_daily_counts(org, name, stime, etime, approx)
+    span_start = daily.span_start()
+    if span_start is None:
+        execution_id = daily.execution_id()
+        save_pageview_time_series(org, name, stime, etime, daily.series(), execution_id, fmt, approx)
+        stats_result.done(keys, execution_id)
+        return {'execution_id': execution_id}
+
+    if stats_window.enabled() and not approx:
+        execution_id = stats_window.start(org, name, stime, etime, generate_base_criteria, span_start)
+    else:
+        # the approximate query reads the collect log
+        execution_id = execute_athena_query(pageview_daily_query(org, name, span_start, etime, approx=approx),
+                                            token='pageview_time_series', org=org)
+    stats_result.pending(keys, execution_id, span_start)
 
     return {'execution_id': execution_id}
 
@@ -389,7 +463,10 @@ def make_container_stats_start_pageview_time_series(org, name):
 @check_json_body({
     'execution_id': {'type': 'string', 'required': True},
     'stime': {'type': 'integer', 'required': True},
-    'etime': {'type': 'integer', 'required': True}
+    'etime': {'type': 'integer', 'required': True},
+    'format': {'type': 'string', 'allowed': stats_format.FORMATS},
+    'approx': {'type': 'boolean'},
+    'sample': {'type': 'integer', 'min': 1, 'max': 100}
 })
 def make_container_query_result_pageview_time_series(org, name):
     request = app.current_request
@@ -397,35 +474,47 @@ def make_container_query_result_pageview_time_series(org, name):
     execution_id = body['execution_id']
     stime = datetime.datetime.utcfromtimestamp(int(body['stime']) / 1000)
     etime = datetime.datetime.utcfromtimestamp(int(body['etime']) / 1000)
-
-    state_result = athena_client.get_query_execution(
-        QueryExecutionId=execution_id,
-    )
+    fmt = stats_format.requested(body)
+    approx = stats_approx.requested(body)
+
+    keys = [artifact_name(org, name, stime, etime, approx_suffix('pageview_time_series', approx), fmt)]
+    files = stats_result.files(keys, execution_id)
+    if files:
+        return {'state': 'SUCCEEDED', 'file': files[0]}
+
+    report_execution_id = execution_id
+    if stats_window.is_window(execution_id):
+        # the report query is started when the extract of the window is made
+        state, report_execution_id = stats_window.resolve(
+            org, execution_id, lambda window, query_stime: pageview_daily_query(org, name, query_stime, etime, window),
+            'pageview_time_series')
+        if report_execution_id is None:
+            return {'state': state, 'file': None}
+
+    state_result = get_query_execution(org, report_execution_id)
+    # the Athena execution id of a queued query
+    report_execution_id = state_result['QueryExecution']['QueryExecutionId']
     file = None
     # QUEUED | RUNNING | SUCCEEDED | FAILED | CANCELLED
     state = state_result['QueryExecution']['Status']['State']
     if state == 'SUCCEEDED':
-        result_data = s3.Bucket(os.environ.get('STATS_ATHENA_RESULT_BUCKET')).Object('%s.csv' % (execution_id)).get()
-        pd_data = pd.read_csv(result_data['Body'], encoding='utf-8')
-
-        result = []
-
-        for index, row in pd_data.iterrows():
-            result.append(json.loads(row.to_json()))
-
-        target = s3.Object(os.environ.get('OTM_STATS_BUCKET'), generate_object_name(org, name, stime, etime, 'pageview_time_series'))
-        target.put(Body=json.dumps({
-            'meta': {
-                'stime': int(stime.timestamp() * 1000),
-                'etime': int(etime.timestamp() * 1000),
-                'tid': name,
-                'version': 4,
-                'type': 'pageview_time_series'
-            },
-            'table': result
-        }, ensure_ascii=False), ContentType='application/json; charset=utf-8')
-        file = s3_client.generate_presigned_url('get_object', {'Key': target.key, 'Bucket': target.bucket_name})
-        save_athena_usage_report(org, name, state_result)
+        def make():
+            result_data = s3.Bucket(os.environ.get('STATS_ATHENA_RESULT_BUCKET')).Object('%s.csv' % (report_execution_id)).get()
+            pd_data = pd.read_csv(result_data['Body'], encoding='utf-8')
+            if approx:
+                pd_data = approx.extrapolate(pd_data, PAGEVIEW_COUNTS)
+            result = pageview_daily_counts(org, name, stime, etime, approx).series(
+                pd_data, stats_result.span_start(keys, execution_id))
+            file = save_pageview_time_series(org, name, stime, etime, result, execution_id, fmt, approx)
+            save_athena_usage_report(org, name, state_result)
+            stats_window.save_usage_report(org, name, execution_id)
+            return [file]
+
+        files = stats_result.materialize(keys, execution_id, make)
+        if files is None:
+            # another request is writing the artifact
+            return {'state': 'RUNNING', 'file': None}
+        file = files[0]
 
     return {
         'state': state,
@@ -433,19 +522,119 @@ def make_container_query_result_pageview_time_series(org, name):
     }
 
 
+def url_table_rollup_query(org, tid, stime, etime):
+    # same rows as url_table_query, from the rollup of each hour
+    # (count is multiplied by the event count of the url in the hour like url_table_query)
+    return """SELECT * FROM (
+SELECT
+format_datetime(datetime, 'yyyy-MM-dd HH:00:00ZZ') AS datetime,
+url,
+CASE WHEN url IS NOT NULL THEN MIN_BY(first_title, first_datetime) OVER (PARTITION BY url) END AS title,
+p_url,
+CASE WHEN url IS NOT NULL THEN count * url_event_count ELSE count END AS count,
+session_count,
+user_count,
+s_count,
+sum_scroll_y,
+max_scroll_y,
+event_count,
+w_click_count,
+t_click_count,
+plt_count,
+sum_plt,
+max_plt
+FROM {0}
+WHERE {1}
+) tmp
+WHERE count > 0
+ORDER BY count DESC
+""".format(stats_rollup.URL_TABLE, stats_rollup.criteria(org, tid, stime, etime))
+
+
+def url_table_chunks(org, tid, stime, etime, approx=None):
+    # the approximate rows are stored apart
+    return stats_chunks.ChunkedQuery(org, tid, approx_suffix('url_table', approx), stime, etime,
+                                     lambda *args: url_table_query(*args, approx=approx), 'datetime')
+
+
+def url_table_approx_meta(table, approx):
+    # `table` is the merged url table of the artifact, after the extrapolation and the merge of the chunks
+    return approx.meta(table, URL_TABLE_APPROX_ERRORS, URL_TABLE_APPROX_DISTINCT) if approx else None
+
+
+def save_url_table(org, name, stime, etime, pd_data, execution_id, fmt, approx=None):
+    # the merged table, the approx meta is computed from the same rows as save_url_table_stream
+    table = stats_rows.url_table_frames([pd_data])
+
+    query = url_table_query(org, name, stime, etime, approx=approx)
+    with artifact_writer(org, name, stime, etime, approx_suffix('url_table', approx), query, execution_id, fmt,
+                         url_table_approx_meta(table, approx)) as writer:
+        writer.field('table')
+        writer.extend(stats_rows.iter_records(table))
+    return writer.url
+
+
+def save_url_table_stream(org, name, stime, etime, body, execution_id, fmt, approx=None, span_start=None):
+    frames = stats_stream.read_csv(body)
+    if approx:
+        frames = (approx.extrapolate(x, URL_TABLE_APPROX_COUNTS) for x in frames)
+    merged = url_table_chunks(org, name, stime, etime, approx).stream(frames, stats_rows.merge_url_table, span_start)
+    table = stats_rows.url_table_frames([merged])
+
+    query = url_table_query(org, name, stime, etime, approx=approx)
+    with artifact_writer(org, name, stime, etime, approx_suffix('url_table', approx), query, execution_id, fmt,
+                         url_table_approx_meta(table, approx)) as writer:
+        writer.field('table')
+        writer.extend(stats_rows.iter_records(table))
+    return writer.url
+
+
 @stats_routes.route('/start_query_url_table', methods=['POST'], cors=True, authorizer=authorizer)
 @check_org_permission('read')
 @check_json_body({
     'stime': {'type': 'integer', 'required': True},
-    'etime': {'type': 'integer', 'required': True}
+    'etime': {'type': 'integer', 'required': True},
+    'format': {'type': 'string', 'allowed': stats_format.FORMATS},
+    'approx': {'type': 'boolean'},
+    'sample': {'type': 'integer', 'min': 1, 'max': 100}
 })
 def make_container_stats_start_query_url_table(org, name):
     request = app.current_request
     body = request.json_body
     stime = datetime.datetime.utcfromtimestamp(int(body['stime']) / 1000)
     etime = datetime.datetime.utcfromtimestamp(int(body['etime']) / 1000)
-
-    execution_id = execute_athena_query(url_table_query(org, name, stime, etime), token='url_table')
+    fmt = stats_format.requested(body)
+    approx = stats_approx.requested(body)
+
+    query = url_table_query(org, name, stime, etime, approx=approx)
+    keys = [artifact_name(org, name, stime, etime, approx_suffix('url_table', approx), fmt)]
+    execution_id = stats_cache.lookup(keys[0], query, etime)
+    if execution_id:
+        stats_result.done(keys, execution_id)
+        return {'execution_id': execution_id}
+
+    # closed days are stored by chunk, only the rest of the window is queried
+    chunks = url_table_chunks(org, name, stime, etime, approx)
+    span_start = chunks.span_start()
+    if span_start is None:
+        execution_id = chunks.execution_id()
+        save_url_table(org, name, stime, etime, chunks.merge(), execution_id, fmt, approx)
+        stats_result.done(keys, execution_id)
+        return {'execution_id': execution_id}
+
+    if approx:
+        # the approximate query reads the collect log
+        execution_id = execute_athena_query(url_table_query(org, name, span_start, etime, approx=approx),
+                                            token='url_table', org=org)
+    elif stats_rollup.covers(stats_rollup.URL_TABLE, org, name, span_start, etime):
+        execution_id = execute_athena_query(url_table_rollup_query(org, name, span_start, etime),
+                                            token='url_table', org=org)
+    elif stats_window.enabled():
+        execution_id = stats_window.start(org, name, stime, etime, generate_base_criteria, span_start)
+    else:
+        execution_id = execute_athena_query(url_table_query(org, name, span_start, etime),
+                                            token='url_table', org=org)
+    stats_result.pending(keys, execution_id, span_start)
 
     return {'execution_id': execution_id}
 
@@ -455,7 +644,10 @@ def make_container_stats_start_query_url_table(org, name):
 @check_json_body({
     'execution_id': {'type': 'string', 'required': True},
     'stime': {'type': 'integer', 'required': True},
-    'etime': {'type': 'integer', 'required': True}
+    'etime': {'type': 'integer', 'required': True},
+    'format': {'type': 'string', 'allowed': stats_format.FORMATS},
+    'approx': {'type': 'boolean'},
+    'sample': {'type': 'integer', 'min': 1, 'max': 100}
 })
 def make_container_query_result_url_table(org, name):
     request = app.current_request
@@ -463,83 +655,51 @@ def make_container_query_result_url_table(org, name):
     execution_id = body['execution_id']
     stime = datetime.datetime.utcfromtimestamp(int(body['stime']) / 1000)
     etime = datetime.datetime.utcfromtimestamp(int(body['etime']) / 1000)
-
-    state_result = athena_client.get_query_execution(
-        QueryExecutionId=execution_id,
-    )
+    fmt = stats_format.requested(body)
+    approx = stats_approx.requested(body)
+
+    keys = [artifact_name(org, name, stime, etime, approx_suffix('url_table', approx), fmt)]
+    files = stats_result.files(keys, execution_id)
+    if files:
+        return {'state': 'SUCCEEDED', 'file': files[0]}
+
+    report_execution_id = execution_id
+    if stats_window.is_window(execution_id):
+        # the report query is started when the extract of the window is made
+        state, report_execution_id = stats_window.resolve(
+            org, execution_id, lambda window, query_stime: url_table_query(org, name, query_stime, etime, window), 'url_table')
+        if report_execution_id is None:
+            return {'state': state, 'file': None}
+
+    state_result = get_query_execution(org, report_execution_id)
+    # the Athena execution id of a queued query
+    report_execution_id = state_result['QueryExecution']['QueryExecutionId']
     file = None
     # QUEUED | RUNNING | SUCCEEDED | FAILED | CANCELLED
     state = state_result['QueryExecution']['Status']['State']
     if state == 'SUCCEEDED':
-        result_data = s3.Bucket(os.environ.get('STATS_ATHENA_RESULT_BUCKET')).Object('%s.csv' % (execution_id)).get()
-        pd_data = pd.read_csv(result_data['Body'], encoding='utf-8')
-
-        table_result = []
-
-        for index, row in pd_data.iterrows():
-            url = normalize_url(row['url'])
-            p_url = normalize_url(row['p_url'])
-
-            rj = json.loads(row.to_json())
-
-            r = [d for d in table_result if d['url'] == url and d['p_url'] == p_url and d['datetime'] == rj['datetime']]
-            if len(r) > 0:
-                # merge data
-                r[0]['count'] += rj['count'] or 0
-                r[0]['session_count'] += rj['session_count'] or 0
-                r[0]['user_count'] += rj['user_count'] or 0
-                r[0]['s_count'] += rj['s_count'] or 0
-                r[0]['sum_scroll_y'] += rj['sum_scroll_y'] or 0
-                r[0]['max_scroll_y'] = max(r[0]['max_scroll_y'], rj['max_scroll_y'] or 0)
-                r[0]['event_count'] += rj['event_count'] or 0
-                r[0]['w_click_count'] += rj['w_click_count'] or 0
-                r[0]['t_click_count'] += rj['t_click_count'] or 0
-                r[0]['plt_count'] += rj['plt_count'] or 0
-                r[0]['sum_plt'] += rj['sum_plt'] or 0
-                r[0]['max_plt'] += rj['max_plt'] or 0
+        def make():
+            result_data = s3.Bucket(os.environ.get('STATS_ATHENA_RESULT_BUCKET')).Object('%s.csv' % (report_execution_id)).get()
+            # the chunks before the span were stored when the query was started
+            span_start = stats_result.span_start(keys, execution_id)
+            if stats_stream.is_large(result_data):
+                file = save_url_table_stream(org, name, stime, etime, result_data['Body'], execution_id, fmt, approx,
+                                             span_start)
             else:
-                # initialize data
-                rj['url'] = url
-                rj['p_url'] = p_url
-                rj['title'] = rj['title']
-                rj['count'] = rj['count'] or 0
-                rj['session_count'] = rj['session_count'] or 0
-                rj['user_count'] = rj['user_count'] or 0
-                rj['s_count'] = rj['s_count'] or 0
-                rj['sum_scroll_y'] = rj['sum_scroll_y'] or 0
-                rj['max_scroll_y'] = rj['max_scroll_y'] or 0
-                rj['event_count'] = rj['event_count'] or 0
-                rj['w_click_count'] = rj['w_click_count'] or 0
-                rj['t_click_count'] = rj['t_click_count'] or 0
-                rj['plt_count'] = rj['plt_count'] or 0
-                rj['sum_plt'] = rj['sum_plt'] or 0
-                rj['max_plt'] = rj['max_plt'] or 0
-                table_result.append(rj)
-
-        for t_result in table_result:
-            if t_result['s_count'] and t_result['s_count'] > 0:
-                t_result['avg_scroll_y'] = t_result['sum_scroll_y'] / t_result['s_count']
-            else:
-                t_result['avg_scroll_y'] = None
-
-            if t_result['plt_count'] and t_result['plt_count'] > 0:
-                t_result['avg_plt'] = t_result['sum_plt'] / t_result['plt_count']
-            else:
-                t_result['avg_plt'] = None
-
-        target = s3.Object(os.environ.get('OTM_STATS_BUCKET'), generate_object_name(org, name, stime, etime, 'url_table'))
-        target.put(Body=json.dumps({
-            'meta': {
-                'stime': int(stime.timestamp() * 1000),
-                'etime': int(etime.timestamp() * 1000),
-                'tid': name,
-                'version': 4,
-                'type': 'url_table'
-            },
-            'table': table_result
-        }, ensure_ascii=False), ContentType='application/json; charset=utf-8')
-        file = s3_client.generate_presigned_url('get_object', {'Key': target.key, 'Bucket': target.bucket_name})
-        save_athena_usage_report(org, name, state_result)
+                pd_data = pd.read_csv(result_data['Body'], encoding='utf-8')
+                if approx:
+                    pd_data = approx.extrapolate(pd_data, URL_TABLE_APPROX_COUNTS)
+                pd_data = url_table_chunks(org, name, stime, etime, approx).merge(pd_data, span_start)
+                file = save_url_table(org, name, stime, etime, pd_data, execution_id, fmt, approx)
+            save_athena_usage_report(org, name, state_result)
+            stats_window.save_usage_report(org, name, execution_id)
+            return [file]
+
+        files = stats_result.materialize(keys, execution_id, make)
+        if files is None:
+            # another request is writing the artifact
+            return {'state': 'RUNNING', 'file': None}
+        file = files[0]
 
     return {
         'state': state,
@@ -547,36 +707,115 @@ def make_container_query_result_url_table(org, name):
     }
 
 
-def event_table_query(org, name, stime, etime):
+def event_table_query(org, name, stime, etime, window=None):
+    table, query_columns = source(window)
     return """SELECT 
-JSON_EXTRACT_SCALAR(qs, '$.dl') AS url,
-JSON_EXTRACT_SCALAR(qs, '$.dt') AS title,
-JSON_EXTRACT_SCALAR(qs, '$.o_s') AS state,
-JSON_EXTRACT_SCALAR(qs, '$.el') AS label,
+{2} AS chunk,
+{norm_dl} AS url,
+{dt} AS title,
+{o_s} AS state,
+{el} AS label,
 COUNT(*) as count
 FROM {0}
 WHERE {1}
 GROUP BY 
-JSON_EXTRACT_SCALAR(qs, '$.dl'), 
-JSON_EXTRACT_SCALAR(qs, '$.dt'),
-JSON_EXTRACT_SCALAR(qs, '$.o_s'),
-JSON_EXTRACT_SCALAR(qs, '$.el')
-""".format(os.environ.get('STATS_ATHENA_TABLE'), generate_base_criteria(org, name, stime, etime))
+{2},
+{norm_dl}, 
+{dt},
+{o_s},
+{el}
+""".format(table, generate_base_criteria(org, name, stime, etime),
+           stats_chunks.label_expression(stime, etime), **query_columns)
+
+
+def event_table_rollup_query(org, name, stime, etime):
+    # same rows as event_table_query, from the rollup of each hour
+    return """SELECT 
+{1} AS chunk,
+url,
+title,
+state,
+label,
+SUM(count) as count
+FROM {0}
+WHERE {2}
+GROUP BY 
+{1},
+url,
+title,
+state,
+label
+""".format(stats_rollup.EVENT_TABLE, stats_chunks.label_expression(stime, etime),
+           stats_rollup.criteria(org, name, stime, etime))
+
+
+def event_table_chunks(org, tid, stime, etime):
+    return stats_chunks.ChunkedQuery(org, tid, 'event_table', stime, etime, event_table_query, 'chunk')
+
+
+def save_event_table(org, name, stime, etime, pd_data, execution_id, fmt):
+    # the chunk label is used only by stats_chunks
+    table_result = stats_rows.event_table(pd_data.drop(columns=['chunk'], errors='ignore'))
+
+    query = event_table_query(org, name, stime, etime)
+    with artifact_writer(org, name, stime, etime, 'event_table', query, execution_id, fmt) as writer:
+        writer.field('table')
+        writer.extend(table_result)
+    return writer.url
+
+
+def save_event_table_stream(org, name, stime, etime, body, execution_id, fmt, span_start=None):
+    # the chunk label is used only by stats_chunks
+    merged = event_table_chunks(org, name, stime, etime).stream(stats_stream.read_csv(body),
+                                                                stats_rows.merge_event_table, span_start)
+    table = stats_rows.event_table_frames([merged.drop(columns=['chunk'], errors='ignore')])
+
+    query = event_table_query(org, name, stime, etime)
+    with artifact_writer(org, name, stime, etime, 'event_table', query, execution_id, fmt) as writer:
+        writer.field('table')
+        writer.extend(stats_rows.iter_records(table))
+    return writer.url
 
 
 @stats_routes.route('/start_query_event_table', methods=['POST'], cors=True, authorizer=authorizer)
 @check_org_permission('read')
 @check_json_body({
     'stime': {'type': 'integer', 'required': True},
-    'etime': {'type': 'integer', 'required': True}
+    'etime': {'type': 'integer', 'required': True},
+    'format': {'type': 'string', 'allowed': stats_format.FORMATS}
 })
 def make_container_stats_start_query_event_table(org, name):
     request = app.current_request
     body = request.json_body
     stime = datetime.datetime.utcfromtimestamp(int(body['stime']) / 1000)
     etime = datetime.datetime.utcfromtimestamp(int(body['etime']) / 1000)
-
-    execution_id = execute_athena_query(event_table_query(org, name, stime, etime), token='event_table')
+    fmt = stats_format.requested(body)
+
+    query = event_table_query(org, name, stime, etime)
+    keys = [artifact_name(org, name, stime, etime, 'event_table', fmt)]
+    execution_id = stats_cache.lookup(keys[0], query, etime)
+    if execution_id:
+        stats_result.done(keys, execution_id)
+        return {'execution_id': execution_id}
+
+    # closed days are stored by chunk, only the rest of the window is queried
+    chunks = event_table_chunks(org, name, stime, etime)
+    span_start = chunks.span_start()
+    if span_start is None:
+        execution_id = chunks.execution_id()
+        save_event_table(org, name, stime, etime, chunks.merge(), execution_id, fmt)
+        stats_result.done(keys, execution_id)
+        return {'execution_id': execution_id}
+
+    if stats_rollup.covers(stats_rollup.EVENT_TABLE, org, name, span_start, etime):
+        execution_id = execute_athena_query(event_table_rollup_query(org, name, span_start, etime),
+                                            token='event_table', org=org)
+    elif stats_window.enabled():
+        execution_id = stats_window.start(org, name, stime, etime, generate_base_criteria, span_start)
+    else:
+        execution_id = execute_athena_query(event_table_query(org, name, span_start, etime),
+                                            token='event_table', org=org)
+    stats_result.pending(keys, execution_id, span_start)
 
     return {'execution_id': execution_id}
 
@@ -586,7 +825,8 @@ def make_container_stats_start_query_event_table(org, name):
 @check_json_body({
     'execution_id': {'type': 'string', 'required': True},
     'stime': {'type': 'integer', 'required': True},
-    'etime': {'type': 'integer', 'required': True}
+    'etime': {'type': 'integer', 'required': True},
+    'format': {'type': 'string', 'allowed': stats_format.FORMATS}
 })
 def make_container_query_result_event_table(org, name):
     request = app.current_request
@@ -594,41 +834,48 @@ def make_container_query_result_event_table(org, name):
     execution_id = body['execution_id']
     stime = datetime.datetime.utcfromtimestamp(int(body['stime']) / 1000)
     etime = datetime.datetime.utcfromtimestamp(int(body['etime']) / 1000)
-
-    state_result = athena_client.get_query_execution(
-        QueryExecutionId=execution_id,
-    )
+    fmt = stats_format.requested(body)
+
+    keys = [artifact_name(org, name, stime, etime, 'event_table', fmt)]
+    files = stats_result.files(keys, execution_id)
+    if files:
+        return {'state': 'SUCCEEDED', 'file': files[0]}
+
+    report_execution_id = execution_id
+    if stats_window.is_window(execution_id):
+        # the report query is started when the extract of the window is made
+        state, report_execution_id = stats_window.resolve(
+            org, execution_id, lambda window, query_stime: event_table_query(org, name, query_stime, etime, window), 'event_table')
+        if report_execution_id is None:
+            return {'state': state, 'file': None}
+
+    state_result = get_query_execution(org, report_execution_id)
+    # the Athena execution id of a queued query
+    report_execution_id = state_result['QueryExecution']['QueryExecutionId']
     file = None
     # QUEUED | RUNNING | SUCCEEDED | FAILED | CANCELLED
     state = state_result['QueryExecution']['Status']['State']
     if state == 'SUCCEEDED':
-        result_data = s3.Bucket(os.environ.get('STATS_ATHENA_RESULT_BUCKET')).Object('%s.csv' % (execution_id)).get()
-        pd_data = pd.read_csv(result_data['Body'], encoding='utf-8')
-        event_table_result = []
-
-        for index, row in pd_data.iterrows():
-            event = json.loads(row.to_json())
-            url = normalize_url(event['url'])
-            r = [d for d in event_table_result if d['url'] == url and d['state'] == event['state']]
-            if r:
-                r[0]['count'] += event['count']
+        def make():
+            result_data = s3.Bucket(os.environ.get('STATS_ATHENA_RESULT_BUCKET')).Object('%s.csv' % (report_execution_id)).get()
+            # the chunks before the span were stored when the query was started
+            span_start = stats_result.span_start(keys, execution_id)
+            if stats_stream.is_large(result_data):
+                file = save_event_table_stream(org, name, stime, etime, result_data['Body'], execution_id, fmt,
+                                               span_start)
             else:
-                event['url'] = url
-                event_table_result.append(event)
-
-        target = s3.Object(os.environ.get('OTM_STATS_BUCKET'), generate_object_name(org, name, stime, etime, 'event_table'))
-        target.put(Body=json.dumps({
-            'meta': {
-                'stime': int(stime.timestamp() * 1000),
-                'etime': int(etime.timestamp() * 1000),
-                'tid': name,
-                'version': 4,
-                'type': 'event_table'
-            },
-            'table': event_table_result
-        }, ensure_ascii=False), ContentType='application/json; charset=utf-8')
-        file = s3_client.generate_presigned_url('get_object', {'Key': target.key, 'Bucket': target.bucket_name})
-        save_athena_usage_report(org, name, state_result)
+                pd_data = pd.read_csv(result_data['Body'], encoding='utf-8')
+                pd_data = event_table_chunks(org, name, stime, etime).merge(pd_data, span_start)
+                file = save_event_table(org, name, stime, etime, pd_data, execution_id, fmt)
+            save_athena_usage_report(org, name, state_result)
+            stats_window.save_usage_report(org, name, execution_id)
+            return [file]
+
+        files = stats_result.materialize(keys, execution_id, make)
+        if files is None:
+            # another request is writing the artifact
+            return {'state': 'RUNNING', 'file': None}
+        file = files[0]
 
     return {
         'state': state,
@@ -0,0 +1,258 @@
+"""
+Post-processing of the stats query results
+
+The rows of the Athena result are merged by the normalized url.
+Rows are grouped by pandas and the first row of each group keeps the other columns,
+so the output is the same as merging the rows one by one in the order of the result.
+
+The `*_frames` functions merge a result that is read by chunks (stats_stream):
+the merged rows so far and the next chunk are merged again (`merge_*`), so only the merged rows are kept in memory.
+
+The event graph is compacted: the nodes (normalized urls) other than the STATS_EVENT_GRAPH_MAX_NODES (500)
+largest ones are merged into the OTHER node, and the edges of each source node (p_url) other than
+the STATS_EVENT_GRAPH_TOP_EDGES (20) largest ones are folded into one edge to OTHER. 0 disables the limit.
+"""
+from . import urlnorm
+import functools
+import json
+import os
+import pandas as pd
+
+URL_TABLE_KEYS = ['url', 'p_url', 'datetime']
+# max_plt is summed like the other counters
+URL_TABLE_SUM_COLUMNS = ['count', 'session_count', 'user_count', 's_count', 'sum_scroll_y', 'event_count',
+                         'w_click_count', 't_click_count', 'plt_count', 'sum_plt', 'max_plt']
+URL_TABLE_MAX_COLUMNS = ['max_scroll_y']
+EVENT_TABLE_KEYS = ['url', 'state']
+URL_LINKS_KEYS = ['url', 'p_url']
+EVENT_GRAPH_KEYS = ['url', 'p_url', 'state', 'p_state', 'label', 'a_id']
+# url of the merged nodes and the folded edges
+OTHER = '(other)'
+
+
+def event_graph_max_nodes():
+    return int(os.environ.get('STATS_EVENT_GRAPH_MAX_NODES') or 500)
+
+
+def event_graph_top_edges():
+    return int(os.environ.get('STATS_EVENT_GRAPH_TOP_EDGES') or 20)
+
+
+def _records(data, double_precision=10):
+    # NaN is null in JSON
+    return json.loads(data.to_json(orient='records', double_precision=double_precision))
+
+
+def _group(data, keys):
+    """
+    group id of each row, and the mask of the first row of each group
+    """
+    # NaN doesn't make a group, '' is used instead (a normalized url is never '')
+    group = data[keys].fillna('').groupby(keys, sort=False).ngroup()
+    return group, ~group.duplicated()
+
+
+def iter_records(data, double_precision=10, rows=10000):
+    """
+    records of DataFrame by slices of rows
+    """
+    for start in range(0, len(data), rows):
+        yield from _records(data.iloc[start:start + rows], double_precision)
+
+
+def _normalized(data, url_columns):
+    data = data.copy()
+    for name in url_columns:
+        data[name] = urlnorm.normalize_column(data[name])
+    return data
+
+
+def _reduce(frames, merge):
+    """
+    merged rows of the frames, None when there is no row
+    """
+    merged = None
+    for frame in frames:
+        if frame.empty:
+            continue
+        merged = merge(frame if merged is None else pd.concat([merged, frame], sort=False, ignore_index=True))
+    return merged
+
+
+def _merge_url_table(data):
+    group, first = _group(data, URL_TABLE_KEYS)
+    table = data[first].copy()
+    values = data[URL_TABLE_SUM_COLUMNS + URL_TABLE_MAX_COLUMNS].fillna(0)
+    sums = values[URL_TABLE_SUM_COLUMNS].groupby(group).sum().loc[group[first]]
+    maxes = values[URL_TABLE_MAX_COLUMNS].groupby(group).max().loc[group[first]]
+    # column by column, the array of the frame would make the integer counters float
+    for name in URL_TABLE_SUM_COLUMNS:
+        table[name] = sums[name].values
+    for name in URL_TABLE_MAX_COLUMNS:
+        table[name] = maxes[name].values
+    return table
+
+
+def _with_averages(table):
+    table['avg_scroll_y'] = table['sum_scroll_y'] / table['s_count'].where(table['s_count'] > 0)
+    table['avg_plt'] = table['sum_plt'] / table['plt_count'].where(table['plt_count'] > 0)
+    return table
+
+
+def url_table(pd_data):
+    if pd_data.empty:
+        return []
+    return _records(_with_averages(_merge_url_table(_normalized(pd_data, ['url', 'p_url']))))
+
+
+def merge_url_table(merged, frame):
+    """
+    rows of `merged` (None at first) and the rows of the url table query `frame`, merged by the normalized url.
+    The averages are not computed, the merged rows can be merged again.
+    """
+    if frame.empty:
+        return merged
+    frame = _normalized(frame, ['url', 'p_url'])
+    return _merge_url_table(frame if merged is None else pd.concat([merged, frame], sort=False, ignore_index=True))
+
+
+def url_table_frames(frames):
+    """
+    url table of the frames as DataFrame
+    """
+    table = functools.reduce(merge_url_table, frames, None)
+    return pd.DataFrame() if table is None else _with_averages(table)
+
+
+def _merge_event_table(data):
+    group, first = _group(data, EVENT_TABLE_KEYS)
+    table = data[first].copy()
+    table['count'] = data['count'].groupby(group).sum().loc[group[first]].values
+    return table
+
+
+def event_table(pd_data):
+    if pd_data.empty:
+        return []
+    return _records(_merge_event_table(_normalized(pd_data, ['url'])))
+
+
+def merge_event_table(merged, frame):
+    """
+    rows of `merged` (None at first) and the rows of the event table query `frame`, merged by the normalized url
+    """
+    if frame.empty:
+        return merged
+    frame = _normalized(frame, ['url'])
+    return _merge_event_table(frame if merged is None else pd.concat([merged, frame], sort=False, ignore_index=True))
+
+
+def event_table_frames(frames):
+    """
+    event table of the frames as DataFrame
+    """
+    table = functools.reduce(merge_event_table, frames, None)
+    return pd.DataFrame() if table is None else table
+
+
+def _merge_url_links(data):
+    group, first = _group(data, URL_LINKS_KEYS)
+    links = data[first][['count', 'url', 'p_url', 'title']].copy()
+    links['count'] = data['count'].groupby(group).sum().loc[group[first]].values
+    return links
+
+
+def _urls(data):
+    # url and p_url of each row, in the order of the rows
+    stacked = pd.Series(data[['url', 'p_url']].values.ravel())
+    return stacked[stacked.notna()].unique().tolist()
+
+
+def url_links(pd_data):
+    """
+    (urls, url_links) of the url link query
+    """
+    if pd_data.empty:
+        return [], []
+
+    data = _normalized(pd_data[['url', 'p_url', 'title', 'count']], ['url', 'p_url'])
+    return _urls(data), _records(_merge_url_links(data))
+
+
+def url_links_frames(frames):
+    """
+    (urls, url_links as DataFrame) of the frames
+    """
+    urls = {}
+
+    def normalized():
+        for frame in frames:
+            if frame.empty:
+                continue
+            data = _normalized(frame[['url', 'p_url', 'title', 'count']], ['url', 'p_url'])
+            for url in _urls(data):
+                urls.setdefault(url, None)
+            yield data
+
+    links = _reduce(normalized(), _merge_url_links)
+    return list(urls), pd.DataFrame() if links is None else links
+
+
+def _merge_event_graph(data):
+    group, first = _group(data, EVENT_GRAPH_KEYS)
+    graph = data[first].copy()
+    graph['count'] = data['count'].groupby(group).sum().loc[group[first]].values
+    return graph
+
+
+def merge_event_graph(merged, frame):
+    """
+    edges of `merged` (None at first) and the rows of the url link query `frame`, merged by the normalized url
+    """
+    if frame.empty:
+        return merged
+    frame = _normalized(frame, ['url', 'p_url'])
+    return _merge_event_graph(frame if merged is None else pd.concat([merged, frame], sort=False, ignore_index=True))
+
+
+def _fold(data, mask, columns):
+    # the rows of mask lose the identity of `columns`, they are merged by the next _merge_event_graph
+    if not mask.any():
+        return data
+    data = data.copy()
+    for name in columns:
+        data.loc[mask, name] = OTHER if name in ['url', 'p_url'] else None
+    return data
+
+
+def compact_event_graph(merged):
+    """
+    DataFrame of the event graph within the node and edge limits
+    """
+    if merged is None or merged.empty:
+        return pd.DataFrame()
+    graph = merged
+    edges = len(graph)
+
+    max_nodes = event_graph_max_nodes()
+    if max_nodes > 0:
+        # size of a node is the count of its edges in and out
+        sizes = pd.concat([graph[['url', 'count']],
+                           graph[['p_url', 'count']].rename(columns={'p_url': 'url'})]).groupby('url')['count'].sum()
+        kept = set(sizes.sort_values(ascending=False, kind='mergesort').index[:max_nodes])
+        graph = _fold(graph, graph['url'].notna() & ~graph['url'].isin(kept), ['url', 'title'])
+        graph = _fold(graph, graph['p_url'].notna() & ~graph['p_url'].isin(kept), ['p_url'])
+        graph = _merge_event_graph(graph)
+
+    top_edges = event_graph_top_edges()
+    if top_edges > 0:
+        rank = graph['count'].groupby(graph['p_url'].fillna('')).rank(method='first', ascending=False)
+        graph = _merge_event_graph(_fold(graph, rank > top_edges,
+                                         ['url', 'title', 'state', 'p_state', 'label', 'a_id', 'xpath', 'class']))
+
+    print(json.dumps({'message': 'stats event graph', 'edges': edges, 'compacted': len(graph)}))
+    return graph.sort_values('count', ascending=False, kind='mergesort')
+
+
+def event_graph(pd_data):
+    return _records(compact_event_graph(merge_event_graph(None, pd_data)))
@@ -0,0 +1,162 @@
+"""
+Streaming transform of large Athena results
+
+The result CSV is read by chunks of rows and the JSON artifact is written by S3 multipart upload,
+so the memory of the transform is bounded by the merged rows instead of the rows of the result.
+Results larger than STATS_STREAM_THRESHOLD bytes are streamed, the others are read at once.
+Every artifact is written by ArtifactWriter, small artifacts by one request.
+"""
+from . import s3_client, stats_format
+import itertools
+import json
+import os
+import zlib
+import pandas as pd
+
+# S3 multipart upload requires at least 5MB for every part except the last one
+PART_SIZE = 8 * 1024 * 1024
+DEFAULT_THRESHOLD = 32 * 1024 * 1024
+DEFAULT_CHUNK_ROWS = 50000
+# records of a block of the compact format
+BLOCK_ROWS = 10000
+
+
+def threshold():
+    return int(os.environ.get('STATS_STREAM_THRESHOLD') or DEFAULT_THRESHOLD)
+
+
+def is_large(result_data):
+    # result_data is the response of get() of the result CSV
+    return result_data['ContentLength'] > threshold()
+
+
+def read_csv(body):
+    """
+    DataFrames of the result CSV by chunks of STATS_STREAM_CHUNK_ROWS rows
+    """
+    return pd.read_csv(body, encoding='utf-8', chunksize=int(os.environ.get('STATS_STREAM_CHUNK_ROWS') or DEFAULT_CHUNK_ROWS))
+
+
+class ArtifactWriter:
+    """
+    `{"meta": meta, "<field>": [...], ...}` written by parts.
+    The json format is the same bytes as json.dumps of the whole artifact,
+    the compact format is written by blocks of BLOCK_ROWS records and gzip compressed (see stats_format).
+
+        with ArtifactWriter(key, meta, metadata, fmt) as writer:
+            writer.field('table')
+            writer.extend(records)
+        url = writer.url
+    """
+
+    def __init__(self, key, meta, metadata, fmt='json'):
+        self.bucket = os.environ.get('OTM_STATS_BUCKET')
+        self.key = key
+        self.metadata = metadata
+        self.encoder = stats_format.Encoder() if fmt == 'compact' else None
+        self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if self.encoder else None
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.in_list = False
+        self.first = True
+        self.url = None
+        self._write('{"meta": ' + json.dumps(meta, ensure_ascii=False))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def field(self, name):
+        """
+        start the list of records `name`
+        """
+        self._end_list()
+        self._write(', %s: [' % json.dumps(name))
+        self.in_list = True
+        self.first = True
+
+    def extend(self, records):
+        if self.encoder is None:
+            for record in records:
+                self._item(record)
+            return
+        records = iter(records)
+        while True:
+            block = list(itertools.islice(records, BLOCK_ROWS))
+            if not block:
+                break
+            self._item(self.encoder.block(block))
+
+    def values(self, name, values, dictionary):
+        """
+        list of strings `name`, the indices of `dictionary` in the compact format
+        """
+        self._end_list()
+        if self.encoder is not None:
+            values = self.encoder.column(dictionary, values)
+        self._write(', %s: %s' % (json.dumps(name), json.dumps(values, ensure_ascii=False)))
+
+    def _item(self, value):
+        self._write(('' if self.first else ', ') + json.dumps(value, ensure_ascii=False))
+        self.first = False
+
+    def _end_list(self):
+        if self.in_list:
+            self._write(']')
+            self.in_list = False
+
+    def _write(self, text):
+        data = text.encode('utf-8')
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buffer += data
+        if len(self.buffer) >= PART_SIZE:
+            self._upload_part()
+
+    def _headers(self):
+        headers = {'ContentType': 'application/json; charset=utf-8', 'Metadata': self.metadata}
+        if self.compressor is not None:
+            headers['ContentEncoding'] = 'gzip'
+        return headers
+
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = s3_client.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key, **self._headers())['UploadId']
+        number = len(self.parts) + 1
+        response = s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                         PartNumber=number, Body=bytes(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+        self.buffer = bytearray()
+
+    def close(self):
+        """
+        Finish the artifact, returns the presigned URL
+        """
+        self._end_list()
+        if self.encoder is not None:
+            self._write(', "dictionaries": ' + json.dumps(self.encoder.dictionaries, ensure_ascii=False))
+        self._write('}')
+        if self.compressor is not None:
+            self.buffer += self.compressor.flush()
+        if self.upload_id is None:
+            # small artifact, one request
+            s3_client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer), **self._headers())
+        else:
+            if self.buffer:
+                self._upload_part()
+            s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                MultipartUpload={'Parts': self.parts})
+            print(json.dumps({'message': 'stats stream', 'key': self.key, 'parts': len(self.parts)}))
+        self.url = s3_client.generate_presigned_url('get_object', {'Key': self.key, 'Bucket': self.bucket})
+        return self.url
+
+    def abort(self):
+        if self.upload_id is not None:
+            s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
@@ -0,0 +1,142 @@
+"""
+Shared materialization of the window of a dashboard
+
+The rows of a window (org, tid, span start .. etime) are extracted once into a temporary Parquet table (CTAS),
+then the report queries of the window read the extract instead of the collect log.
+The span starts at the start of the queried span of the report (the first chunk or day that is not stored),
+so the stored chunks are not read again. The span of the pageview time series starts at the first day of its rolling
+sums (30 days before stime at most), it's the only report that reads before stime.
+
+- start_query_*: the CTAS is started and `window_<CTAS execution id>_<table>_<stime>` is returned as the execution id.
+  Every report of the window gets the same CTAS execution, by the request token.
+- query_result_*: the report query is started when the CTAS is finished, with the same request token for every poll.
+  When the CTAS failed, the report query reads the collect log.
+
+The name of the table has the span and the TTL period (STATS_WINDOW_TTL seconds) of the start: the reports of the
+same span share the table, and a start in the next period makes a new table (and a new request token)
+instead of joining a table that may be dropped.
+The tables are dropped by `drop_expired` after two periods, the reports of the last start of a period read it.
+"""
+from . import execute_athena_query, get_query_execution, save_athena_usage_report, s3_client
+from .collect_columns import columns, STRING_COLUMNS, NUMBER_COLUMNS, DERIVED_COLUMNS
+import boto3
+import datetime
+import hashlib
+import json
+import os
+import time
+
+glue_client = boto3.client('glue')
+
+TABLE_PREFIX = 'otm_window_'
+LOCATION_PREFIX = 'windows/'
+TIME_FORMAT = '%Y%m%d%H%M%S'
+# query string keys that are read by the report queries, the extract keeps only them in `qs`
+QS_KEYS = ['o_ps', 'o_a_id', 'o_xpath', 'o_a_class']
+
+
+def enabled():
+    return os.environ.get('STATS_WINDOW_ENABLED') == '1'
+
+
+def ttl():
+    return int(os.environ.get('STATS_WINDOW_TTL') or 3600)
+
+
+class Window:
+    """
+    source of the report queries: the extract table, whose promoted columns don't need the fallback
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def columns(self):
+        return {name: name for name in STRING_COLUMNS + NUMBER_COLUMNS + DERIVED_COLUMNS}
+
+
+def _select(org, tid, span_start, etime, criteria):
+    qs = 'json_format(CAST(MAP(ARRAY[{0}], ARRAY[{1}]) AS JSON))'.format(
+        ', '.join("'%s'" % x for x in QS_KEYS),
+        ', '.join("JSON_EXTRACT_SCALAR(qs, '$.%s')" % x for x in QS_KEYS))
+    promoted = ',\n'.join('{0} AS {1}'.format(expression, name) for name, expression in columns().items())
+    return """SELECT
+org, tid, year, month, day, datetime,
+{0},
+{1} AS qs
+FROM {2}
+WHERE {3}""".format(promoted, qs, os.environ.get('STATS_ATHENA_TABLE'), criteria(org, tid, span_start, etime))
+
+
+def start(org, tid, stime, etime, criteria, query_stime=None):
+    """
+    Start (or join) the CTAS of the window, returns the execution id for the client
+    `query_stime` is the start of the queried span of the report (stime when it's not given)
+    """
+    span_start = query_stime or stime
+    select = _select(org, tid, span_start, etime, criteria)
+    # the span and the TTL period are a part of the name, the request token of execute_athena_query changes with it
+    table = TABLE_PREFIX + hashlib.sha1('\n'.join(
+        [select, span_start.strftime(TIME_FORMAT), str(int(time.time() // ttl()))]).encode('utf-8')).hexdigest()[:24]
+    ctas = """CREATE TABLE {0}
+WITH (format = 'PARQUET', external_location = 's3://{1}/{2}{0}/')
+AS {3}""".format(table, os.environ.get('STATS_ATHENA_RESULT_BUCKET'), LOCATION_PREFIX, select)
+    ctas_execution_id = execute_athena_query(ctas, token='window', org=org)
+    return 'window_%s_%s_%s' % (ctas_execution_id, table[len(TABLE_PREFIX):],
+                                span_start.strftime(TIME_FORMAT))
+
+
+def is_window(execution_id):
+    return execution_id.startswith('window_')
+
+
+def _parse(execution_id):
+    _, ctas_execution_id, table, query_stime = execution_id.split('_')
+    return ctas_execution_id, TABLE_PREFIX + table, datetime.datetime.strptime(query_stime, TIME_FORMAT)
+
+
+def resolve(org, execution_id, make_query, token):
+    """
+    (state, execution id of the report query), the execution id is None while the CTAS is running
+    `make_query(window, stime)` makes the report query, window is None for the collect log
+    """
+    ctas_execution_id, table, query_stime = _parse(execution_id)
+    state = get_query_execution(org, ctas_execution_id)['QueryExecution']['Status']['State']
+    if state in ['QUEUED', 'RUNNING']:
+        return state, None
+    window = Window(table) if state == 'SUCCEEDED' else None
+    return state, execute_athena_query(make_query(window, query_stime), token=token, org=org)
+
+
+def save_usage_report(org, tid, execution_id):
+    # the scan of the CTAS, the report is written once for each CTAS execution
+    if is_window(execution_id):
+        ctas_execution_id, _, _ = _parse(execution_id)
+        save_athena_usage_report(org, tid, get_query_execution(org, ctas_execution_id))
+
+
+def _delete_location(bucket, prefix):
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        keys = [{'Key': x['Key']} for x in page.get('Contents', [])]
+        if keys:
+            s3_client.delete_objects(Bucket=bucket, Delete={'Objects': keys, 'Quiet': True})
+
+
+def drop_expired():
+    """
+    Drop the extract tables that are older than two TTL periods, and their data
+    """
+    database = os.environ.get('STATS_ATHENA_DATABASE')
+    bucket = os.environ.get('STATS_ATHENA_RESULT_BUCKET')
+    dropped = []
+    paginator = glue_client.get_paginator('get_tables')
+    for page in paginator.paginate(DatabaseName=database, Expression=TABLE_PREFIX + '.*'):
+        for table in page['TableList']:
+            if time.time() - table['CreateTime'].timestamp() < 2 * ttl():
+                continue
+            glue_client.delete_table(DatabaseName=database, Name=table['Name'])
+            _delete_location(bucket, LOCATION_PREFIX + table['Name'] + '/')
+            dropped.append(table['Name'])
+
+    print(json.dumps({'message': 'drop stats windows', 'tables': dropped}))
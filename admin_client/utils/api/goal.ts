@@ -1,4 +1,6 @@
 /* eslint-disable camelcase */
+import { IStatApproxMeta } from '~/utils/api/stat'
+
 export type TGoalMatchPattern = 'eq' | 'prefix' | 'regex'
 
 export interface IGoal {
@@ -17,5 +19,7 @@ export interface IGoalResultData {
   date: string
   e_count: number
   u_count: number
+  // the users of the `approx` option are APPROX_DISTINCT
+  approx?: IStatApproxMeta
 }
 /* eslint-enable  */
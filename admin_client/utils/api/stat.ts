@@ -11,12 +11,20 @@ export interface IStat {
   file_url: string
 }
 
+// meta.approx of the approximate artifacts, see admin_api/chalicelib/stats_approx.py
+export interface IStatApproxMeta {
+  sample: number
+  standard_error: number
+  relative_error: { [name: string]: number | null }
+}
+
 export interface IStatDataMeta {
   etime: number
   stime: number
   tid: string
   type: string
   version: number
+  approx?: IStatApproxMeta
 }
 
 export interface IStatDataTable {
@@ -100,4 +108,21 @@ export interface IStatPageviewTimeSeriesData {
   meta: IStatDataMeta
   table: IStatPageviewTimeSeriesTable[]
 }
+
+// compact format (meta.version 5), see admin_api/chalicelib/stats_format.py
+export interface IStatCompactColumn {
+  dictionary: string
+  index: (number | null)[]
+}
+
+export interface IStatCompactBlock {
+  length: number
+  columns: { [name: string]: IStatCompactColumn | unknown[] }
+}
+
+export interface IStatCompactData {
+  meta: IStatDataMeta
+  dictionaries: { [name: string]: string[] }
+  [field: string]: unknown
+}
 /* eslint-enable */
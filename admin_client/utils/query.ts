@@ -1,6 +1,22 @@
 import API from '@aws-amplify/api'
 import { IQueryExecution, IQueryResultFile } from '~/utils/api/query'
-import {IStatEventTableData, IStatPageviewTimeSeriesData, IStatUrlTableData} from '~/utils/api/stat'
+import {
+  IStatCompactBlock,
+  IStatCompactColumn,
+  IStatCompactData,
+  IStatEventTableData,
+  IStatPageviewTimeSeriesData,
+  IStatUrlTableData,
+} from '~/utils/api/stat'
+
+// stats artifacts of meta.version 5 are columnar, version 4 is row-oriented
+const COMPACT_VERSION = 5
+
+// approximate query of url_table / pageview_time_series, a fast first answer
+export interface IQueryOptions {
+  approx?: boolean
+  sample?: number
+}
 
 const delay = (seconds: number): Promise<void> => {
   return new Promise((resolve) => {
@@ -10,13 +26,73 @@ const delay = (seconds: number): Promise<void> => {
   })
 }
 
+const isCompactColumn = (value: unknown): value is IStatCompactColumn => {
+  return (
+    typeof value === 'object' &&
+    value !== null &&
+    !Array.isArray(value) &&
+    'dictionary' in value
+  )
+}
+
+const decodeColumn = (
+  column: IStatCompactColumn | unknown[],
+  dictionaries: { [name: string]: string[] }
+): unknown[] => {
+  if (!isCompactColumn(column)) {
+    return column
+  }
+  const words = dictionaries[column.dictionary]
+  return column.index.map((i) => (i === null ? null : words[i]))
+}
+
+const decodeBlocks = (
+  blocks: IStatCompactBlock[],
+  dictionaries: { [name: string]: string[] }
+): { [name: string]: unknown }[] => {
+  const rows: { [name: string]: unknown }[] = []
+  for (const block of blocks) {
+    const columns = Object.keys(block.columns).map((name) => ({
+      name,
+      values: decodeColumn(block.columns[name], dictionaries),
+    }))
+    for (let i = 0; i < block.length; i++) {
+      const row: { [name: string]: unknown } = {}
+      for (const column of columns) {
+        row[column.name] = column.values[i]
+      }
+      rows.push(row)
+    }
+  }
+  return rows
+}
+
+// rows of the compact format, the same data as the row-oriented format
+const decodeArtifact = <T>(data: IStatCompactData): T => {
+  if (data.meta.version < COMPACT_VERSION) {
+    return (data as unknown) as T
+  }
+  const decoded: { [name: string]: unknown } = { meta: data.meta }
+  for (const name of Object.keys(data)) {
+    if (name === 'meta' || name === 'dictionaries') {
+      continue
+    }
+    const value = data[name]
+    decoded[name] = isCompactColumn(value)
+      ? decodeColumn(value, data.dictionaries)
+      : decodeBlocks(value as IStatCompactBlock[], data.dictionaries)
+  }
+  return (decoded as unknown) as T
+}
+
 const waitTableQuery = async (
   path: string,
   id: string,
   org: string,
   container: string,
   stime: number,
-  etime: number
+  etime: number,
+  options: IQueryOptions
 ): Promise<IQueryResultFile> => {
   const result: IQueryResultFile = await API.post(
     'OTMClientAPI',
@@ -26,6 +102,9 @@ const waitTableQuery = async (
         execution_id: id,
         stime,
         etime,
+        // the server default is the row-oriented json
+        format: 'compact',
+        ...options,
       },
     }
   )
@@ -36,7 +115,7 @@ const waitTableQuery = async (
     throw new Error('Failed to load')
   }
   await delay(1000)
-  return waitTableQuery(path, id, org, container, stime, etime)
+  return waitTableQuery(path, id, org, container, stime, etime, options)
 }
 
 const tableQuery = async <T>(
@@ -44,7 +123,8 @@ const tableQuery = async <T>(
   org: string,
   container: string,
   stime: number,
-  etime: number
+  etime: number,
+  options: IQueryOptions = {}
 ): Promise<T> => {
   const execute: IQueryExecution = await API.post(
     'OTMClientAPI',
@@ -53,6 +133,9 @@ const tableQuery = async <T>(
       body: {
         stime,
         etime,
+        // the server default is the row-oriented json
+        format: 'compact',
+        ...options,
       },
     }
   )
@@ -62,13 +145,15 @@ const tableQuery = async <T>(
     org,
     container,
     stime,
-    etime
+    etime,
+    options
   )
 
   if (result.file) {
     const response: Response = await fetch(result.file, { method: 'GET' })
-    const data: T = await response.json()
-    return data
+    // the compact artifact is gzip compressed, the browser decodes Content-Encoding
+    const data: IStatCompactData = await response.json()
+    return decodeArtifact<T>(data)
   }
 
   throw new Error('File not found')
@@ -78,14 +163,16 @@ export const pageviewTimeSeriesQuery = async (
   org: string,
   container: string,
   stime: number,
-  etime: number
+  etime: number,
+  options: IQueryOptions = {}
 ) => {
   return await tableQuery<IStatPageviewTimeSeriesData>(
     'pageview_time_series',
     org,
     container,
     stime,
-    etime
+    etime,
+    options
   )
 }
 
@@ -93,14 +180,16 @@ export const urlTableQuery = async (
   org: string,
   container: string,
   stime: number,
-  etime: number
+  etime: number,
+  options: IQueryOptions = {}
 ) => {
   return await tableQuery<IStatUrlTableData>(
     'url_table',
     org,
     container,
     stime,
-    etime
+    etime,
+    options
   )
 }
 
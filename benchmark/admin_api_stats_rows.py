@@ -0,0 +1,201 @@
+"""
+Benchmark of the post-processing of the stats query results
+
+Transforms synthetic Athena results (10k, 100k and 1M rows by default) into the url table, the event table
+and the url links, and prints the throughput as JSON.
+The results are generated from a fixed random seed, so the result is reproducible.
+
+    python benchmark/admin_api_stats_rows.py [--rows 10000 100000 1000000] [--seed 0] [--legacy 10000]
+
+`--legacy N` also measures the row by row merge before `stats_rows` for the results up to N rows,
+and checks that both outputs are the same.
+"""
+from argparse import ArgumentParser
+import io
+import json
+import os
+import random
+import sys
+import time
+import pandas as pd
+
+# the benchmark is not deployed with the app, the app is imported from its directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'admin_api'))
+from chalicelib import stats_rows  # noqa: E402
+from chalicelib.collect_columns import normalize_url  # noqa: E402
+
+STATES = ['pageview', 'scroll_25', 'scroll_50', 'click_widget_id=menu', 'click_trivial_class=link', 'leave']
+
+
+def generate_url(rnd, pages):
+    return 'https://example.com/page/%d?ref=%d' % (rnd.randint(0, pages), rnd.randint(0, 10))
+
+
+def optional(rnd, value):
+    # LEFT OUTER JOIN makes empty columns
+    return value if rnd.random() < 0.8 else None
+
+
+def url_table_data(rows, rnd):
+    pages = max(rows // 20, 10)
+    data = []
+    for i in range(rows):
+        data.append({
+            'datetime': '2020-05-%02d %02d:00:00+00:00' % (rnd.randint(1, 7), rnd.randint(0, 23)),
+            'url': generate_url(rnd, pages),
+            'title': 'Example page %d' % rnd.randint(0, pages),
+            'p_url': optional(rnd, generate_url(rnd, pages)),
+            'count': rnd.randint(1, 100),
+            'session_count': rnd.randint(1, 50),
+            'user_count': rnd.randint(1, 30),
+            's_count': optional(rnd, rnd.randint(0, 20)),
+            'sum_scroll_y': optional(rnd, rnd.randint(0, 100000)),
+            'max_scroll_y': optional(rnd, rnd.randint(0, 5000)),
+            'event_count': optional(rnd, rnd.randint(0, 300)),
+            'w_click_count': optional(rnd, rnd.randint(0, 10)),
+            't_click_count': optional(rnd, rnd.randint(0, 10)),
+            'plt_count': optional(rnd, rnd.randint(0, 20)),
+            'sum_plt': optional(rnd, rnd.randint(0, 200000)),
+            'max_plt': optional(rnd, rnd.randint(0, 30000)),
+        })
+    return data
+
+
+def event_table_data(rows, rnd):
+    pages = max(rows // 20, 10)
+    return [{
+        'url': generate_url(rnd, pages),
+        'title': 'Example page %d' % rnd.randint(0, pages),
+        'state': rnd.choice(STATES),
+        'label': optional(rnd, rnd.choice(['menu', 'footer link'])),
+        'count': rnd.randint(1, 100)
+    } for i in range(rows)]
+
+
+def url_links_data(rows, rnd):
+    pages = max(rows // 20, 10)
+    return [{
+        'url': generate_url(rnd, pages),
+        'p_url': optional(rnd, generate_url(rnd, pages)),
+        'title': 'Example page %d' % rnd.randint(0, pages),
+        'state': rnd.choice(STATES),
+        'p_state': rnd.choice(STATES),
+        'label': optional(rnd, rnd.choice(['menu', 'footer link'])),
+        'a_id': None,
+        'xpath': None,
+        'class': None,
+        'count': rnd.randint(1, 100)
+    } for i in range(rows)]
+
+
+def to_result(data):
+    # the Athena result is read from CSV
+    return pd.read_csv(io.StringIO(pd.DataFrame(data).to_csv(index=False)), encoding='utf-8')
+
+
+def legacy_url_table(pd_data):
+    table_result = []
+    for index, row in pd_data.iterrows():
+        url = normalize_url(row['url'])
+        p_url = normalize_url(row['p_url'])
+        rj = json.loads(row.to_json())
+        r = [d for d in table_result if d['url'] == url and d['p_url'] == p_url and d['datetime'] == rj['datetime']]
+        if len(r) > 0:
+            for key in stats_rows.URL_TABLE_SUM_COLUMNS:
+                r[0][key] += rj[key] or 0
+            r[0]['max_scroll_y'] = max(r[0]['max_scroll_y'], rj['max_scroll_y'] or 0)
+        else:
+            rj['url'] = url
+            rj['p_url'] = p_url
+            for key in stats_rows.URL_TABLE_SUM_COLUMNS + stats_rows.URL_TABLE_MAX_COLUMNS:
+                rj[key] = rj[key] or 0
+            table_result.append(rj)
+    for t_result in table_result:
+        t_result['avg_scroll_y'] = t_result['sum_scroll_y'] / t_result['s_count'] if t_result['s_count'] else None
+        t_result['avg_plt'] = t_result['sum_plt'] / t_result['plt_count'] if t_result['plt_count'] else None
+    return table_result
+
+
+def legacy_event_table(pd_data):
+    event_table_result = []
+    for index, row in pd_data.iterrows():
+        event = json.loads(row.to_json())
+        url = normalize_url(event['url'])
+        r = [d for d in event_table_result if d['url'] == url and d['state'] == event['state']]
+        if r:
+            r[0]['count'] += event['count']
+        else:
+            event['url'] = url
+            event_table_result.append(event)
+    return event_table_result
+
+
+def legacy_url_links(pd_data):
+    urls = []
+    url_links_map = {}
+    for index, row in pd_data.iterrows():
+        event = json.loads(row.to_json())
+        url = normalize_url(event['url'])
+        p_url = normalize_url(event['p_url'])
+        if url and url not in urls:
+            urls.append(url)
+        if p_url and p_url not in urls:
+            urls.append(p_url)
+        key = "{0}-{1}".format(url, p_url)
+        if key in url_links_map:
+            url_links_map[key]['count'] += event['count']
+        else:
+            url_links_map[key] = {'count': event['count'], 'url': url, 'p_url': p_url, 'title': event['title']}
+    return urls, list(url_links_map.values())
+
+
+TRANSFORMS = [
+    ('url_table', url_table_data, stats_rows.url_table, legacy_url_table),
+    ('event_table', event_table_data, stats_rows.event_table, legacy_event_table),
+    ('url_links', url_links_data, stats_rows.url_links, legacy_url_links),
+]
+
+
+def same(a, b):
+    # compared as JSON values, 1 and 1.0 are the same for the client
+    if isinstance(a, float) and isinstance(b, (int, float)):
+        return abs(a - b) <= 1e-9 * max(abs(a), abs(b), 1)
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(same(a[k], b[k]) for k in a)
+    if isinstance(a, (list, tuple)) and isinstance(b, (list, tuple)):
+        return len(a) == len(b) and all(same(x, y) for x, y in zip(a, b))
+    return a == b or (isinstance(b, float) and same(b, a))
+
+
+def measure(name, transform, pd_data):
+    started_at = time.perf_counter()
+    output = transform(pd_data)
+    elapsed = time.perf_counter() - started_at
+    return output, {
+        'transform': name,
+        'rows': len(pd_data),
+        'elapsed': round(elapsed, 3),
+        'rows_per_sec': int(len(pd_data) / elapsed)
+    }
+
+
+def main():
+    argparser = ArgumentParser()
+    argparser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000], help='rows of the result')
+    argparser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic result')
+    argparser.add_argument('--legacy', type=int, default=0, help='measure the legacy merge up to this number of rows')
+    args = argparser.parse_args()
+
+    for rows in args.rows:
+        for name, generate, transform, legacy in TRANSFORMS:
+            pd_data = to_result(generate(rows, random.Random(args.seed)))
+            output, result = measure(name, transform, pd_data)
+            print(json.dumps(result))
+            if rows <= args.legacy:
+                legacy_output, legacy_result = measure('legacy_' + name, legacy, pd_data)
+                legacy_result['same_output'] = same(output, legacy_output)
+                print(json.dumps(legacy_result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Benchmark of the CloudFront log parser
+
+Parses a synthetic CloudFront log (1M lines by default) and prints the throughput as JSON.
+The log is generated from a fixed random seed, so the result is reproducible.
+
+    python benchmark/log_formatter_cf_parser.py [--lines 1000000] [--seed 0] [--legacy]
+
+`--legacy` also measures the parser before the header-driven parser, for comparison.
+"""
+from argparse import ArgumentParser
+from urllib import parse as urlparse
+from urllib.parse import quote
+from datetime import datetime, timedelta
+import json
+import os
+import random
+import sys
+import time
+
+# the benchmark is not deployed with the app, the app is imported from its directory
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'log_formatter'))
+from chalicelib import cf_parser  # noqa: E402
+
+# distinct lines to be generated, the log repeats them
+POOL_SIZE = 10000
+
+STATES = ['pageview', 'scroll_25', 'scroll_50', 'scroll_100', 'click_widget_id=menu', 'click_trivial_class=link',
+          'change-url_url=/', 'leave']
+
+
+def generate_line(rnd, ts):
+    page = '/page/%d' % rnd.randint(0, 300)
+    state = rnd.choice(STATES)
+    qs = [
+        ('v', '1'),
+        ('tid', 'container%d' % rnd.randint(0, 3)),
+        ('org', rnd.choice(['root', 'org1'])),
+        ('dl', 'https://example.com%s?ref=%d' % (page, rnd.randint(0, 10))),
+        ('dt', 'Example page %s' % page),
+        ('cid', '%032x' % rnd.getrandbits(128)),
+        ('o_psid', '%032x' % rnd.getrandbits(128)),
+        ('o_pl', 'https://example.com/page/%d' % rnd.randint(0, 300)),
+        ('o_s', state),
+        ('o_ps', rnd.choice(STATES)),
+        ('el', rnd.choice(['', 'menu', 'footer link'])),
+        ('o_e_y', str(rnd.randint(0, 5000))),
+        ('plt', str(rnd.randint(1, 30000))),
+    ]
+    # CloudFront encodes the query string again
+    query = quote(urlparse.urlencode([x for x in qs if x[1]]), safe='=&')
+    return '\t'.join([
+        ts.strftime('%Y-%m-%d'), ts.strftime('%H:%M:%S'), 'NRT12-C1', '1234', '192.0.2.%d' % rnd.randint(1, 254), 'GET',
+        'd111111abcdef8.cloudfront.net', '/collect', '200', 'https://example.com/', 'Mozilla/5.0%20(X11)', query, '-',
+        'Hit', '%040x' % rnd.getrandbits(160), 'collect.example.com', 'https', '512', '0.001', '-', 'TLSv1.2',
+        'ECDHE-RSA-AES128-GCM-SHA256', 'Hit', 'HTTP/2.0', '-', '-', '54321', '0.001', 'Hit', 'text/html', '1024',
+        '-', '-'
+    ]) + '\n'
+
+
+def generate_log(lines, seed):
+    rnd = random.Random(seed)
+    start = datetime(2020, 5, 1)
+    pool = []
+    for i in range(POOL_SIZE):
+        # an hourly log file
+        pool.append(generate_line(rnd, start + timedelta(seconds=i * 3600 // POOL_SIZE)))
+    header = [
+        '#Version: 1.0\n',
+        '#Fields: %s\n' % ' '.join(cf_parser.DEFAULT_FIELDS + [
+            'c-port', 'time-to-first-byte', 'x-edge-detailed-result-type', 'sc-content-type', 'sc-content-len',
+            'sc-range-start', 'sc-range-end'])
+    ]
+    return header, pool, lines
+
+
+def iterate_log(log):
+    header, pool, lines = log
+    for line in header:
+        yield line
+    size = len(pool)
+    for i in range(lines):
+        yield pool[i % size]
+
+
+def legacy_parse_line(line):
+    # the parser before the header-driven parser (position based)
+    if line[0] == '#':
+        return None
+    data = line.rstrip().split('\t')
+    record_data = {
+        'x_edge_location': data[2],
+        'sc_bytes': data[3],
+        'c_ip': data[4],
+        'cs_method': data[5],
+        'cs_host': data[6],
+        'cs_uri_stem': data[7],
+        'cs_status': data[8],
+        'cs_referer': data[9],
+        'cs_user_agent': data[10],
+        'cs_uri_query': data[11],
+        'cs_cookie': data[12],
+        'cs_x_edge_result_type': data[13],
+        'cs_x_edge_request_id': data[14],
+        'x_host_header': data[15],
+        'cs_protocol': data[16],
+        'cs_bytes': data[17],
+        'time_taken': data[18],
+        'x_forwarded_for': data[19],
+        'ssl_protocol': data[20],
+        'ssl_cipher': data[21],
+        'x_edge_response_result_type': data[22],
+        'cs_protocol_version': data[23],
+        'fle_status': data[24],
+        'fle_encrypted_fields': data[25]
+    }
+    url_query = urlparse.parse_qs(urlparse.unquote(record_data['cs_uri_query']))
+    qs_json = {}
+    for key in url_query:
+        qs_json[key] = url_query[key][0]
+    record_data['qs'] = qs_json
+    ts = datetime.strptime(data[0] + ' ' + data[1], '%Y-%m-%d %H:%M:%S')
+    record_data['datetime'] = ts.strftime('%Y-%m-%d %H:%M:%S')
+    prefix = "org=%s/tid=%s/%s" % (qs_json.get('org', 'root'), qs_json.get('tid', 'null'),
+                                   ts.strftime('year=%Y/month=%-m/day=%-d'))
+    return record_data, prefix
+
+
+def measure(name, parse_line, log, serialize):
+    started_at = time.perf_counter()
+    count = 0
+    for line in iterate_log(log):
+        parsed = parse_line(line)
+        if parsed is None:
+            continue
+        if serialize:
+            json.dumps(parsed[0])
+        count += 1
+    elapsed = time.perf_counter() - started_at
+    return {
+        'parser': name,
+        'serialize': serialize,
+        'lines': count,
+        'elapsed': round(elapsed, 3),
+        'lines_per_sec': int(count / elapsed)
+    }
+
+
+def main():
+    argparser = ArgumentParser()
+    argparser.add_argument('--lines', type=int, default=1000000, help='number of log lines')
+    argparser.add_argument('--seed', type=int, default=0, help='random seed of the synthetic log')
+    argparser.add_argument('--legacy', action='store_true', default=False, help='measure the legacy parser too')
+    args = argparser.parse_args()
+
+    log = generate_log(args.lines, args.seed)
+
+    results = []
+    for serialize in [False, True]:
+        parser = cf_parser.CloudFrontLogParser()
+        results.append(measure('cf_parser', parser.parse_line, log, serialize))
+        if args.legacy:
+            results.append(measure('legacy', legacy_parse_line, log, serialize))
+
+    for result in results:
+        print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
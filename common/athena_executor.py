@@ -0,0 +1,210 @@
+"""
+Athena executions in flight, shared by admin_api and data_retriever
+
+AthenaExecutor starts the queries and polls every execution in flight with one batch_get_query_execution
+(50 ids a request). The poll interval starts at ATHENA_POLL_MIN_INTERVAL seconds and grows up to
+ATHENA_POLL_MAX_INTERVAL while no execution finishes. At most ATHENA_MAX_IN_FLIGHT queries run at once,
+the others wait in the order of submit().
+
+    executor = AthenaExecutor(boto3.client('athena'), {'OutputLocation': 's3://bucket/prefix'})
+    futures = [executor.submit(query) for query in queries]
+    results = [x.result() for x in futures]
+
+The result of a future is the get_query_execution response of the finished execution (SUCCEEDED | FAILED | CANCELLED).
+The queue, engine and total time of every finished execution are logged by `record`.
+"""
+from botocore.exceptions import ClientError
+from concurrent.futures import Future
+import json
+import os
+import threading
+import time
+
+FINISHED = ['SUCCEEDED', 'FAILED', 'CANCELLED']
+# max ids of batch_get_query_execution
+BATCH_SIZE = 50
+GROWTH = 1.5
+
+
+def record(result, waited=None):
+    """
+    Log the times of a finished execution, `waited` is the seconds from submit() to the result
+    """
+    execution = result['QueryExecution']
+    statistics = execution.get('Statistics', {})
+    message = {
+        'message': 'athena execution',
+        'id': execution['QueryExecutionId'],
+        'state': execution['Status']['State'],
+        'queue_ms': statistics.get('QueryQueueTimeInMillis'),
+        'engine_ms': statistics.get('EngineExecutionTimeInMillis'),
+        'total_ms': statistics.get('TotalExecutionTimeInMillis'),
+        'scanned': statistics.get('DataScannedInBytes')
+    }
+    if waited is not None:
+        message['wait_ms'] = int(waited * 1000)
+    print(json.dumps(message))
+
+
+class AthenaExecutor:
+    def __init__(self, client, result_configuration, database=None):
+        self.client = client
+        self.result_configuration = result_configuration
+        self.database = database
+        self.max_in_flight = int(os.environ.get('ATHENA_MAX_IN_FLIGHT') or 20)
+        self.min_interval = float(os.environ.get('ATHENA_POLL_MIN_INTERVAL') or 0.2)
+        self.max_interval = float(os.environ.get('ATHENA_POLL_MAX_INTERVAL') or 5)
+        self._condition = threading.Condition()
+        # [(query, request token, future, submitted at)] not started yet
+        self._queue = []
+        # execution id: (future, submitted at)
+        self._in_flight = {}
+        self._thread = None
+        # set by submit() / watch() while the poller isn't waiting
+        self._woken = False
+
+    def start(self, query, token=None):
+        """
+        Start the query, returns the execution id without waiting for it
+        """
+        args = {
+            'QueryString': query,
+            'ResultConfiguration': self.result_configuration
+        }
+        if self.database:
+            args['QueryExecutionContext'] = {'Database': self.database}
+        if token:
+            args['ClientRequestToken'] = token
+        return self.client.start_query_execution(**args)['QueryExecutionId']
+
+    def submit(self, query, token=None):
+        """
+        Future of the finished execution of the query
+        """
+        future = Future()
+        with self._condition:
+            self._queue.append((query, token, future, time.time()))
+            self._wake()
+        return future
+
+    def watch(self, execution_id):
+        """
+        Future of the finished execution of a started query
+        """
+        future = Future()
+        with self._condition:
+            self._in_flight[execution_id] = (future, time.time())
+            self._wake()
+        return future
+
+    def execute(self, query, token=None):
+        return self.submit(query, token).result()
+
+    def _wake(self):
+        # the poller exits when nothing is left, it's started again by the next query
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        self._woken = True
+        self._condition.notify()
+
+    def _start_queued(self, queued):
+        """
+        Start the queued queries (outside the lock), returns ([(execution id, future, submitted at)],
+        [(future, exception)], the queries that are not started)
+        """
+        started = []
+        failed = []
+        for i, (query, token, future, submitted_at) in enumerate(queued):
+            try:
+                execution_id = self.start(query, token)
+            except ClientError as e:
+                if e.response['Error']['Code'] == 'TooManyRequestsException':
+                    # the concurrent query limit of the account, started by the next poll
+                    return started, failed, queued[i:]
+                failed.append((future, e))
+                continue
+            except Exception as e:
+                failed.append((future, e))
+                continue
+            started.append((execution_id, future, submitted_at))
+        return started, failed, []
+
+    def _poll(self, ids):
+        """
+        Poll the executions (outside the lock), returns ({execution id: result}, {execution id: exception})
+        """
+        finished = {}
+        errors = {}
+        for i in range(0, len(ids), BATCH_SIZE):
+            response = self.client.batch_get_query_execution(QueryExecutionIds=ids[i:i + BATCH_SIZE])
+            for execution in response['QueryExecutions']:
+                if execution['Status']['State'] in FINISHED:
+                    finished[execution['QueryExecutionId']] = {'QueryExecution': execution}
+            for error in response.get('UnprocessedQueryExecutionIds', []):
+                if error.get('ErrorCode') == 'ThrottlingException':
+                    # polled again by the next round
+                    continue
+                errors[error['QueryExecutionId']] = Exception('Cannot get query execution: %s' % json.dumps(error))
+        return finished, errors
+
+    def _round(self):
+        """
+        One round of the poller: start the queued queries and poll the executions in flight.
+        The lock is held only to take and put back the state, the requests to Athena and the futures
+        (and their done callbacks) run without it, so submit() doesn't wait for them.
+        Returns the count of the started and finished executions, None when nothing is left.
+        """
+        with self._condition:
+            if not self._in_flight and not self._queue:
+                self._thread = None
+                return None
+            queued = self._queue[:max(self.max_in_flight - len(self._in_flight), 0)]
+            del self._queue[:len(queued)]
+            ids = list(self._in_flight.keys())
+
+        started, resolved, not_started = self._start_queued(queued)
+        try:
+            finished, errors = self._poll(ids)
+        except ClientError as e:
+            if e.response['Error']['Code'] in ['ThrottlingException', 'TooManyRequestsException']:
+                finished, errors = {}, {}
+            else:
+                # the futures polled are failed, so that the callers don't wait forever
+                finished, errors = {}, {x: e for x in ids}
+        except Exception as e:
+            finished, errors = {}, {x: e for x in ids}
+
+        results = []
+        with self._condition:
+            # the queries that are not started are the first of the queue again
+            self._queue[:0] = not_started
+            for execution_id, future, submitted_at in started:
+                self._in_flight[execution_id] = (future, submitted_at)
+            for execution_id, result in finished.items():
+                future, submitted_at = self._in_flight.pop(execution_id)
+                results.append((future, result, submitted_at))
+            for execution_id, e in errors.items():
+                future, _ = self._in_flight.pop(execution_id)
+                resolved.append((future, e))
+
+        for future, result, submitted_at in results:
+            record(result, time.time() - submitted_at)
+            future.set_result(result)
+        for future, e in resolved:
+            future.set_exception(e)
+        return len(started) + len(results) + len(resolved)
+
+    def _run(self):
+        interval = self.min_interval
+        while True:
+            changed = self._round()
+            if changed is None:
+                return
+            # short intervals while the executions start and finish, longer while they run
+            interval = self.min_interval if changed else min(interval * GROWTH, self.max_interval)
+            with self._condition:
+                # submit() wakes the poller to start the query at once, the poller exits at once when nothing is left
+                if not self._woken and (self._in_flight or self._queue):
+                    self._condition.wait(interval)
+                self._woken = False
@@ -0,0 +1,404 @@
+"""
+Per-org scheduler of the Athena queries, shared by admin_api and data_retriever
+
+The concurrent query limit of the account is shared by every org, so each org runs at most
+ATHENA_SCHEDULER_ORG_SLOTS (4) queries at once. The last ATHENA_SCHEDULER_INTERACTIVE_SLOTS (1) of them are kept
+for the interactive queries of admin_api, the batch queries of data_retriever wait for the others.
+
+- admin_api: submit() starts the query when the org has a free slot, otherwise the query is queued and
+  `queued-...` is the execution id. execution() polls the query, and starts the first queued query of the org
+  when a slot is free. An identical query in flight is shared (single-flight), and sweep() stops the queries
+  whose client stopped polling for ATHENA_SCHEDULER_ABANDON_SECONDS (60).
+- data_retriever: wait() takes a slot for a batch query, release() gives it back.
+
+The state is kept in OTM_ATHENA_SCHEDULER_DYNAMODB_TABLE (hash key `org`, range key `entry`):
+
+- slots: `running`, the number of the slots in use
+- pending#<uuid>: a slot taken by acquire() whose run# entry is not written yet, it's written with the slot
+  in one transaction and replaced by the run# entry in another, so sweep() can count the slots in use from the entries
+- run#<execution id>: a running query (or the slot of a batch query)
+- queue#<time>#<uuid>: a queued query, `execution_id` is set when it's started
+- hash#<query hash>: the execution id of the query in flight
+- stopped#<query hash>: `attempts`, the number of the executions of the query stopped by sweep(), it's added
+  to the request token so that the next start is not the stopped execution of the same token
+"""
+from botocore.exceptions import ClientError
+import boto3
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+
+INTERACTIVE = 'interactive'
+BATCH = 'batch'
+FINISHED = ['SUCCEEDED', 'FAILED', 'CANCELLED']
+QUEUED_PREFIX = 'queued-'
+
+_table = None
+
+
+def enabled():
+    return os.environ.get('ATHENA_SCHEDULER_ENABLED') == '1'
+
+
+def org_slots():
+    return int(os.environ.get('ATHENA_SCHEDULER_ORG_SLOTS') or 4)
+
+
+def interactive_slots():
+    return int(os.environ.get('ATHENA_SCHEDULER_INTERACTIVE_SLOTS') or 1)
+
+
+def abandon_seconds():
+    # the clients poll every second
+    return int(os.environ.get('ATHENA_SCHEDULER_ABANDON_SECONDS') or 60)
+
+
+def batch_lease_seconds():
+    # the slot of a batch query is given back after this time even if the job died
+    return int(os.environ.get('ATHENA_SCHEDULER_BATCH_LEASE_SECONDS') or 3600)
+
+
+def pending_seconds():
+    # a slot of acquire() is counted by sweep() until then without its run# entry, the query is started before it
+    return 300
+
+
+def expire_seconds():
+    # DynamoDB TTL of the items, the queued ids are resolved until then
+    return 86400
+
+
+def table():
+    global _table
+    if _table is None:
+        _table = boto3.resource('dynamodb').Table(str(os.environ.get('OTM_ATHENA_SCHEDULER_DYNAMODB_TABLE')))
+    return _table
+
+
+def query_hash(query):
+    return hashlib.sha1(re.sub(r'\s+', ' ', query).strip().encode('utf-8')).hexdigest()
+
+
+def _conditional(call, **kwargs):
+    # False when the condition of the request failed
+    try:
+        call(**kwargs)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+            return False
+        raise
+
+
+def _transact(actions):
+    # False when a condition of the transaction failed, a conflict with another transaction is tried again
+    # (the client of the resource takes the values as they are, like the table)
+    for attempt in range(5):
+        try:
+            table().meta.client.transact_write_items(TransactItems=actions)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] != 'TransactionCanceledException':
+                raise
+            if 'ConditionalCheckFailed' in [x.get('Code') for x in e.response.get('CancellationReasons', [])]:
+                return False
+            time.sleep(0.05 * (attempt + 1))
+    raise Exception('Cannot write the athena scheduler state')
+
+
+def _slots_update(org, value, condition=None, condition_values=None):
+    # the update of `running` in a transaction
+    update = {'TableName': table().name, 'Key': {'org': org, 'entry': 'slots'}, 'UpdateExpression': 'ADD running :value',
+              'ExpressionAttributeValues': dict({':value': value}, **(condition_values or {}))}
+    if condition:
+        update['ConditionExpression'] = condition
+    return {'Update': update}
+
+
+def _state(execution_id, state):
+    # the get_query_execution response of a query that is not started
+    return {'QueryExecution': {'QueryExecutionId': execution_id, 'Status': {'State': state}}}
+
+
+class AthenaScheduler:
+    def __init__(self, executor):
+        # athena_executor.AthenaExecutor that starts the queries
+        self.executor = executor
+
+    def acquire(self, org, priority):
+        """
+        Take a slot of the org, returns the pending entry of the slot for _add_run(), None when the slots are full
+        """
+        if priority == BATCH and self._first_queued(org):
+            # the queued interactive queries go first
+            return None
+        limit = org_slots() - (interactive_slots() if priority == BATCH else 0)
+        pending = 'pending#' + uuid.uuid4().hex
+        if not _transact([
+            _slots_update(org, 1, 'attribute_not_exists(running) OR running < :limit', {':limit': limit}),
+            {'Put': {'TableName': table().name,
+                     'Item': {'org': org, 'entry': pending, 'expires_at': int(time.time()) + pending_seconds()}}}
+        ]):
+            return None
+        return pending
+
+    def _add_run(self, org, execution_id, priority, pending, h=None):
+        now = int(time.time())
+        item = {'org': org, 'entry': 'run#' + execution_id, 'priority': priority, 'last_poll': now,
+                'expires_at': now + expire_seconds()}
+        if h:
+            item['query_hash'] = h
+        if not _transact([
+            {'Put': {'TableName': table().name, 'Item': item,
+                     'ConditionExpression': 'attribute_not_exists(entry)'}},
+            {'Delete': {'TableName': table().name, 'Key': {'org': org, 'entry': pending}}}
+        ]):
+            # the same execution was started by another request (the request token), one slot is enough
+            self._release_slot(org, pending)
+
+    def _release_slot(self, org, pending):
+        _transact([_slots_update(org, -1), {'Delete': {'TableName': table().name, 'Key': {'org': org, 'entry': pending}}}])
+
+    def release(self, org, execution_id):
+        """
+        Give back the slot of the execution, once
+        """
+        old = table().get_item(Key={'org': org, 'entry': 'run#' + execution_id}, ConsistentRead=True).get('Item')
+        if not old:
+            return
+        # the entry and the slot are given back together, sweep() never sees one without the other
+        if not _transact([
+            {'Delete': {'TableName': table().name, 'Key': {'org': org, 'entry': 'run#' + execution_id},
+                        'ConditionExpression': 'attribute_exists(entry)'}},
+            _slots_update(org, -1)
+        ]):
+            # given back by another request meanwhile
+            return
+        if old.get('query_hash'):
+            _conditional(table().delete_item, Key={'org': org, 'entry': 'hash#' + old['query_hash']},
+                         ConditionExpression='execution_id = :id', ExpressionAttributeValues={':id': execution_id})
+
+    def wait(self, org, interval=5):
+        """
+        Wait for a slot of a batch query, returns the id to release()
+        """
+        pending = self.acquire(org, BATCH)
+        while not pending:
+            time.sleep(interval)
+            pending = self.acquire(org, BATCH)
+        lease_id = 'batch-' + uuid.uuid4().hex
+        self._add_run(org, lease_id, BATCH, pending)
+        return lease_id
+
+    def submit(self, org, query, token=None, priority=INTERACTIVE):
+        """
+        Execution id of the query: the Athena execution id when it's started, `queued-...` when it waits for a slot
+        """
+        h = query_hash(query)
+        shared = table().get_item(Key={'org': org, 'entry': 'hash#' + h}).get('Item')
+        if shared:
+            self.touch(org, shared['execution_id'])
+            print(json.dumps({'message': 'athena scheduler shared', 'org': org, 'execution_id': shared['execution_id']}))
+            return shared['execution_id']
+        if token:
+            stopped = table().get_item(Key={'org': org, 'entry': 'stopped#' + h}).get('Item')
+            if stopped:
+                # Athena returns the stopped execution for the same token
+                token = '%s_%d' % (token, int(stopped['attempts']))
+
+        now = int(time.time())
+        pending = None if self._first_queued(org) else self.acquire(org, priority)
+        if pending:
+            execution_id = self._start(org, query, token, priority, pending, h)
+        else:
+            execution_id = QUEUED_PREFIX + '%013d-%s' % (int(time.time() * 1000), uuid.uuid4().hex)
+            table().put_item(Item={'org': org, 'entry': self._queue_id(execution_id), 'query': query, 'token': token,
+                                   'priority': priority, 'query_hash': h, 'last_poll': now,
+                                   'expires_at': now + expire_seconds()})
+            print(json.dumps({'message': 'athena scheduler queued', 'org': org, 'execution_id': execution_id}))
+        table().put_item(Item={'org': org, 'entry': 'hash#' + h, 'execution_id': execution_id,
+                               'expires_at': now + expire_seconds()})
+        return execution_id
+
+    def _start(self, org, query, token, priority, pending, h):
+        try:
+            execution_id = self.executor.start(query, token)
+        except Exception:
+            self._release_slot(org, pending)
+            raise
+        self._add_run(org, execution_id, priority, pending, h)
+        return execution_id
+
+    def _queue_id(self, queued_id):
+        return 'queue#' + queued_id[len(QUEUED_PREFIX):].replace('-', '#')
+
+    def _first_queued(self, org):
+        # the queued queries that are not started, in the order of submit()
+        args = {
+            'KeyConditionExpression': 'org = :org AND begins_with(entry, :queue)',
+            'FilterExpression': 'attribute_not_exists(execution_id)',
+            'ExpressionAttributeValues': {':org': org, ':queue': 'queue#'}
+        }
+        while True:
+            items = table().query(**args)
+            if items['Items']:
+                return items['Items'][0]
+            if 'LastEvaluatedKey' not in items:
+                return None
+            args['ExclusiveStartKey'] = items['LastEvaluatedKey']
+
+    def _dispatch(self, org, queued_id, item):
+        """
+        Start the queued query when it's the first one and the org has a free slot, returns the execution id or None
+        """
+        first = self._first_queued(org)
+        if not first or first['entry'] != item['entry']:
+            return None
+        pending = self.acquire(org, item['priority'])
+        if not pending:
+            return None
+        execution_id = self._start(org, item['query'], item.get('token'), item['priority'], pending,
+                                   item['query_hash'])
+        table().update_item(Key={'org': org, 'entry': item['entry']}, UpdateExpression='SET execution_id = :id',
+                            ExpressionAttributeValues={':id': execution_id})
+        _conditional(table().update_item, Key={'org': org, 'entry': 'hash#' + item['query_hash']},
+                     UpdateExpression='SET execution_id = :id', ConditionExpression='execution_id = :queued',
+                     ExpressionAttributeValues={':id': execution_id, ':queued': queued_id})
+        print(json.dumps({'message': 'athena scheduler started', 'org': org, 'queued_id': queued_id,
+                          'execution_id': execution_id}))
+        return execution_id
+
+    def touch(self, org, execution_id):
+        # the client is polling the execution
+        key = self._queue_id(execution_id) if execution_id.startswith(QUEUED_PREFIX) else 'run#' + execution_id
+        _conditional(table().update_item, Key={'org': org, 'entry': key}, UpdateExpression='SET last_poll = :now',
+                     ConditionExpression='attribute_exists(entry)', ExpressionAttributeValues={':now': int(time.time())})
+
+    def execution(self, org, execution_id):
+        """
+        get_query_execution of the execution id of submit(), the slot is given back when the query is finished
+        """
+        if execution_id.startswith(QUEUED_PREFIX):
+            item = table().get_item(Key={'org': org, 'entry': self._queue_id(execution_id)}).get('Item')
+            if not item:
+                # stopped by sweep() or expired
+                return _state(execution_id, 'CANCELLED')
+            if 'execution_id' in item:
+                execution_id = item['execution_id']
+            else:
+                self.touch(org, execution_id)
+                started = self._dispatch(org, execution_id, item)
+                if not started:
+                    return _state(execution_id, 'QUEUED')
+                execution_id = started
+
+        result = self.executor.client.get_query_execution(QueryExecutionId=execution_id)
+        if result['QueryExecution']['Status']['State'] in FINISHED:
+            self.release(org, execution_id)
+        else:
+            self.touch(org, execution_id)
+        return result
+
+    def _stopped(self, org, h):
+        # a new request token for the next start of the query
+        table().update_item(Key={'org': org, 'entry': 'stopped#' + h},
+                            UpdateExpression='ADD attempts :one SET expires_at = :expires_at',
+                            ExpressionAttributeValues={':one': 1, ':expires_at': int(time.time()) + expire_seconds()})
+
+    def sweep(self):
+        """
+        Stop the abandoned queries, give back the slots of the finished queries that are not polled,
+        and recount the slots in use of each org
+        """
+        now = int(time.time())
+        orgs = set()
+        runs = []
+        queued = []
+        args = {'FilterExpression': 'entry = :slots OR begins_with(entry, :run) OR begins_with(entry, :queue)',
+                'ExpressionAttributeValues': {':slots': 'slots', ':run': 'run#', ':queue': 'queue#'}}
+        while True:
+            items = table().scan(**args)
+            for item in items['Items']:
+                if item['entry'] == 'slots':
+                    orgs.add(item['org'])
+                elif item['entry'].startswith('run#'):
+                    runs.append(item)
+                elif 'execution_id' not in item:
+                    queued.append(item)
+            if 'LastEvaluatedKey' not in items:
+                break
+            args['ExclusiveStartKey'] = items['LastEvaluatedKey']
+
+        stopped = []
+        released = []
+        interactive = [x for x in runs if x['priority'] == INTERACTIVE]
+        for i in range(0, len(interactive), 50):
+            batch = {x['entry'][len('run#'):]: x for x in interactive[i:i + 50]}
+            response = self.executor.client.batch_get_query_execution(QueryExecutionIds=list(batch.keys()))
+            for execution in response['QueryExecutions']:
+                execution_id = execution['QueryExecutionId']
+                item = batch[execution_id]
+                if execution['Status']['State'] not in FINISHED:
+                    if item['last_poll'] >= now - abandon_seconds():
+                        continue
+                    self.executor.client.stop_query_execution(QueryExecutionId=execution_id)
+                    if item.get('query_hash'):
+                        self._stopped(item['org'], item['query_hash'])
+                    stopped.append(execution_id)
+                self.release(item['org'], execution_id)
+                released.append(execution_id)
+        for item in runs:
+            if item['priority'] == BATCH and item['last_poll'] < now - batch_lease_seconds():
+                self.release(item['org'], item['entry'][len('run#'):])
+                released.append(item['entry'][len('run#'):])
+        for item in queued:
+            if item['last_poll'] >= now - abandon_seconds():
+                continue
+            table().delete_item(Key={'org': item['org'], 'entry': item['entry']})
+            queued_id = QUEUED_PREFIX + item['entry'][len('queue#'):].replace('#', '-')
+            _conditional(table().delete_item, Key={'org': item['org'], 'entry': 'hash#' + item['query_hash']},
+                         ConditionExpression='execution_id = :id', ExpressionAttributeValues={':id': queued_id})
+            stopped.append(queued_id)
+
+        recounted = {org: running for org, running in ((x, self._recount(x, now)) for x in orgs) if running is not None}
+        print(json.dumps({'message': 'athena scheduler sweep', 'stopped': stopped, 'released': released,
+                          'recounted': recounted}))
+
+    def _count(self, org, prefix, now):
+        # the entries of the prefix that are not expired, the expired entries are not deleted by TTL at once
+        args = {
+            'KeyConditionExpression': 'org = :org AND begins_with(entry, :prefix)',
+            'ExpressionAttributeValues': {':org': org, ':prefix': prefix},
+            'ConsistentRead': True
+        }
+        count = 0
+        while True:
+            items = table().query(**args)
+            count += len([x for x in items['Items'] if x.get('expires_at', now) >= now])
+            if 'LastEvaluatedKey' not in items:
+                return count
+            args['ExclusiveStartKey'] = items['LastEvaluatedKey']
+
+    def _recount(self, org, now):
+        """
+        Set `running` of the org to the number of its run# and pending# entries, the slots leak when a request dies
+        between acquire() and _add_run() (its pending# entry expires), a release fails or a run# entry expires.
+        A slot and its entry are always written in one transaction, so the count is the slots in use.
+        Returns the new count or None.
+        """
+        item = table().get_item(Key={'org': org, 'entry': 'slots'}, ConsistentRead=True).get('Item')
+        if not item:
+            return None
+        count = self._count(org, 'run#', now) + self._count(org, 'pending#', now)
+        running = int(item.get('running', 0))
+        if running == count:
+            return None
+        # not set when a slot was taken or given back meanwhile
+        if not _conditional(table().update_item, Key={'org': org, 'entry': 'slots'}, UpdateExpression='SET running = :count',
+                            ConditionExpression='running = :running',
+                            ExpressionAttributeValues={':count': count, ':running': running}):
+            return None
+        return count
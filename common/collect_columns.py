@@ -0,0 +1,116 @@
+"""
+Query string keys that are promoted to the top-level columns of the formatted collect log.
+
+This module is shared by log_formatter (writer side) and admin_api / data_retriever (query side).
+"""
+import math
+import os
+
+try:
+    from . import urlnorm
+except ImportError:
+    # data_retriever imports the shared modules as top-level modules
+    import urlnorm
+
+# promoted query string keys
+STRING_COLUMNS = ['o_s', 'dl', 'o_pl', 'cid', 'o_psid', 'el', 'dt']
+NUMBER_COLUMNS = ['o_e_y', 'plt']
+
+# derived columns
+# - norm_dl / norm_o_pl: normalized URL (scheme://netloc/path by default, see urlnorm) of dl / o_pl
+# - o_s_kind: event kind of o_s (pageview, scroll, click_widget, click_trivial)
+DERIVED_COLUMNS = ['norm_dl', 'norm_o_pl', 'o_s_kind']
+
+# `o_s` prefix, same as `LIKE 'prefix_%'`
+EVENT_KIND_PREFIXES = [
+    ('scroll', 'scroll'),
+    ('click_widget', 'click_widget'),
+    ('click_trivial', 'click_trivial')
+]
+
+# expressions to read the value from `qs` for the log that is formatted before promotion
+FALLBACK_EXPRESSIONS = {
+    'o_s': "JSON_EXTRACT_SCALAR(qs, '$.o_s')",
+    'dl': "JSON_EXTRACT_SCALAR(qs, '$.dl')",
+    'o_pl': "JSON_EXTRACT_SCALAR(qs, '$.o_pl')",
+    'cid': "JSON_EXTRACT_SCALAR(qs, '$.cid')",
+    'o_psid': "JSON_EXTRACT_SCALAR(qs, '$.o_psid')",
+    'el': "JSON_EXTRACT_SCALAR(qs, '$.el')",
+    'dt': "JSON_EXTRACT_SCALAR(qs, '$.dt')",
+    'o_e_y': "TRY_CAST(JSON_EXTRACT_SCALAR(qs, '$.o_e_y') AS double)",
+    'plt': "TRY_CAST(JSON_EXTRACT_SCALAR(qs, '$.plt') AS double)",
+    'norm_dl': "regexp_extract(JSON_EXTRACT_SCALAR(qs, '$.dl'), '^[^?#]*')",
+    'norm_o_pl': "regexp_extract(JSON_EXTRACT_SCALAR(qs, '$.o_pl'), '^[^?#]*')",
+    'o_s_kind': """(CASE
+WHEN JSON_EXTRACT_SCALAR(qs, '$.o_s') = 'pageview' THEN 'pageview'
+WHEN JSON_EXTRACT_SCALAR(qs, '$.o_s') LIKE 'scroll_%' THEN 'scroll'
+WHEN JSON_EXTRACT_SCALAR(qs, '$.o_s') LIKE 'click_widget_%' THEN 'click_widget'
+WHEN JSON_EXTRACT_SCALAR(qs, '$.o_s') LIKE 'click_trivial_%' THEN 'click_trivial'
+END)"""
+}
+
+
+def use_fallback():
+    # The fallback reads `qs` for the data that doesn't have promoted columns.
+    # Disable it (STATS_ATHENA_QS_FALLBACK=0) when all the partitions in the query range have them,
+    # then Athena doesn't need to read and parse `qs` column.
+    return os.environ.get('STATS_ATHENA_QS_FALLBACK') != '0'
+
+
+def column(name):
+    """
+    SQL expression of the promoted column
+    """
+    if use_fallback():
+        return 'COALESCE({0}, {1})'.format(name, FALLBACK_EXPRESSIONS[name])
+    return name
+
+
+def columns():
+    """
+    SQL expressions of all promoted columns, for `str.format(**columns())`
+    """
+    return {name: column(name) for name in STRING_COLUMNS + NUMBER_COLUMNS + DERIVED_COLUMNS}
+
+
+def normalize_url(url):
+    return urlnorm.normalize_url(url)
+
+
+def event_kind(state):
+    if not state:
+        return None
+    if state == 'pageview':
+        return 'pageview'
+    for prefix, kind in EVENT_KIND_PREFIXES:
+        # `LIKE 'prefix_%'` requires at least one character after the prefix
+        if len(state) > len(prefix) and state.startswith(prefix):
+            return kind
+    return None
+
+
+def to_number(value):
+    if value is None or value == '':
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    if not math.isfinite(number):
+        return None
+    return number
+
+
+def promote(qs):
+    """
+    Make promoted columns from the parsed query string (dict)
+    """
+    result = {}
+    for name in STRING_COLUMNS:
+        result[name] = qs.get(name)
+    for name in NUMBER_COLUMNS:
+        result[name] = to_number(qs.get(name))
+    result['norm_dl'] = normalize_url(qs.get('dl'))
+    result['norm_o_pl'] = normalize_url(qs.get('o_pl'))
+    result['o_s_kind'] = event_kind(qs.get('o_s'))
+    return result
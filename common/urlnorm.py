@@ -0,0 +1,105 @@
+"""
+Canonical form of the URLs of the collect log
+
+This module is shared by log_formatter (norm_dl / norm_o_pl at ingest) and admin_api (merge of the stats results).
+
+OTM_URL_NORMALIZE_RULES is a comma separated list of the rules, default is `strip_query`:
+
+- strip_query: drop the parameters and the query string (the fragment is always dropped)
+- strip_trailing_slash: drop the trailing '/' of the path ('/' is kept for the root)
+- lower_host: case-fold the scheme and the host
+
+The canonical form of each distinct value is cached, so a column of repeated URLs is parsed once per URL.
+"""
+from urllib.parse import urlparse
+import os
+
+RULES = ['strip_query', 'strip_trailing_slash', 'lower_host']
+DEFAULT_RULES = ['strip_query']
+# the cache is cleared when it is full, the formatter sees an unbounded number of URLs
+CACHE_SIZE = 100000
+
+
+class UrlNormalizer:
+    def __init__(self, rules=None, cache_size=CACHE_SIZE):
+        rules = DEFAULT_RULES if rules is None else rules
+        unknown = [x for x in rules if x not in RULES]
+        if unknown:
+            raise Exception('Unknown URL normalize rules: %s' % ', '.join(unknown))
+        self.strip_query = 'strip_query' in rules
+        self.strip_trailing_slash = 'strip_trailing_slash' in rules
+        self.lower_host = 'lower_host' in rules
+        self.cache_size = cache_size
+        self._cache = {}
+
+    def canonical(self, url):
+        """
+        canonical form of the URL without the cache
+        """
+        if not isinstance(url, str) or not url:
+            return None
+        if url.lower() == 'undefined':
+            return url
+
+        parsed = urlparse(url)
+        scheme = parsed.scheme
+        netloc = parsed.netloc
+        path = parsed.path
+        if self.lower_host:
+            scheme = scheme.lower()
+            netloc = netloc.lower()
+        if self.strip_trailing_slash:
+            path = path.rstrip('/') or '/'
+        if not self.strip_query:
+            if parsed.params:
+                path += ';' + parsed.params
+            if parsed.query:
+                path += '?' + parsed.query
+        return '{0}://{1}{2}'.format(scheme, netloc, path)
+
+    def normalize(self, url):
+        try:
+            return self._cache[url]
+        except (KeyError, TypeError):
+            pass
+        value = self.canonical(url)
+        if isinstance(url, str):
+            if len(self._cache) >= self.cache_size:
+                self._cache.clear()
+            self._cache[url] = value
+        return value
+
+    def normalize_column(self, values):
+        """
+        canonical form of pandas Series, NaN is kept as it is
+        """
+        uniques = values.dropna().unique()
+        return values.map({x: self.normalize(x) for x in uniques})
+
+
+def rules_from_env():
+    value = os.environ.get('OTM_URL_NORMALIZE_RULES')
+    if not value:
+        return DEFAULT_RULES
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+_default = None
+
+
+def default():
+    """
+    normalizer of the rules of OTM_URL_NORMALIZE_RULES
+    """
+    global _default
+    if _default is None:
+        _default = UrlNormalizer(rules_from_env())
+    return _default
+
+
+def normalize_url(url):
+    return default().normalize(url)
+
+
+def normalize_column(values):
+    return default().normalize_column(values)
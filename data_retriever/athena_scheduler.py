@@ -0,0 +1 @@
+../common/athena_scheduler.py
\ No newline at end of file
@@ -0,0 +1 @@
+../common/collect_columns.py
\ No newline at end of file
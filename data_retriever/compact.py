@@ -0,0 +1,274 @@
+from retriever_base import RetrieverBase
+from botocore.exceptions import ClientError
+from datetime import datetime, timedelta
+import gzip
+import io
+import json
+import os
+import time
+
+# S3 multipart upload requires at least 5MB for every part except the last one
+PART_SIZE = 8 * 1024 * 1024
+DEFAULT_TARGET_SIZE = 128 * 1024 * 1024
+# S3 DeleteObjects accepts up to 1000 keys
+DELETE_BATCH_SIZE = 1000
+COMPACTED_PREFIX = 'compacted-'
+# Athena ignores the objects whose name starts with '_'
+STAGING_PREFIX = '_'
+# sources and outputs of the swap in progress of a partition
+MANIFEST_NAME = '_compaction_manifest.json'
+# staged files older than this without a manifest are left by a run that died
+ORPHAN_SECONDS = 86400
+
+# the formatted log has no trailing newline, so a newline is put between the concatenated files
+GZIP_SEPARATOR = gzip.compress(b'\n')
+
+
+class Compaction(RetrieverBase):
+    """
+    Merge the small formatted log files of a closed day into files of about `target_size` bytes.
+
+    New files are written with a hidden name (`_compacted-...`), then the manifest of the swap
+    (`_compaction_manifest.json`: the source keys and the staged / visible keys) is written, the staged files are
+    renamed (copied) to the visible name, the source and staged files are deleted, and the manifest is deleted last.
+    Every step can be run again, so a manifest that is left by a crash or a failed delete is finished (rolled forward)
+    before the partition is compacted again. Staged files without a manifest are removed.
+    The swap is not atomic: a query that runs between the copies and the delete reads the records twice.
+    """
+
+    def __init__(self, **kwargs):
+        super(Compaction, self).__init__(**kwargs)
+        if self.options['date']:
+            self.date = datetime.strptime(self.options['date'], '%Y-%m-%d')
+        else:
+            # CloudFront delivers the log of a day until the next day
+            self.date = datetime.today() - timedelta(days=int(self.options['days_ago']))
+        self.client = self.s3.meta.client
+        self.bucket = self.options['collect_log_bucket']
+        self.target_size = int(self.options['target_size'])
+        self.stats = {'partitions': 0, 'compacted_partitions': 0, 'files_in': 0, 'bytes_in': 0, 'files_out': 0,
+                      'bytes_out': 0}
+
+    def execute(self):
+        started_at = time.time()
+        for partition in self.partitions():
+            self.stats['partitions'] += 1
+            self.compact_partition(partition)
+
+        print(json.dumps(dict({
+            'message': 'compaction',
+            'date': self.date.strftime('%Y-%m-%d'),
+            'elapsed': round(time.time() - started_at, 3)
+        }, **self.stats)))
+
+    def _sub_prefixes(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            for common_prefix in page.get('CommonPrefixes', []):
+                yield common_prefix['Prefix']
+
+    def partitions(self):
+        # org=xxx/tid=xxx/ are listed by delimiter, the day is appended, so the other days are not listed
+        day = self.date.strftime('year=%Y/month=%-m/day=%-d/')
+        for org_prefix in self._sub_prefixes(self.options['collect_log_prefix']):
+            for tid_prefix in self._sub_prefixes(org_prefix):
+                yield tid_prefix + day
+
+    def compact_partition(self, partition):
+        self.finish_pending(partition)
+
+        objects = []
+        orphans = []
+        for obj in self.s3.Bucket(self.bucket).objects.filter(Prefix=partition):
+            name = obj.key[len(partition):]
+            if '/' in name or not name.endswith(self.options['extension']):
+                continue
+            if name.startswith(STAGING_PREFIX):
+                # staged by a run that died before the manifest
+                if obj.last_modified.timestamp() < time.time() - ORPHAN_SECONDS:
+                    orphans.append(obj.key)
+                continue
+            objects.append({'key': obj.key, 'size': obj.size})
+        if orphans:
+            self.delete(orphans)
+
+        small = [x for x in objects if x['size'] < self.target_size // 2]
+        if len(small) < 2:
+            return
+
+        compacted_at = int(time.time())
+        outputs = []
+        for index, group in enumerate(self.group(small)):
+            name = '%s%d-%d%s' % (COMPACTED_PREFIX, compacted_at, index, self.options['extension'])
+            staging_key = partition + STAGING_PREFIX + name
+            if self.options['collect_format'] == 'parquet':
+                size = self.write_parquet(group, staging_key)
+            else:
+                size = self.write_gzip(group, staging_key)
+            outputs.append((staging_key, partition + name))
+            self.stats['files_in'] += len(group)
+            self.stats['bytes_in'] += sum(x['size'] for x in group)
+            self.stats['files_out'] += 1
+            self.stats['bytes_out'] += size
+
+        manifest = {'sources': [x['key'] for x in small], 'outputs': outputs}
+        self.client.put_object(Bucket=self.bucket, Key=partition + MANIFEST_NAME, Body=json.dumps(manifest),
+                               ContentType='application/json')
+        self.swap(partition, manifest)
+
+        self.stats['compacted_partitions'] += 1
+        print(json.dumps({'message': 'compact partition', 'partition': partition, 'files_in': len(small),
+                          'files_out': len(outputs)}))
+
+    def finish_pending(self, partition):
+        # the swap of the previous run that didn't finish
+        try:
+            body = self.client.get_object(Bucket=self.bucket, Key=partition + MANIFEST_NAME)['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            return
+        print(json.dumps({'message': 'finish compaction', 'partition': partition}))
+        self.swap(partition, json.loads(body))
+
+    def swap(self, partition, manifest):
+        """
+        The staged files of the manifest become visible and the sources are removed, it can be run again
+        """
+        for staging_key, key in manifest['outputs']:
+            try:
+                self.client.copy({'Bucket': self.bucket, 'Key': staging_key}, self.bucket, key)
+            except ClientError as e:
+                # the staged file is deleted only after all the copies
+                if e.response['Error']['Code'] not in ['404', 'NoSuchKey']:
+                    raise
+                self.client.head_object(Bucket=self.bucket, Key=key)
+        # an output can have the name of a source that was compacted in the same second
+        keys = set(key for _, key in manifest['outputs'])
+        self.delete([x for x in manifest['sources'] if x not in keys] +
+                    [staging_key for staging_key, _ in manifest['outputs']])
+        self.client.delete_object(Bucket=self.bucket, Key=partition + MANIFEST_NAME)
+
+    def delete(self, keys):
+        # the keys that don't exist are not errors of DeleteObjects
+        for i in range(0, len(keys), DELETE_BATCH_SIZE):
+            response = self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [{'Key': key} for key in keys[i:i + DELETE_BATCH_SIZE]],
+                'Quiet': True
+            })
+            if response.get('Errors'):
+                raise Exception('Cannot delete compacted files: %s' % json.dumps(response['Errors']))
+
+    def group(self, objects):
+        # first fit by the order of the key (= delivery time)
+        group = []
+        size = 0
+        for obj in sorted(objects, key=lambda x: x['key']):
+            if group and size + obj['size'] > self.target_size:
+                yield group
+                group = []
+                size = 0
+            group.append(obj)
+            size += obj['size']
+        if group:
+            yield group
+
+    def write_gzip(self, group, key):
+        # gzip members can be concatenated as they are
+        with MultipartUpload(self.client, self.bucket, key) as upload:
+            for index, obj in enumerate(group):
+                if index:
+                    upload.write(GZIP_SEPARATOR)
+                upload.write(self.client.get_object(Bucket=self.bucket, Key=obj['key'])['Body'].read())
+        return upload.size
+
+    def write_parquet(self, group, key):
+        # parquet files can't be concatenated, the row groups are rewritten into one file
+        import pyarrow.parquet as pq
+
+        with MultipartUpload(self.client, self.bucket, key) as upload:
+            writer = None
+            for obj in group:
+                body = self.client.get_object(Bucket=self.bucket, Key=obj['key'])['Body'].read()
+                table = pq.read_table(io.BytesIO(body))
+                if writer is None:
+                    # INT96 timestamp is used for the compatibility with Athena (Hive), same as log_formatter
+                    writer = pq.ParquetWriter(upload, table.schema, compression='snappy',
+                                              use_deprecated_int96_timestamps=True)
+                writer.write_table(table)
+            writer.close()
+        return upload.size
+
+
+class MultipartUpload:
+    """
+    Writable file object of an S3 object, the written bytes are uploaded by parts of PART_SIZE bytes.
+    The upload is completed at the end of the `with` block, or aborted by an exception.
+    """
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.upload_id = None
+        self.parts = []
+        self.buffer = bytearray()
+        self.size = 0
+        self.closed = False
+
+    def __enter__(self):
+        self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.closed = True
+        if exc_type is not None:
+            self._abort()
+            return
+        try:
+            if self.buffer or not self.parts:
+                self._upload_part()
+            self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                  MultipartUpload={'Parts': self.parts})
+        except Exception:
+            self._abort()
+            raise
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        if len(self.buffer) >= PART_SIZE:
+            self._upload_part()
+        return len(data)
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        pass
+
+    def _upload_part(self):
+        number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=bytes(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+        self.buffer = bytearray()
+
+    def _abort(self):
+        self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
+def main():
+    collect_format = os.environ.get('OTM_COLLECT_FORMAT') or 'json'
+    compaction = Compaction(
+        collect_log_bucket=os.environ.get('OTM_COLLECT_LOG_BUCKET'),
+        collect_log_prefix=os.environ.get('OTM_COLLECT_LOG_PREFIX') or 'formatted/',
+        collect_format=collect_format,
+        extension='.parquet' if collect_format == 'parquet' else '.gz',
+        target_size=os.environ.get('OTM_COMPACT_TARGET_SIZE') or DEFAULT_TARGET_SIZE,
+        days_ago=os.environ.get('OTM_COMPACT_DAYS_AGO') or 2,
+        date=os.environ.get('DATE')
+    )
+    compaction.execute()
+
+
+if __name__ == '__main__':
+    main()
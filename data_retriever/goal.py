@@ -1,4 +1,5 @@
 from retriever_base import RetrieverBase
+from collect_columns import columns
 from datetime import datetime, timedelta
 from botocore.errorfactory import ClientError
 import json
@@ -39,6 +40,7 @@ class GoalDataRetriever(RetrieverBase):
             self.scan_table(items['LastEvaluatedKey'])
 
     def execute_result_yesterday(self, org, tid, g):
+        c = columns()
         q = ''
         q += "org = '{0}'".format(org)
         q += " AND tid = '{0}'".format(tid)
@@ -47,45 +49,45 @@ class GoalDataRetriever(RetrieverBase):
         q += ' AND day = {0}'.format(self.yesterday.day)
 
         if g['target_match'] == 'prefix':
-            q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.o_s'), '^{0}')".format(
-                re.sub(r'\'', '\'\'', re.escape(g['target'])))
+            q += " AND regexp_like({o_s}, '^{0}')".format(
+                re.sub(r'\'', '\'\'', re.escape(g['target'])), **c)
         elif g['target_match'] == 'regex':
-            q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.o_s'), '{0}')".format(re.sub(r'\'', '\'\'', g['target']))
+            q += " AND regexp_like({o_s}, '{0}')".format(re.sub(r'\'', '\'\'', g['target']), **c)
         else:
             # eq
-            q += " AND JSON_EXTRACT_SCALAR(qs, '$.o_s') = '{0}'".format(re.sub(r'\'', '\'\'', g['target']))
+            q += " AND {o_s} = '{0}'".format(re.sub(r'\'', '\'\'', g['target']), **c)
 
         if 'path' in g and g['path']:
             if g['path_match'] == 'prefix':
-                q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.dl'), '^https?://[^/]+{0}')".format(
-                    re.sub(r'\'', '\'\'', re.escape(g['path'])))
+                q += " AND regexp_like({dl}, '^https?://[^/]+{0}')".format(
+                    re.sub(r'\'', '\'\'', re.escape(g['path'])), **c)
             elif g['target_match'] == 'regex':
-                q += " AND regexp_like(regexp_replace(JSON_EXTRACT_SCALAR(qs, '$.dl'), '^https?://[^/]+', ''), '{0}')".format(
-                    re.sub(r'\'', '\'\'', g['path']))
+                q += " AND regexp_like(regexp_replace({dl}, '^https?://[^/]+', ''), '{0}')".format(
+                    re.sub(r'\'', '\'\'', g['path']), **c)
             else:
                 # eq
-                q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.dl'), '^https?://[^/]+{0}$')".format(
-                    re.sub(r'\'', '\'\'', re.escape(g['path'])))
+                q += " AND regexp_like({dl}, '^https?://[^/]+{0}$')".format(
+                    re.sub(r'\'', '\'\'', re.escape(g['path'])), **c)
 
         if 'label' in g and g['label']:
             if g['label_match'] == 'prefix':
-                q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.el'), '^{0}')".format(
-                    re.sub(r'\'', '\'\'', re.escape(g['label'])))
+                q += " AND regexp_like({el}, '^{0}')".format(
+                    re.sub(r'\'', '\'\'', re.escape(g['label'])), **c)
             elif g['target_match'] == 'regex':
-                q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.el'), '{0}')".format(
-                    re.sub(r'\'', '\'\'', g['label']))
+                q += " AND regexp_like({el}, '{0}')".format(
+                    re.sub(r'\'', '\'\'', g['label']), **c)
             else:
                 # eq
-                q += " AND JSON_EXTRACT_SCALAR(qs, '$.el') = '{0}'".format(re.sub(r'\'', '\'\'', g['label']))
+                q += " AND {el} = '{0}'".format(re.sub(r'\'', '\'\'', g['label']), **c)
 
         sql = """SELECT 
 COUNT(qs) as e_count,
-COUNT(DISTINCT JSON_EXTRACT_SCALAR(qs, '$.cid')) as u_count
+{3} as u_count
 FROM {0}.{1}
 WHERE {2}
-""".format(self.options['athena_database'], self.options['athena_table'], q)
+""".format(self.options['athena_database'], self.options['athena_table'], q, self.distinct_users(c), **c)
 
-        result = self._execute_athena_query(sql)
+        result = self._execute_athena_query(sql, org)
         if result['QueryExecution']['Status']['State'] != 'SUCCEEDED':
             print(result)
             return False
@@ -99,6 +101,8 @@ WHERE {2}
         e_count = int(pd_data.iloc[0]['e_count'])
         u_count = int(pd_data.iloc[0]['u_count'])
         r_data = {'date': self.yesterday.strftime('%Y-%m-%d'), 'e_count': e_count, 'u_count': u_count}
+        if self.options.get('approx'):
+            r_data['approx'] = self.approx_meta()
 
         grp_prefix = ''
         if not org == 'root':
@@ -133,8 +137,10 @@ def main():
         athena_result_prefix=os.environ.get('STATS_ATHENA_RESULT_PREFIX') or '',
         athena_database=os.environ.get('STATS_ATHENA_DATABASE'),
         athena_table=os.environ.get('STATS_ATHENA_TABLE'),
+        partition_mode=os.environ.get('OTM_PARTITION_MODE') or 'msck',
         container_table=os.environ.get('OTM_CONTAINER_DYNAMODB_TABLE'),
-        date=os.environ.get('DATE')
+        date=os.environ.get('DATE'),
+        approx=os.environ.get('OTM_GOAL_APPROX') == '1'
     )
     retriever.execute()
 
@@ -1,4 +1,5 @@
 from retriever_base import RetrieverBase
+from collect_columns import columns
 from botocore.errorfactory import ClientError
 import json
 import os
@@ -31,6 +32,7 @@ class GoalTermDataRetriever(RetrieverBase):
         return
 
     def execute_query(self, org, tid, g):
+        c = columns()
         q = ''
         q += "org = '{0}'".format(org)
         q += " AND tid = '{0}'".format(tid)
@@ -38,47 +40,47 @@ class GoalTermDataRetriever(RetrieverBase):
         q += ' AND  year * 10000 + month * 100 + day <= {0}'.format(self.options['enddate'])
 
         if g['target_match'] == 'prefix':
-            q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.o_s'), '^{0}')".format(
-                re.sub(r'\'', '\'\'', re.escape(g['target'])))
+            q += " AND regexp_like({o_s}, '^{0}')".format(
+                re.sub(r'\'', '\'\'', re.escape(g['target'])), **c)
         elif g['target_match'] == 'regex':
-            q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.o_s'), '{0}')".format(re.sub(r'\'', '\'\'', g['target']))
+            q += " AND regexp_like({o_s}, '{0}')".format(re.sub(r'\'', '\'\'', g['target']), **c)
         else:
             # eq
-            q += " AND JSON_EXTRACT_SCALAR(qs, '$.o_s') = '{0}'".format(re.sub(r'\'', '\'\'', g['target']))
+            q += " AND {o_s} = '{0}'".format(re.sub(r'\'', '\'\'', g['target']), **c)
 
         if 'path' in g and g['path']:
             if g['path_match'] == 'prefix':
-                q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.dl'), '^https?://[^/]+{0}')".format(
-                    re.sub(r'\'', '\'\'', re.escape(g['path'])))
+                q += " AND regexp_like({dl}, '^https?://[^/]+{0}')".format(
+                    re.sub(r'\'', '\'\'', re.escape(g['path'])), **c)
             elif g['target_match'] == 'regex':
-                q += " AND regexp_like(regexp_replace(JSON_EXTRACT_SCALAR(qs, '$.dl'), '^https?://[^/]+', ''), '{0}')".format(
-                    re.sub(r'\'', '\'\'', g['path']))
+                q += " AND regexp_like(regexp_replace({dl}, '^https?://[^/]+', ''), '{0}')".format(
+                    re.sub(r'\'', '\'\'', g['path']), **c)
             else:
                 # eq
-                q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.dl'), '^https?://[^/]+{0}$')".format(
-                    re.sub(r'\'', '\'\'', re.escape(g['path'])))
+                q += " AND regexp_like({dl}, '^https?://[^/]+{0}$')".format(
+                    re.sub(r'\'', '\'\'', re.escape(g['path'])), **c)
 
         if 'label' in g and g['label']:
             if g['label_match'] == 'prefix':
-                q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.el'), '^{0}')".format(
-                    re.sub(r'\'', '\'\'', re.escape(g['label'])))
+                q += " AND regexp_like({el}, '^{0}')".format(
+                    re.sub(r'\'', '\'\'', re.escape(g['label'])), **c)
             elif g['target_match'] == 'regex':
-                q += " AND regexp_like(JSON_EXTRACT_SCALAR(qs, '$.el'), '{0}')".format(
-                    re.sub(r'\'', '\'\'', g['label']))
+                q += " AND regexp_like({el}, '{0}')".format(
+                    re.sub(r'\'', '\'\'', g['label']), **c)
             else:
                 # eq
-                q += " AND JSON_EXTRACT_SCALAR(qs, '$.el') = '{0}'".format(re.sub(r'\'', '\'\'', g['label']))
+                q += " AND {el} = '{0}'".format(re.sub(r'\'', '\'\'', g['label']), **c)
 
         sql = """SELECT 
 year * 10000 + month * 100 + day as date,
 COUNT(qs) as e_count,
-COUNT(DISTINCT JSON_EXTRACT_SCALAR(qs, '$.cid')) as u_count
+{3} as u_count
 FROM {0}.{1}
 WHERE {2}
 GROUP BY year * 10000 + month * 100 + day 
-""".format(self.options['athena_database'], self.options['athena_table'], q)
+""".format(self.options['athena_database'], self.options['athena_table'], q, self.distinct_users(c), **c)
 
-        athena_result = self._execute_athena_query(sql)
+        athena_result = self._execute_athena_query(sql, org)
         if athena_result['QueryExecution']['Status']['State'] != 'SUCCEEDED':
             print(athena_result)
             return False
@@ -108,6 +110,8 @@ GROUP BY year * 10000 + month * 100 + day
                 'e_count': e_count,
                 'u_count': u_count
             }
+            if self.options.get('approx'):
+                r_data['approx'] = self.approx_meta()
             idx = [i for i, _ in enumerate(result) if _['date'] == r_data['date']]
             if len(idx) > 0:
                 result[idx[0]] = r_data
@@ -129,11 +133,13 @@ def main():
         athena_result_prefix=os.environ.get('STATS_ATHENA_RESULT_PREFIX') or '',
         athena_database=os.environ.get('STATS_ATHENA_DATABASE'),
         athena_table=os.environ.get('STATS_ATHENA_TABLE'),
+        partition_mode=os.environ.get('OTM_PARTITION_MODE') or 'msck',
         container_table=os.environ.get('OTM_CONTAINER_DYNAMODB_TABLE'),
         tid=os.environ.get('TID'),
         goal_id=os.environ.get('GOAL_ID'),
         startdate=os.environ.get('STARTDATE'),
-        enddate=os.environ.get('ENDDATE')
+        enddate=os.environ.get('ENDDATE'),
+        approx=os.environ.get('OTM_GOAL_APPROX') == '1'
     )
     retriever.execute()
 
@@ -1,5 +1,6 @@
 from retriever_base import RetrieverBase
 import os
+import json
 
 
 class MakePartition(RetrieverBase):
@@ -7,7 +8,13 @@ class MakePartition(RetrieverBase):
         super(MakePartition, self).__init__(**kwargs)
 
     def execute(self):
-        self.make_partition()
+        # projected partitions don't need to be registered
+        if self.options.get('partition_mode') == 'projection':
+            print(json.dumps({'message': 'skip msck', 'partition_mode': self.options['partition_mode']}))
+            return
+        # the scheduled job also repairs the table in `register` mode,
+        # for the partitions that log_formatter failed to register
+        self.repair_table()
 
 
 def main():
@@ -16,6 +23,7 @@ def main():
         athena_database=os.environ.get('STATS_ATHENA_DATABASE'),
         athena_result_bucket=os.environ.get('STATS_ATHENA_RESULT_BUCKET'),
         athena_result_prefix=os.environ.get('STATS_ATHENA_RESULT_PREFIX') or '',
+        partition_mode=os.environ.get('OTM_PARTITION_MODE') or 'msck',
     )
     make_partition.execute()
 
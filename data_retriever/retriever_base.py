@@ -1,45 +1,59 @@
-from retrying import retry
+from athena_executor import AthenaExecutor
+import athena_scheduler
 import boto3
 import json
 import datetime
 
+# max standard error of APPROX_DISTINCT, and the z of the 95% bound (admin_api/chalicelib/stats_approx.py)
+APPROX_STANDARD_ERROR = 0.023
+Z_95 = 1.96
+
 
 class RetrieverBase:
     def __init__(self, **kwargs):
         self.options = kwargs
         self.s3 = boto3.resource('s3')
         self.athena = boto3.client('athena')
+        self.athena_executor = AthenaExecutor(self.athena, {
+            'OutputLocation': 's3://%s/%s' % (
+                self.options.get('athena_result_bucket'), self.options.get('athena_result_prefix') or ''),
+            'EncryptionConfiguration': {
+                'EncryptionOption': 'SSE_S3'
+            }
+        })
+        self.athena_scheduler = athena_scheduler.AthenaScheduler(self.athena_executor)
 
-    @retry(stop_max_attempt_number=10,
-           wait_exponential_multiplier=1000,
-           wait_exponential_max=10 * 60 * 1000)
-    def _poll_status(self, id):
-        print(json.dumps({'message': 'poll status', 'id': id}))
-        result = self.athena.get_query_execution(
-            QueryExecutionId=id
-        )
-        state = result['QueryExecution']['Status']['State']
-        if state == 'SUCCEEDED':
-            return result
-        elif state == 'FAILED':
-            return result
-        else:
-            raise Exception
-
-    def _execute_athena_query(self, query):
+    def _submit_athena_query(self, query, org=None):
+        """
+        Future of the get_query_execution response, the queries of the retriever run concurrently.
+        The query of an org waits for a batch slot of the org (athena_scheduler).
+        """
         print(json.dumps({'message': 'execute athena', 'query': query}))
-        response = self.athena.start_query_execution(
-            QueryString=query,
-            ResultConfiguration={
-                'OutputLocation': 's3://%s/%s' % (
-                    self.options['athena_result_bucket'], self.options['athena_result_prefix']),
-                'EncryptionConfiguration': {
-                    'EncryptionOption': 'SSE_S3'
-                }
-            }
-        )
-        QueryExecutionId = response['QueryExecutionId']
-        return self._poll_status(QueryExecutionId)
+        if org is None or not athena_scheduler.enabled():
+            return self.athena_executor.submit(query)
+        lease_id = self.athena_scheduler.wait(org)
+        future = self.athena_executor.submit(query)
+        future.add_done_callback(lambda x: self.athena_scheduler.release(org, lease_id))
+        return future
+
+    def _execute_athena_query(self, query, org=None):
+        return self._submit_athena_query(query, org).result()
+
+    def distinct_users(self, c):
+        # APPROX_DISTINCT (standard error 2.3%) of the `approx` option is cheaper than COUNT(DISTINCT)
+        if self.options.get('approx'):
+            return 'APPROX_DISTINCT({cid})'.format(**c)
+        return 'COUNT(DISTINCT {cid})'.format(**c)
+
+    def approx_meta(self):
+        """
+        `approx` of a goal result of the `approx` option, like meta.approx of the stats artifacts:
+        the events are counted exactly, the users are APPROX_DISTINCT (no sampling)
+        """
+        if not self.options.get('approx'):
+            return None
+        return {'sample': 100, 'standard_error': APPROX_STANDARD_ERROR,
+                'relative_error': {'e_count': 0.0, 'u_count': round(Z_95 * APPROX_STANDARD_ERROR, 4)}}
 
     def _save_usage_report(self, bucket, org, tid, result_athena):
         print(json.dumps({'message': 'save usage report'}))
@@ -51,6 +65,13 @@ class RetrieverBase:
         self.s3.Object(bucket, usage_key).put(Body=json.dumps({'type': 'athena_scan', 'size': scanned}))
 
     def make_partition(self):
+        # partitions are registered by log_formatter or projected by Athena except `msck` mode
+        if self.options.get('partition_mode', 'msck') != 'msck':
+            print(json.dumps({'message': 'skip msck', 'partition_mode': self.options['partition_mode']}))
+            return
+        self.repair_table()
+
+    def repair_table(self):
         result = self._execute_athena_query('MSCK REPAIR TABLE %s.%s;' % (self.options['athena_database'], self.options['athena_table']))
 
         if result['QueryExecution']['Status']['State'] != 'SUCCEEDED':
@@ -0,0 +1,233 @@
+from retriever_base import RetrieverBase
+from collect_columns import columns
+from datetime import datetime, timedelta
+import hashlib
+import json
+import os
+import boto3
+
+# tables of the rollups (infra/common/rollup.tf), a day of a container is written under
+# `<prefix><table>/org=/tid=/year=/month=/day=/`
+URL_TABLE = 'otm_rollup_url_hour'
+EVENT_TABLE = 'otm_rollup_event_hour'
+# written when the day is finished, Athena ignores the objects whose name starts with '_'
+# the version of the rows is a part of the name, the days of an older version are not read by admin_api
+MARKER = '_SUCCESS_2'
+
+
+def url_hour_select(source, criteria):
+    # the rows of `url_hour` of the url table query (admin_api), the metrics of the null url / p_url are masked
+    # url_event_count is the event count of the url in the hour (all p_url) for the count of the url table
+    return """
+WITH
+client AS (
+SELECT
+date_trunc('hour', datetime) AS hour,
+{dl} AS url,
+{o_pl} AS p_url,
+{cid} AS cid,
+MIN(datetime) AS first_datetime,
+MIN_BY({dt}, datetime) AS first_title,
+COUNT_IF({o_s} = 'pageview') AS pageview_count,
+ARRAY_AGG(CASE WHEN {o_s} = 'pageview' THEN {o_psid} END) AS psids,
+MAX(CASE WHEN {o_s_kind} = 'scroll' THEN {o_e_y} END) AS y,
+COUNT(datetime) AS event_count,
+COUNT_IF({o_s_kind} = 'click_widget') AS w_click_count,
+COUNT_IF({o_s_kind} = 'click_trivial') AS t_click_count,
+COUNT(CASE WHEN {o_s_kind} = 'pageview' AND {plt} > 0 AND {plt} <= 30000 THEN {plt} END) AS plt_count,
+SUM(CASE WHEN {o_s_kind} = 'pageview' AND {plt} > 0 AND {plt} <= 30000 THEN {plt} END) AS sum_plt,
+MAX(CASE WHEN {o_s_kind} = 'pageview' AND {plt} > 0 AND {plt} <= 30000 THEN {plt} END) AS max_plt
+FROM {0}
+WHERE {1}
+GROUP BY date_trunc('hour', datetime), {dl}, {o_pl}, {cid}
+),
+
+url_hour AS (
+SELECT
+hour, url, p_url,
+MIN(first_datetime) AS first_datetime,
+MIN_BY(first_title, first_datetime) AS first_title,
+SUM(pageview_count) AS count,
+CARDINALITY(ARRAY_DISTINCT(FILTER(FLATTEN(ARRAY_AGG(psids)), x -> x IS NOT NULL))) AS session_count,
+COUNT_IF(cid IS NOT NULL AND pageview_count > 0) AS user_count,
+COUNT(y) AS s_count,
+SUM(y) AS sum_scroll_y,
+MAX(y) AS max_scroll_y,
+SUM(event_count) AS event_count,
+SUM(w_click_count) AS w_click_count,
+SUM(t_click_count) AS t_click_count,
+SUM(plt_count) AS plt_count,
+SUM(sum_plt) AS sum_plt,
+MAX(max_plt) AS max_plt
+FROM client
+GROUP BY hour, url, p_url
+)
+
+SELECT
+CAST(hour AS timestamp) AS datetime,
+url,
+p_url,
+CAST(first_datetime AS timestamp) AS first_datetime,
+first_title,
+CAST(count AS bigint) AS count,
+CAST(session_count AS bigint) AS session_count,
+CAST(user_count AS bigint) AS user_count,
+CAST(CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN s_count END AS bigint) AS s_count,
+CAST(CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN sum_scroll_y END AS double) AS sum_scroll_y,
+CAST(CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN max_scroll_y END AS double) AS max_scroll_y,
+CAST(CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN event_count END AS bigint) AS event_count,
+CAST(CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN w_click_count END AS bigint) AS w_click_count,
+CAST(CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN t_click_count END AS bigint) AS t_click_count,
+CAST(CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN plt_count END AS bigint) AS plt_count,
+CAST(CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN sum_plt END AS double) AS sum_plt,
+CAST(CASE WHEN url IS NOT NULL AND p_url IS NOT NULL THEN max_plt END AS double) AS max_plt,
+CAST(SUM(event_count) OVER (PARTITION BY hour, url) AS bigint) AS url_event_count
+FROM url_hour
+""".format(source, criteria, **columns())
+
+
+def event_hour_select(source, criteria):
+    # the rows of the event table query (admin_api) by hour
+    return """SELECT
+CAST(date_trunc('hour', datetime) AS timestamp) AS datetime,
+{norm_dl} AS url,
+{dt} AS title,
+{o_s} AS state,
+{el} AS label,
+CAST(COUNT(*) AS bigint) AS count
+FROM {0}
+WHERE {1}
+GROUP BY date_trunc('hour', datetime), {norm_dl}, {dt}, {o_s}, {el}
+""".format(source, criteria, **columns())
+
+
+ROLLUPS = [
+    (URL_TABLE, url_hour_select),
+    (EVENT_TABLE, event_hour_select),
+]
+
+
+class RollupRetriever(RetrieverBase):
+    """
+    Aggregate a closed day (UTC) of the collect log of each container by hour into the rollup tables.
+    """
+
+    def __init__(self, **kwargs):
+        super(RollupRetriever, self).__init__(**kwargs)
+        if self.options['date']:
+            self.date = datetime.strptime(self.options['date'], '%Y-%m-%d')
+        else:
+            # CloudFront delivers the log of a day until the next day
+            self.date = datetime.today() - timedelta(days=int(self.options['days_ago']))
+        self.bucket = self.options['stat_bucket']
+
+    def execute(self):
+        self.make_partition()
+        days = [RollupDay(self, org, tid, table, select) for org, tid in self.containers() for table, select in ROLLUPS]
+        # the days of the containers are made concurrently, each step waits for every day
+        self._wait([x.prepare() for x in days], 'Cannot drop table')
+        results = self._wait([x.make() for x in days])
+        self._wait([x.drop() for x in days], 'Cannot drop table')
+        # the marker is written for the finished days, a failed day is made again by the next run
+        failed = [day.prefix for day, result in zip(days, results) if not day.finish(result)]
+        if failed:
+            raise Exception('Cannot make rollup: %s' % ', '.join(failed))
+
+    def _wait(self, futures, error=None):
+        results = [x.result() for x in futures]
+        for result in results:
+            if error and result['QueryExecution']['Status']['State'] != 'SUCCEEDED':
+                print(result)
+                raise Exception(error)
+        return results
+
+    def containers(self, last_evaluated_key=None):
+        args = {}
+        if last_evaluated_key:
+            args['ExclusiveStartKey'] = last_evaluated_key
+
+        dynamodb = boto3.resource('dynamodb')
+        table = dynamodb.Table(str(self.options['container_table']))
+        items = table.scan(**args)
+        for item in items['Items']:
+            yield item['organization'], item['tid']
+        if 'LastEvaluatedKey' in items:
+            yield from self.containers(items['LastEvaluatedKey'])
+
+    def criteria(self, org, tid):
+        c = columns()
+        q = "org = '{0}'".format(org)
+        q += " AND tid = '{0}'".format(tid)
+        q += ' AND year = {0}'.format(self.date.year)
+        q += ' AND month = {0}'.format(self.date.month)
+        q += ' AND day = {0}'.format(self.date.day)
+        q += ' AND {0} IS NOT NULL'.format(c['o_s'])
+        return q
+
+
+class RollupDay:
+    """
+    The day of a container of a rollup table, written by CTAS into its partition, so a rerun replaces the day.
+    """
+
+    def __init__(self, retriever, org, tid, table, select):
+        self.retriever = retriever
+        self.options = retriever.options
+        self.date = retriever.date
+        self.org = org
+        self.tid = tid
+        self.table = table
+        self.select = select
+        self.prefix = '%s%s/org=%s/tid=%s/year=%d/month=%d/day=%d/' % (
+            self.options['rollup_prefix'], table, org, tid, self.date.year, self.date.month, self.date.day)
+        # the containers are made concurrently, each has its staging table
+        self.staging_table = '%s.%s_%s_%s' % (self.options['athena_database'], table, self.date.strftime('%Y%m%d'),
+                                              hashlib.sha1(self.prefix.encode('utf-8')).hexdigest()[:16])
+
+    def prepare(self):
+        # CTAS needs an empty location, the day of the previous run is removed
+        self.retriever.s3.Bucket(self.retriever.bucket).objects.filter(Prefix=self.prefix).delete()
+        return self.drop()
+
+    def make(self):
+        source = '%s.%s' % (self.options['athena_database'], self.options['athena_table'])
+        sql = """CREATE TABLE {0}
+WITH (format = 'PARQUET', external_location = 's3://{1}/{2}')
+AS {3}""".format(self.staging_table, self.retriever.bucket, self.prefix,
+                 self.select(source, self.retriever.criteria(self.org, self.tid)))
+        return self.retriever._submit_athena_query(sql, self.org)
+
+    def drop(self):
+        # the data is kept, only the staging table is removed from the catalog
+        return self.retriever._submit_athena_query('DROP TABLE IF EXISTS %s' % self.staging_table, self.org)
+
+    def finish(self, result):
+        if result['QueryExecution']['Status']['State'] != 'SUCCEEDED':
+            print(result)
+            return False
+        self.retriever.s3.Object(self.retriever.bucket, self.prefix + MARKER).put(Body=b'')
+        self.retriever._save_usage_report(self.retriever.bucket, self.org, self.tid, result)
+        print(json.dumps({'message': 'rollup', 'partition': self.prefix,
+                          'scanned': result['QueryExecution']['Statistics']['DataScannedInBytes']}))
+        return True
+
+
+def main():
+    retriever = RollupRetriever(
+        stat_bucket=os.environ.get('OTM_STATS_BUCKET'),
+        usage_prefix=os.environ.get('OTM_USAGE_PREFIX'),
+        rollup_prefix=os.environ.get('OTM_ROLLUP_PREFIX') or 'rollups/',
+        athena_result_bucket=os.environ.get('STATS_ATHENA_RESULT_BUCKET'),
+        athena_result_prefix=os.environ.get('STATS_ATHENA_RESULT_PREFIX') or '',
+        athena_database=os.environ.get('STATS_ATHENA_DATABASE'),
+        athena_table=os.environ.get('STATS_ATHENA_TABLE'),
+        partition_mode=os.environ.get('OTM_PARTITION_MODE') or 'msck',
+        container_table=os.environ.get('OTM_CONTAINER_DYNAMODB_TABLE'),
+        days_ago=os.environ.get('OTM_ROLLUP_DAYS_AGO') or 1,
+        date=os.environ.get('DATE')
+    )
+    retriever.execute()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1 @@
+../common/urlnorm.py
\ No newline at end of file
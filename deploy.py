@@ -15,6 +15,14 @@ def main():
     backend_region = os.environ.get('TERRAFORM_BACKEND_REGION') or region
     dockerhub_user = os.environ.get('DOCKERHUB_USER')
     dockerhub_pass = os.environ.get('DOCKERHUB_PASS')
+    collect_format = os.environ.get('OTM_COLLECT_FORMAT') or 'json'
+    collect_table = 'otm_collect_parquet' if collect_format == 'parquet' else 'otm_collect'
+    partition_mode = os.environ.get('OTM_PARTITION_MODE') or 'msck'
+    formatter_ingestion = os.environ.get('OTM_FORMATTER_INGESTION') or 'sns'
+    athena_scheduler_enabled = os.environ.get('ATHENA_SCHEDULER_ENABLED') or '0'
+    goal_approx = os.environ.get('OTM_GOAL_APPROX') or '0'
+    # the formatter (norm_dl / norm_o_pl) and admin_api (merge of the results) use the same rules
+    url_normalize_rules = os.environ.get('OTM_URL_NORMALIZE_RULES') or 'strip_query'
 
 
     print('1. deploy infra')
@@ -55,7 +63,12 @@ def main():
     terraform_apply_cmd = [
         'terraform', 'plan',
         '-var=aws_batch_job_queue_arn=%s' % job_queue,
-        '-var=aws_region=%s' % region
+        '-var=aws_region=%s' % region,
+        '-var=otm_collect_format=%s' % collect_format,
+        '-var=otm_partition_mode=%s' % partition_mode,
+        '-var=otm_formatter_ingestion=%s' % formatter_ingestion,
+        '-var=otm_athena_scheduler_enabled=%s' % athena_scheduler_enabled,
+        '-var=otm_goal_approx=%s' % goal_approx
     ]
     if os.path.exists('terraform.tfvars'):
         terraform_apply_cmd.append('-var-file=%s' % '../../terraform.tfvars')
@@ -119,12 +132,24 @@ def main():
     dynamo_usage_table = dynamo_usage_values['id']
     dynamo_usage_table_arn = dynamo_usage_values['arn']
 
+    dynamo_stats_result_values = [x for x in common_resources if x['address'] == 'aws_dynamodb_table.otm_stats_result'][0]['values']
+    dynamo_stats_result_table = dynamo_stats_result_values['id']
+    dynamo_stats_result_table_arn = dynamo_stats_result_values['arn']
+
+    dynamo_athena_scheduler_values = [x for x in common_resources if x['address'] == 'aws_dynamodb_table.otm_athena_scheduler'][0]['values']
+    dynamo_athena_scheduler_table = dynamo_athena_scheduler_values['id']
+    dynamo_athena_scheduler_table_arn = dynamo_athena_scheduler_values['arn']
+
     job_definition = [x for x in common_resources if x['address'] == 'aws_batch_job_definition.otm_data_retriever'][0]['values']['id']
 
     sns_topic = [x for x in common_resources if x['address'] == 'aws_sns_topic.otm_collect_log_topic'][0]['values']['name']
 
     athena_database = [x for x in common_resources if x['address'] == 'aws_glue_catalog_database.otm'][0]['values']['name']
 
+    log_queue_values = None
+    if formatter_ingestion == 'sqs':
+        log_queue_values = [x for x in common_resources if x['address'] == 'aws_sqs_queue.otm_collect_log_queue[0]'][0]['values']
+
     cognito_identify_pool_values = [x for x in common_resources if x['address'] == 'aws_cognito_identity_pool.otm'][0]['values']
     cognito_identify_pool_id = cognito_identify_pool_values['id']
     aws_id = re.match('^arn:aws:cognito-identity:[a-z0-9\-]+:([0-9]+):identitypool', cognito_identify_pool_values['arn'])[1]
@@ -157,6 +182,8 @@ def main():
         env['OTM_ORG_DYNAMODB_TABLE'] = dynamo_org_table
         env['OTM_CONTAINER_DYNAMODB_TABLE'] = dynamo_container_table
         env['OTM_USAGE_DYNAMODB_TABLE'] = dynamo_usage_table
+        env['OTM_STATS_RESULT_DYNAMODB_TABLE'] = dynamo_stats_result_table
+        env['OTM_ATHENA_SCHEDULER_DYNAMODB_TABLE'] = dynamo_athena_scheduler_table
         env['OTM_STATS_BUCKET'] = stat_bucket
         env['OTM_STATS_PREFIX'] = 'stats/'
         env['OTM_USAGE_PREFIX'] = 'usage/'
@@ -167,8 +194,13 @@ def main():
         env['STATS_CONFIG_BUCKET'] = config_bucket
         env['STATS_GCLOUD_KEY_NAME'] = 'account.json'
         env['STATS_ATHENA_DATABASE'] = athena_database
-        env['STATS_ATHENA_TABLE'] = 'otm_collect'
+        env['STATS_ATHENA_TABLE'] = collect_table
         env['STATS_ATHENA_RESULT_BUCKET'] = athena_bucket
+        env['OTM_URL_NORMALIZE_RULES'] = url_normalize_rules
+        env['STATS_WINDOW_ENABLED'] = os.environ.get('STATS_WINDOW_ENABLED') or '0'
+        env['STATS_ROLLUP_ENABLED'] = os.environ.get('STATS_ROLLUP_ENABLED') or '0'
+        env['ATHENA_SCHEDULER_ENABLED'] = athena_scheduler_enabled
+        env['STATS_APPROX_SAMPLE_PERCENT'] = os.environ.get('STATS_APPROX_SAMPLE_PERCENT') or '100'
 
     with open('./admin_api/.chalice/config.json', 'w') as f:
         json.dump(config, f, indent=4)
@@ -195,6 +227,10 @@ def main():
         config['Statement'][2]['Resource'].append(dynamo_container_table_arn + '/*')
         config['Statement'][2]['Resource'].append(dynamo_usage_table_arn)
         config['Statement'][2]['Resource'].append(dynamo_usage_table_arn + '/*')
+        config['Statement'][2]['Resource'].append(dynamo_stats_result_table_arn)
+        config['Statement'][2]['Resource'].append(dynamo_stats_result_table_arn + '/*')
+        config['Statement'][2]['Resource'].append(dynamo_athena_scheduler_table_arn)
+        config['Statement'][2]['Resource'].append(dynamo_athena_scheduler_table_arn + '/*')
         config['Statement'][3]['Resource'] = []
         config['Statement'][3]['Resource'].append(cognito_user_pool_arn)
 
@@ -210,7 +246,11 @@ def main():
     if dockerhub_user and dockerhub_pass:
         # sign in to dockerhub
         subprocess.run(['docker', 'login', '-u', dockerhub_user, '-p', dockerhub_pass], check=True)
-    subprocess.run(['docker', 'build', '-t', 'otm-data-retriever', '.'], cwd='./data_retriever', check=True)
+    # build context is passed through `tar -h` to resolve symlinks to ../common
+    context = subprocess.Popen(['tar', '-ch', '.'], stdout=subprocess.PIPE, cwd='./data_retriever')
+    subprocess.run(['docker', 'build', '-t', 'otm-data-retriever', '-'], stdin=context.stdout, cwd='./data_retriever',
+                   check=True)
+    context.wait()
     subprocess.run(['docker', 'tag', 'otm-data-retriever:latest', '%s:latest' % repository_url], cwd='./data_retriever',
                    check=True)
     p = subprocess.Popen(['aws', 'ecr', 'get-login', '--no-include-email'], stdout=subprocess.PIPE)
@@ -261,9 +301,27 @@ def main():
         config = json.load(f)
         env = config['environment_variables']
         env['OTM_REFORM_S3_BUCKET'] = collect_log_bucket
-        env['OTM_REFORM_LOG_PREFIX'] = 'formatted/'
+        env['OTM_REFORM_LOG_PREFIX'] = 'formatted_parquet/' if collect_format == 'parquet' else 'formatted/'
+        env['OTM_REFORM_FORMAT'] = collect_format
         env['OTM_STAT_S3_BUCKET'] = stat_bucket
         env['OTM_STAT_LOG_PREFIX'] = 'usage/'
+        env['OTM_PARTITION_MODE'] = partition_mode
+        env['OTM_GLUE_DATABASE'] = athena_database
+        env['OTM_GLUE_TABLE'] = collect_table
+        env['OTM_FORMATTER_WORKERS'] = os.environ.get('OTM_FORMATTER_WORKERS') or '4'
+        env['OTM_URL_NORMALIZE_RULES'] = url_normalize_rules
+        if log_queue_values:
+            env['OTM_LOG_QUEUE_URL'] = log_queue_values['id']
+            env['OTM_BATCH_MAX_BYTES'] = os.environ.get('OTM_BATCH_MAX_BYTES') or str(64 * 1024 * 1024)
+            # a batch can start until 5 minutes before the timeout, only the scheduled drain has the long timeout
+            stage = config['stages'].setdefault(environment, {})
+            stage.setdefault('lambda_functions', {})['batch_handler'] = {'lambda_timeout': 900}
+            env['OTM_BATCH_MAX_SECONDS'] = '600'
+        else:
+            env.pop('OTM_LOG_QUEUE_URL', None)
+        if collect_format == 'parquet' and os.environ.get('OTM_PYARROW_LAYER'):
+            # pyarrow is too large to be bundled in the deployment package
+            config['layers'] = [os.environ.get('OTM_PYARROW_LAYER')]
 
     with open('./log_formatter/.chalice/config.json', 'w') as f:
         json.dump(config, f, indent=4)
@@ -275,6 +333,13 @@ def main():
         config['Statement'][1]['Resource'].append('arn:aws:s3:::%s' % collect_log_bucket)
         config['Statement'][1]['Resource'].append('arn:aws:s3:::%s/*' % stat_bucket)
         config['Statement'][1]['Resource'].append('arn:aws:s3:::%s' % stat_bucket)
+        if log_queue_values:
+            config['Statement'].append({
+                'Effect': 'Allow',
+                'Action': ['sqs:ReceiveMessage', 'sqs:DeleteMessage', 'sqs:ChangeMessageVisibility',
+                           'sqs:GetQueueAttributes'],
+                'Resource': [log_queue_values['arn']]
+            })
 
     with open('./log_formatter/.chalice/policy-%s.json' % environment, 'w') as f:
         json.dump(config, f, indent=4)
@@ -282,6 +347,9 @@ def main():
     subprocess.run(['pip', 'install', '-r', 'requirements.txt'], cwd='./log_formatter', check=True)
     local_env = os.environ.copy()
     local_env['OTM_LOG_SNS'] = sns_topic
+    if log_queue_values:
+        # registers the scheduled drain instead of the SNS subscription
+        local_env['OTM_LOG_QUEUE_URL'] = log_queue_values['id']
     subprocess.run(['chalice', 'deploy', '--no-autogen-policy', '--stage=%s' % environment], cwd='./log_formatter',
                    env=local_env, check=True)
 
@@ -19,8 +19,12 @@ resource "aws_batch_job_definition" "otm_data_retriever_goal" {
     {"name": "OTM_USAGE_PREFIX", "value": "usage/"},
     {"name": "STATS_ATHENA_RESULT_BUCKET", "value": "${aws_s3_bucket.otm_athena.bucket}"},
     {"name": "STATS_ATHENA_DATABASE", "value": "${aws_glue_catalog_database.otm.name}"},
-    {"name": "STATS_ATHENA_TABLE", "value": "otm_collect"},
-    {"name": "OTM_CONTAINER_DYNAMODB_TABLE", "value": "${aws_dynamodb_table.otm_container.name}"}
+    {"name": "STATS_ATHENA_TABLE", "value": "${local.collect_table}"},
+    {"name": "OTM_PARTITION_MODE", "value": "${var.otm_partition_mode}"},
+    {"name": "OTM_CONTAINER_DYNAMODB_TABLE", "value": "${aws_dynamodb_table.otm_container.name}"},
+    {"name": "OTM_ATHENA_SCHEDULER_DYNAMODB_TABLE", "value": "${aws_dynamodb_table.otm_athena_scheduler.name}"},
+    {"name": "ATHENA_SCHEDULER_ENABLED", "value": "${var.otm_athena_scheduler_enabled}"},
+    {"name": "OTM_GOAL_APPROX", "value": "${var.otm_goal_approx}"}
   ],
   "mountPoints": [],
   "ulimits": []
@@ -45,12 +45,36 @@ resource "aws_s3_bucket" "otm_collect_log" {
     type        = "CanonicalUser"
     permissions = ["FULL_CONTROL"]
   }
+
+  # multipart uploads of log_formatter that are not completed (e.g. timeout)
+  lifecycle_rule {
+    id = "abort-incomplete-multipart-upload"
+    enabled = true
+    abort_incomplete_multipart_upload_days = 1
+  }
 }
 
 locals {
+  collect_table = var.otm_collect_format == "parquet" ? "otm_collect_parquet" : "otm_collect"
+  collect_prefix = var.otm_collect_format == "parquet" ? "formatted_parquet/" : "formatted/"
   s3_collect_origin_id = "s3otmCollect"
   s3_script_origin_id = "s3otmScript"
   s3_client_origin_id = "s3otmClient"
+
+  # Athena partition projection of the formatted collect log (`projection` partition mode)
+  # org / tid are injected by the query conditions, so the partitions are not registered.
+  collect_projection = {
+    "projection.enabled" = "true"
+    "projection.org.type" = "injected"
+    "projection.tid.type" = "injected"
+    "projection.year.type" = "integer"
+    "projection.year.range" = var.otm_partition_projection_year_range
+    "projection.month.type" = "integer"
+    "projection.month.range" = "1,12"
+    "projection.day.type" = "integer"
+    "projection.day.range" = "1,31"
+  }
+  collect_location_template = "org=$${org}/tid=$${tid}/year=$${year}/month=$${month}/day=$${day}"
 }
 
 resource "aws_cloudfront_distribution" "otm_collect_distribution" {
@@ -153,6 +177,56 @@ resource "aws_s3_bucket_notification" "otm_collect_log_notification" {
   }
 }
 
+# micro-batch ingestion (otm_formatter_ingestion = "sqs"): S3 events are queued and drained by log_formatter
+resource "aws_sqs_queue" "otm_collect_log_dlq" {
+  count = var.otm_formatter_ingestion == "sqs" ? 1 : 0
+  name = "${terraform.workspace}-otm-collect-log-dlq"
+  message_retention_seconds = 1209600
+  tags = var.aws_resource_tags
+}
+
+resource "aws_sqs_queue" "otm_collect_log_queue" {
+  count = var.otm_formatter_ingestion == "sqs" ? 1 : 0
+  name = "${terraform.workspace}-otm-collect-log-queue"
+  # longer than the timeout of log_formatter
+  visibility_timeout_seconds = 960
+  message_retention_seconds = 1209600
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.otm_collect_log_dlq[0].arn
+    maxReceiveCount = 5
+  })
+  tags = var.aws_resource_tags
+}
+
+resource "aws_sqs_queue_policy" "otm_collect_log_queue" {
+  count = var.otm_formatter_ingestion == "sqs" ? 1 : 0
+  queue_url = aws_sqs_queue.otm_collect_log_queue[0].id
+
+  policy = <<POLICY
+{
+  "Version": "2012-10-17",
+  "Statement": [{
+    "Effect": "Allow",
+    "Principal": {"Service": "sns.amazonaws.com"},
+    "Action": "sqs:SendMessage",
+    "Resource": "${aws_sqs_queue.otm_collect_log_queue[0].arn}",
+    "Condition": {
+      "ArnEquals": {"aws:SourceArn": "${aws_sns_topic.otm_collect_log_topic.arn}"}
+    }
+  }]
+}
+POLICY
+}
+
+resource "aws_sns_topic_subscription" "otm_collect_log_queue" {
+  count = var.otm_formatter_ingestion == "sqs" ? 1 : 0
+  topic_arn = aws_sns_topic.otm_collect_log_topic.arn
+  protocol = "sqs"
+  endpoint = aws_sqs_queue.otm_collect_log_queue[0].arn
+  # the message body is the S3 event notification as it is
+  raw_message_delivery = true
+}
+
 resource "aws_s3_bucket" "otm_script" {
   bucket = "${terraform.workspace}-${var.aws_s3_bucket_prefix}-otm-script"
   acl = "private"
@@ -389,6 +463,50 @@ resource "aws_dynamodb_table" "otm_usage" {
   }
 }
 
+resource "aws_dynamodb_table" "otm_stats_result" {
+  name = "${terraform.workspace}_otm_stats_result"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key = "execution_id"
+  range_key = "artifact"
+
+  attribute {
+    name = "execution_id"
+    type = "S"
+  }
+
+  attribute {
+    name = "artifact"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled = true
+  }
+}
+
+resource "aws_dynamodb_table" "otm_athena_scheduler" {
+  name = "${terraform.workspace}_otm_athena_scheduler"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key = "org"
+  range_key = "entry"
+
+  attribute {
+    name = "org"
+    type = "S"
+  }
+
+  attribute {
+    name = "entry"
+    type = "S"
+  }
+
+  ttl {
+    attribute_name = "expires_at"
+    enabled = true
+  }
+}
+
 resource "aws_iam_role" "ecs_task_role" {
   name = "${terraform.workspace}_otm_ecs_task_role"
   assume_role_policy = <<EOF
@@ -459,6 +577,7 @@ resource "aws_iam_policy" "log_stat_s3_access_policy" {
           "s3:GetObjectTagging",
           "s3:GetObjectVersionTagging",
           "s3:PutObject",
+          "s3:AbortMultipartUpload",
           "s3:PutObjectAcl",
           "s3:PutObjectTagging",
           "s3:PutObjectVersionTagging",
@@ -490,7 +609,8 @@ resource "aws_iam_policy" "log_stat_s3_access_policy" {
       "Resource": [
         "${aws_dynamodb_table.otm_org.arn}",
         "${aws_dynamodb_table.otm_container.arn}",
-        "${aws_dynamodb_table.otm_usage.arn}"
+        "${aws_dynamodb_table.otm_usage.arn}",
+        "${aws_dynamodb_table.otm_athena_scheduler.arn}"
       ]
     }
   ]
@@ -534,10 +654,13 @@ resource "aws_batch_job_definition" "otm_data_retriever" {
     {"name": "STATS_ATHENA_RESULT_BUCKET", "value": "${aws_s3_bucket.otm_athena.bucket}"},
     {"name": "STATS_ATHENA_RESULT_PREFIX", "value": ""},
     {"name": "STATS_ATHENA_DATABASE", "value": "${aws_glue_catalog_database.otm.name}"},
-    {"name": "STATS_ATHENA_TABLE", "value": "otm_collect"},
+    {"name": "STATS_ATHENA_TABLE", "value": "${local.collect_table}"},
+    {"name": "OTM_PARTITION_MODE", "value": "${var.otm_partition_mode}"},
     {"name": "USAGE_ATHENA_TABLE", "value": "otm_usage"},
     {"name": "OTM_USAGE_DYNAMODB_TABLE", "value": "${aws_dynamodb_table.otm_usage.name}"},
-    {"name": "OTM_CONTAINER_DYNAMODB_TABLE", "value": "${aws_dynamodb_table.otm_container.name}"}
+    {"name": "OTM_CONTAINER_DYNAMODB_TABLE", "value": "${aws_dynamodb_table.otm_container.name}"},
+    {"name": "OTM_ATHENA_SCHEDULER_DYNAMODB_TABLE", "value": "${aws_dynamodb_table.otm_athena_scheduler.name}"},
+    {"name": "ATHENA_SCHEDULER_ENABLED", "value": "${var.otm_athena_scheduler_enabled}"}
   ],
   "mountPoints": [],
   "ulimits": []
@@ -653,7 +776,8 @@ resource "aws_batch_job_definition" "otm_data_retriever_msck" {
     {"name": "STATS_ATHENA_RESULT_BUCKET", "value": "${aws_s3_bucket.otm_athena.bucket}"},
     {"name": "STATS_ATHENA_RESULT_PREFIX", "value": ""},
     {"name": "STATS_ATHENA_DATABASE", "value": "${aws_glue_catalog_database.otm.name}"},
-    {"name": "STATS_ATHENA_TABLE", "value": "otm_collect"}
+    {"name": "STATS_ATHENA_TABLE", "value": "${local.collect_table}"},
+    {"name": "OTM_PARTITION_MODE", "value": "${var.otm_partition_mode}"}
   ],
   "mountPoints": [],
   "ulimits": []
@@ -708,7 +832,8 @@ resource "aws_cloudwatch_event_rule" "otm_msck_report" {
   name                = "${terraform.workspace}_otm_msck_report"
   description         = "[OTM] make partition"
   schedule_expression = "cron(0 0 * * ? *)"
-  is_enabled          = var.aws_cloudwatch_event_msck_enable
+  # projected partitions don't need MSCK REPAIR TABLE
+  is_enabled          = var.aws_cloudwatch_event_msck_enable && var.otm_partition_mode != "projection"
 }
 
 resource "aws_cloudwatch_event_target" "otm_data_retriever_msck" {
@@ -722,10 +847,108 @@ resource "aws_cloudwatch_event_target" "otm_data_retriever_msck" {
   }
 }
 
+resource "aws_batch_job_definition" "otm_data_retriever_compact" {
+  name = "${terraform.workspace}_otm_data_retriever_compact_job_definition"
+  type = "container"
+  timeout {
+    attempt_duration_seconds = var.aws_batch_timeout
+  }
+  container_properties = <<CONTAINER_PROPERTIES
+{
+  "command": ["python", "compact.py"],
+  "image": "${aws_ecr_repository.otm_data_retriever.repository_url}:latest",
+  "jobRoleArn": "${aws_iam_role.ecs_task_role.arn}",
+  "memory": 2000,
+  "vcpus": 2,
+  "volumes": [],
+  "environment": [
+    {"name": "AWS_DEFAULT_REGION", "value": "${var.aws_region}"},
+    {"name": "OTM_COLLECT_LOG_BUCKET", "value": "${aws_s3_bucket.otm_collect_log.bucket}"},
+    {"name": "OTM_COLLECT_LOG_PREFIX", "value": "${local.collect_prefix}"},
+    {"name": "OTM_COLLECT_FORMAT", "value": "${var.otm_collect_format}"}
+  ],
+  "mountPoints": [],
+  "ulimits": []
+}
+CONTAINER_PROPERTIES
+}
+
+resource "aws_iam_role" "data_retriever_compact_role" {
+  name = "${terraform.workspace}_otm_data_retriever_compact_role"
+  assume_role_policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Sid": "",
+      "Effect": "Allow",
+      "Principal": {
+        "Service": "events.amazonaws.com"
+      },
+      "Action": "sts:AssumeRole"
+    }
+  ]
+}
+EOF
+}
+
+resource "aws_iam_policy" "data_retriever_compact_policy" {
+  name = "${terraform.workspace}_otm_data_retriever_compact_policy"
+  description = "Open Tag Manager, CloudWatch target role"
+  policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+       {
+          "Effect": "Allow",
+          "Action": [
+               "batch:SubmitJob"
+           ],
+           "Resource": "*"
+        }
+  ]
+}
+EOF
+}
+
+resource "aws_iam_role_policy_attachment" "data_retriever_compact_policy_attachment" {
+  role = aws_iam_role.data_retriever_compact_role.name
+  policy_arn = aws_iam_policy.data_retriever_compact_policy.arn
+}
+
+resource "aws_cloudwatch_event_rule" "otm_compact_report" {
+  name                = "${terraform.workspace}_otm_compact_report"
+  description         = "[OTM] compact formatted log"
+  schedule_expression = "cron(30 1 * * ? *)"
+  is_enabled          = var.aws_cloudwatch_event_compact_enable
+}
+
+resource "aws_cloudwatch_event_target" "otm_data_retriever_compact" {
+  rule         = aws_cloudwatch_event_rule.otm_compact_report.name
+  target_id    = "${terraform.workspace}_otm_data_retriever_compact"
+  arn          = var.aws_batch_job_queue_arn
+  role_arn     = aws_iam_role.data_retriever_compact_role.arn
+  batch_target {
+    job_definition = aws_batch_job_definition.otm_data_retriever_compact.arn
+    job_name       = "${terraform.workspace}_otm_data_retriever_compact"
+  }
+}
+
 resource "aws_s3_bucket" "otm_athena" {
   bucket = "${terraform.workspace}-${var.aws_s3_bucket_prefix}-otm-athena"
   acl = "private"
   tags = var.aws_resource_tags
+
+  # extracts of the stats windows (admin_api drops them after STATS_WINDOW_TTL)
+  lifecycle_rule {
+    id = "expire-stats-windows"
+    enabled = true
+    prefix = "windows/"
+
+    expiration {
+      days = 2
+    }
+  }
 }
 
 resource "aws_glue_catalog_database" "otm" {
@@ -738,9 +961,11 @@ resource "aws_glue_catalog_table" "otm_collect" {
 
   table_type = "EXTERNAL_TABLE"
 
-  parameters = {
+  parameters = merge({
     EXTERNAL = "TRUE"
-  }
+  }, var.otm_partition_mode == "projection" ? tomap(merge(local.collect_projection, {
+    "storage.location.template" = "s3://${aws_s3_bucket.otm_collect_log.bucket}/formatted/${local.collect_location_template}"
+  })) : tomap({}))
 
   storage_descriptor {
     location = "s3://${aws_s3_bucket.otm_collect_log.bucket}/formatted"
@@ -885,6 +1110,310 @@ resource "aws_glue_catalog_table" "otm_collect" {
       name = "qs"
       type = "string"
     }
+
+    columns {
+      name = "o_s"
+      type = "string"
+    }
+
+    columns {
+      name = "dl"
+      type = "string"
+    }
+
+    columns {
+      name = "o_pl"
+      type = "string"
+    }
+
+    columns {
+      name = "cid"
+      type = "string"
+    }
+
+    columns {
+      name = "o_psid"
+      type = "string"
+    }
+
+    columns {
+      name = "el"
+      type = "string"
+    }
+
+    columns {
+      name = "dt"
+      type = "string"
+    }
+
+    columns {
+      name = "o_e_y"
+      type = "double"
+    }
+
+    columns {
+      name = "plt"
+      type = "double"
+    }
+
+    columns {
+      name = "norm_dl"
+      type = "string"
+    }
+
+    columns {
+      name = "norm_o_pl"
+      type = "string"
+    }
+
+    columns {
+      name = "o_s_kind"
+      type = "string"
+    }
+  }
+
+  partition_keys {
+    name = "org"
+    type = "string"
+  }
+
+  partition_keys {
+    name = "tid"
+    type = "string"
+  }
+
+  partition_keys {
+    name = "year"
+    type = "int"
+  }
+
+  partition_keys {
+    name = "month"
+    type = "int"
+  }
+
+  partition_keys {
+    name = "day"
+    type = "int"
+  }
+}
+
+resource "aws_glue_catalog_table" "otm_collect_parquet" {
+  name = "otm_collect_parquet"
+  database_name = aws_glue_catalog_database.otm.name
+
+  table_type = "EXTERNAL_TABLE"
+
+  parameters = merge({
+    EXTERNAL = "TRUE"
+    "parquet.compression" = "SNAPPY"
+  }, var.otm_partition_mode == "projection" ? tomap(merge(local.collect_projection, {
+    "storage.location.template" = "s3://${aws_s3_bucket.otm_collect_log.bucket}/formatted_parquet/${local.collect_location_template}"
+  })) : tomap({}))
+
+  storage_descriptor {
+    location = "s3://${aws_s3_bucket.otm_collect_log.bucket}/formatted_parquet"
+    input_format = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat"
+    output_format = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat"
+
+    ser_de_info {
+      name = "parquet"
+      serialization_library = "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+
+      parameters = {
+        "serialization.format" = 1
+      }
+    }
+
+    columns {
+      name = "datetime"
+      type = "timestamp"
+    }
+
+    columns {
+      name = "x_edge_location"
+      type = "string"
+    }
+
+    columns {
+      name = "sc_bytes"
+      type = "bigint"
+    }
+
+    columns {
+      name = "c_ip"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_method"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_host"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_uri_stem"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_status"
+      type = "int"
+    }
+
+    columns {
+      name = "cs_referer"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_user_agent"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_uri_query"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_cookie"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_x_edge_result_type"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_x_edge_request_id"
+      type = "string"
+    }
+
+    columns {
+      name = "x_host_header"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_protocol"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_bytes"
+      type = "bigint"
+    }
+
+    columns {
+      name = "time_taken"
+      type = "double"
+    }
+
+    columns {
+      name = "x_forwarded_for"
+      type = "string"
+    }
+
+    columns {
+      name = "ssl_protocol"
+      type = "string"
+    }
+
+    columns {
+      name = "ssl_cipher"
+      type = "string"
+    }
+
+    columns {
+      name = "x_edge_response_result_type"
+      type = "string"
+    }
+
+    columns {
+      name = "cs_protocol_version"
+      type = "string"
+    }
+
+    columns {
+      name = "fle_status"
+      type = "string"
+    }
+
+    columns {
+      name = "fle_encrypted_fields"
+      type = "string"
+    }
+
+    columns {
+      name = "qs"
+      type = "string"
+    }
+
+    columns {
+      name = "o_s"
+      type = "string"
+    }
+
+    columns {
+      name = "dl"
+      type = "string"
+    }
+
+    columns {
+      name = "o_pl"
+      type = "string"
+    }
+
+    columns {
+      name = "cid"
+      type = "string"
+    }
+
+    columns {
+      name = "o_psid"
+      type = "string"
+    }
+
+    columns {
+      name = "el"
+      type = "string"
+    }
+
+    columns {
+      name = "dt"
+      type = "string"
+    }
+
+    columns {
+      name = "o_e_y"
+      type = "double"
+    }
+
+    columns {
+      name = "plt"
+      type = "double"
+    }
+
+    columns {
+      name = "norm_dl"
+      type = "string"
+    }
+
+    columns {
+      name = "norm_o_pl"
+      type = "string"
+    }
+
+    columns {
+      name = "o_s_kind"
+      type = "string"
+    }
   }
 
   partition_keys {
@@ -0,0 +1,323 @@
+resource "aws_batch_job_definition" "otm_data_retriever_rollup" {
+  name = "${terraform.workspace}_otm_data_retriever_rollup_job_definition"
+  type = "container"
+  timeout {
+    attempt_duration_seconds = var.aws_batch_timeout
+  }
+  container_properties = <<CONTAINER_PROPERTIES
+{
+  "command": ["python", "rollup.py"],
+  "image": "${aws_ecr_repository.otm_data_retriever.repository_url}:latest",
+  "jobRoleArn": "${aws_iam_role.ecs_task_role.arn}",
+  "memory": 2000,
+  "vcpus": 2,
+  "volumes": [],
+  "environment": [
+    {"name": "AWS_DEFAULT_REGION", "value": "${var.aws_region}"},
+    {"name": "OTM_STATS_BUCKET", "value": "${aws_s3_bucket.otm_stats.bucket}"},
+    {"name": "OTM_USAGE_PREFIX", "value": "usage/"},
+    {"name": "STATS_ATHENA_RESULT_BUCKET", "value": "${aws_s3_bucket.otm_athena.bucket}"},
+    {"name": "STATS_ATHENA_DATABASE", "value": "${aws_glue_catalog_database.otm.name}"},
+    {"name": "STATS_ATHENA_TABLE", "value": "${local.collect_table}"},
+    {"name": "OTM_ROLLUP_PREFIX", "value": "rollups/"},
+    {"name": "OTM_PARTITION_MODE", "value": "${var.otm_partition_mode}"},
+    {"name": "OTM_CONTAINER_DYNAMODB_TABLE", "value": "${aws_dynamodb_table.otm_container.name}"},
+    {"name": "OTM_ATHENA_SCHEDULER_DYNAMODB_TABLE", "value": "${aws_dynamodb_table.otm_athena_scheduler.name}"},
+    {"name": "ATHENA_SCHEDULER_ENABLED", "value": "${var.otm_athena_scheduler_enabled}"}
+  ],
+  "mountPoints": [],
+  "ulimits": []
+}
+CONTAINER_PROPERTIES
+}
+
+resource "aws_iam_role" "data_retriever_rollup_role" {
+  name = "${terraform.workspace}_otm_data_retriever_rollup_role"
+  assume_role_policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+    {
+      "Sid": "",
+      "Effect": "Allow",
+      "Principal": {
+        "Service": "events.amazonaws.com"
+      },
+      "Action": "sts:AssumeRole"
+    }
+  ]
+}
+EOF
+}
+
+resource "aws_iam_policy" "data_retriever_rollup_policy" {
+  name = "${terraform.workspace}_otm_data_retriever_rollup_policy"
+  description = "Open Tag Manager, CloudWatch target role"
+  policy = <<EOF
+{
+  "Version": "2012-10-17",
+  "Statement": [
+       {
+          "Effect": "Allow",
+          "Action": [
+               "batch:SubmitJob"
+           ],
+           "Resource": "*"
+        }
+  ]
+}
+EOF
+}
+
+resource "aws_iam_role_policy_attachment" "data_retriever_rollup_policy_attachment" {
+  role = aws_iam_role.data_retriever_rollup_role.name
+  policy_arn = aws_iam_policy.data_retriever_rollup_policy.arn
+}
+
+resource "aws_cloudwatch_event_rule" "otm_data_retriever_rollup" {
+  name                = "${terraform.workspace}_otm_data_retriever_rollup"
+  description         = "[OTM] roll up the collect log of yesterday"
+  schedule_expression = "cron(0 3 * * ? *)"
+  is_enabled          = var.aws_cloudwatch_event_rollup_enable
+}
+
+resource "aws_cloudwatch_event_target" "otm_data_retriever_rollup" {
+  rule         = aws_cloudwatch_event_rule.otm_data_retriever_rollup.name
+  target_id    = "${terraform.workspace}_otm_data_retriever_rollup"
+  arn          = var.aws_batch_job_queue_arn
+  role_arn     = aws_iam_role.data_retriever_rollup_role.arn
+  batch_target {
+    job_definition = aws_batch_job_definition.otm_data_retriever_rollup.arn
+    job_name       = "${terraform.workspace}_otm_data_retriever_rollup"
+  }
+}
+
+# rollups of the collect log by hour, written by data_retriever/rollup.py and read by admin_api (stats_rollup)
+# org / tid are injected by the query conditions like the collect log
+resource "aws_glue_catalog_table" "otm_rollup_url_hour" {
+  name = "otm_rollup_url_hour"
+  database_name = aws_glue_catalog_database.otm.name
+
+  table_type = "EXTERNAL_TABLE"
+
+  parameters = merge({
+    EXTERNAL = "TRUE"
+    "parquet.compression" = "GZIP"
+  }, local.collect_projection, {
+    "storage.location.template" = "s3://${aws_s3_bucket.otm_stats.bucket}/rollups/otm_rollup_url_hour/${local.collect_location_template}"
+  })
+
+  storage_descriptor {
+    location = "s3://${aws_s3_bucket.otm_stats.bucket}/rollups/otm_rollup_url_hour"
+    input_format = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat"
+    output_format = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat"
+
+    ser_de_info {
+      name = "parquet"
+      serialization_library = "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+
+      parameters = {
+        "serialization.format" = 1
+      }
+    }
+
+    columns {
+      name = "datetime"
+      type = "timestamp"
+    }
+
+    columns {
+      name = "url"
+      type = "string"
+    }
+
+    columns {
+      name = "p_url"
+      type = "string"
+    }
+
+    columns {
+      name = "first_datetime"
+      type = "timestamp"
+    }
+
+    columns {
+      name = "first_title"
+      type = "string"
+    }
+
+    columns {
+      name = "count"
+      type = "bigint"
+    }
+
+    columns {
+      name = "session_count"
+      type = "bigint"
+    }
+
+    columns {
+      name = "user_count"
+      type = "bigint"
+    }
+
+    columns {
+      name = "s_count"
+      type = "bigint"
+    }
+
+    columns {
+      name = "sum_scroll_y"
+      type = "double"
+    }
+
+    columns {
+      name = "max_scroll_y"
+      type = "double"
+    }
+
+    columns {
+      name = "event_count"
+      type = "bigint"
+    }
+
+    columns {
+      name = "w_click_count"
+      type = "bigint"
+    }
+
+    columns {
+      name = "t_click_count"
+      type = "bigint"
+    }
+
+    columns {
+      name = "plt_count"
+      type = "bigint"
+    }
+
+    columns {
+      name = "sum_plt"
+      type = "double"
+    }
+
+    columns {
+      name = "max_plt"
+      type = "double"
+    }
+
+    columns {
+      name = "url_event_count"
+      type = "bigint"
+    }
+  }
+
+  partition_keys {
+    name = "org"
+    type = "string"
+  }
+
+  partition_keys {
+    name = "tid"
+    type = "string"
+  }
+
+  partition_keys {
+    name = "year"
+    type = "int"
+  }
+
+  partition_keys {
+    name = "month"
+    type = "int"
+  }
+
+  partition_keys {
+    name = "day"
+    type = "int"
+  }
+}
+
+resource "aws_glue_catalog_table" "otm_rollup_event_hour" {
+  name = "otm_rollup_event_hour"
+  database_name = aws_glue_catalog_database.otm.name
+
+  table_type = "EXTERNAL_TABLE"
+
+  parameters = merge({
+    EXTERNAL = "TRUE"
+    "parquet.compression" = "GZIP"
+  }, local.collect_projection, {
+    "storage.location.template" = "s3://${aws_s3_bucket.otm_stats.bucket}/rollups/otm_rollup_event_hour/${local.collect_location_template}"
+  })
+
+  storage_descriptor {
+    location = "s3://${aws_s3_bucket.otm_stats.bucket}/rollups/otm_rollup_event_hour"
+    input_format = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetInputFormat"
+    output_format = "org.apache.hadoop.hive.ql.io.parquet.MapredParquetOutputFormat"
+
+    ser_de_info {
+      name = "parquet"
+      serialization_library = "org.apache.hadoop.hive.ql.io.parquet.serde.ParquetHiveSerDe"
+
+      parameters = {
+        "serialization.format" = 1
+      }
+    }
+
+    columns {
+      name = "datetime"
+      type = "timestamp"
+    }
+
+    columns {
+      name = "url"
+      type = "string"
+    }
+
+    columns {
+      name = "title"
+      type = "string"
+    }
+
+    columns {
+      name = "state"
+      type = "string"
+    }
+
+    columns {
+      name = "label"
+      type = "string"
+    }
+
+    columns {
+      name = "count"
+      type = "bigint"
+    }
+  }
+
+  partition_keys {
+    name = "org"
+    type = "string"
+  }
+
+  partition_keys {
+    name = "tid"
+    type = "string"
+  }
+
+  partition_keys {
+    name = "year"
+    type = "int"
+  }
+
+  partition_keys {
+    name = "month"
+    type = "int"
+  }
+
+  partition_keys {
+    name = "day"
+    type = "int"
+  }
+}
@@ -56,7 +56,56 @@ variable "aws_cloudwatch_event_usage_enable" {
   default = true
 }
 
+# the compaction rewrites the collect log, enable it explicitly
+variable "aws_cloudwatch_event_compact_enable" {
+  type = bool
+  default = false
+}
+
 variable "aws_cloudwatch_event_goal_enable" {
   type = bool
   default = false
 }
+
+variable "aws_cloudwatch_event_rollup_enable" {
+  type = bool
+  default = false
+}
+
+# formatted collect log format: "json" or "parquet"
+variable "otm_collect_format" {
+  type = string
+  default = "json"
+}
+
+# partition maintenance of the formatted collect log: "msck", "register" or "projection"
+# - msck: data_retriever runs MSCK REPAIR TABLE before each job
+# - register: log_formatter registers the partitions it writes
+# - projection: Athena partition projection, no registration
+variable "otm_partition_mode" {
+  type = string
+  default = "msck"
+}
+
+variable "otm_partition_projection_year_range" {
+  type = string
+  default = "2018,2099"
+}
+
+# log_formatter ingestion: "sns" (an invocation per log file) or "sqs" (micro-batch)
+variable "otm_formatter_ingestion" {
+  type = string
+  default = "sns"
+}
+
+# per-org scheduler of the Athena queries (common/athena_scheduler.py): "1" to enable
+variable "otm_athena_scheduler_enabled" {
+  type = string
+  default = "0"
+}
+
+# APPROX_DISTINCT of the users of the daily goal results (data_retriever/goal.py): "1" to enable
+variable "otm_goal_approx" {
+  type = string
+  default = "0"
+}
@@ -1,108 +1,305 @@
-from chalice import Chalice
-from urllib import parse as urlparse
-from datetime import datetime
+from chalice import Chalice, Rate
 import os
 import json
 import boto3
-import gzip
-import tempfile
+import zlib
+import time
 import re
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from retrying import retry
+from chalicelib import parquet_writer, cf_parser, partition_writer, partition_registry
 
 app = Chalice(app_name='otm_log_formatter')
-s3 = boto3.resource('s3')
+# boto3 client is thread-safe (resource is not)
+s3_client = boto3.client('s3')
+sqs_client = boto3.client('sqs')
 
 
-def read_cf_data(bucket_name, object_key):
-    obj = s3.Object(bucket_name, object_key)
-    with tempfile.TemporaryFile() as temp:
-        obj.download_fileobj(temp)
-        temp.seek(0)
-        with gzip.GzipFile(fileobj=temp) as gz:
-            for b in gz:
-                yield b
+STREAM_CHUNK_SIZE = 1024 * 1024
+DECOMPRESS_MAX_SIZE = 4 * 1024 * 1024
+DELETE_ATTEMPTS = 5
 
 
-@app.on_sns_message(topic=os.environ.get('OTM_LOG_SNS'))
-def handler(event):
-    records = json.loads(event.message)
-    record = records['Records'][0]
-    if record['eventName'] != 'ObjectCreated:Put':
-        return None
+class ReadStats:
+    def __init__(self):
+        self.started_at = time.time()
+        self.bytes = 0
+        self.decompressed_bytes = 0
+        self.lines = 0
+        self.short_lines = 0
+
+    def report(self, object_key):
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        if self.short_lines:
+            print(json.dumps({'message': 'dropped short lines', 'key': object_key, 'short_lines': self.short_lines}))
+        print(json.dumps({
+            'message': 'read cf data',
+            'key': object_key,
+            'bytes': self.bytes,
+            'decompressed_bytes': self.decompressed_bytes,
+            'lines': self.lines,
+            'short_lines': self.short_lines,
+            'elapsed': round(elapsed, 3),
+            'bytes_per_sec': int(self.bytes / elapsed),
+            'lines_per_sec': int(self.lines / elapsed)
+        }))
+
 
-    bucket_name = record['s3']['bucket']['name']
-    object_key = record['s3']['object']['key']
+def read_cf_data(bucket_name, object_key, stats=None):
+    # decompress the gzip log directly from the S3 response stream, chunk by chunk,
+    # so that memory stays constant and nothing is written to /tmp
+    stats = stats or ReadStats()
+    body = s3_client.get_object(Bucket=bucket_name, Key=object_key)['Body']
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    rest = b''
+    try:
+        while True:
+            chunk = body.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            stats.bytes += len(chunk)
+            while chunk:
+                data = decompressor.decompress(chunk, DECOMPRESS_MAX_SIZE)
+                chunk = decompressor.unconsumed_tail
+                if decompressor.eof:
+                    # concatenated gzip members
+                    chunk = decompressor.unused_data + chunk
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+                stats.decompressed_bytes += len(data)
+                lines = (rest + data).split(b'\n')
+                rest = lines.pop()
+                for line in lines:
+                    stats.lines += 1
+                    yield line + b'\n'
+        data = decompressor.flush()
+        stats.decompressed_bytes += len(data)
+        rest += data
+        if rest:
+            stats.lines += 1
+            yield rest
+    finally:
+        body.close()
 
-    comment_pattern = re.compile('^#')
 
+def format_log(bucket_name, object_key):
     file_name = re.compile('(.*/)?(.+)$').match(object_key)[2]
+    format_objects([(bucket_name, object_key)], file_name)
+
+
+def format_objects(objects, file_name):
+    """
+    Format the CloudFront log objects into one output object (`file_name`) per partition.
+    """
+    output_format = os.environ.get('OTM_REFORM_FORMAT') or 'json'
+    if output_format == 'parquet':
+        file_name = re.sub(r'\.gz$', '', file_name) + parquet_writer.FILE_EXTENSION
+
+    output_bucket = os.environ.get('OTM_REFORM_S3_BUCKET')
+    output_prefix = os.environ.get('OTM_REFORM_LOG_PREFIX')
+    # partition key -> streaming writer, records are uploaded as they are parsed
+    writers = {}
+    try:
+        for bucket_name, object_key in objects:
+            # every log file has its own `#Fields:` header
+            parser = cf_parser.CloudFrontLogParser()
+            stats = ReadStats()
+            for b in read_cf_data(bucket_name, object_key, stats):
+                parsed = parser.parse_line(b.decode('utf-8'))
+                if parsed is None:
+                    continue
+                record_data, prefix = parsed
+                new_key = "%s/%s" % (prefix, file_name)
+
+                writer = writers.get(new_key)
+                if writer is None:
+                    writer = partition_writer.open_writer(output_format, s3_client, output_bucket,
+                                                          output_prefix + new_key)
+                    writers[new_key] = writer
+                writer.write(record_data)
+
+            stats.short_lines = parser.short_lines
+            stats.report(object_key)
+    except Exception:
+        for key in writers:
+            writers[key].abort()
+        raise
+
+    finish_writers(file_name, writers)
+    partition_registry.register([os.path.dirname(key) for key in writers])
 
-    result = {}
-    record_count = {}
-    for b in read_cf_data(bucket_name, object_key):
-        str = b.decode('utf-8')
-        if comment_pattern.match(str):
+
+@retry(**partition_writer.RETRY)
+def put_usage(key, count):
+    file_name = os.path.splitext(key)[0]
+    s3_client.put_object(Bucket=os.environ.get('OTM_STAT_S3_BUCKET'),
+                         Key=os.environ.get('OTM_STAT_LOG_PREFIX') + file_name + '.json',
+                         Body=json.dumps({'type': 'collect', 'size': count}))
+
+
+def finish_writer(key, writer):
+    started_at = time.time()
+    writer.close()
+    closed_at = time.time()
+    put_usage(key, writer.count)
+    return {
+        'key': key,
+        'records': writer.count,
+        'bytes': writer.upload.bytes,
+        'close': round(closed_at - started_at, 3),
+        'usage': round(time.time() - closed_at, 3)
+    }
+
+
+def finish_writers(object_key, writers):
+    # the last part / PutObject of every partition and its usage marker are written concurrently,
+    # so that the latency is the slowest write, not the sum of them
+    started_at = time.time()
+    workers = min(len(writers), int(os.environ.get('OTM_UPLOAD_WORKERS') or 8)) or 1
+    timings = []
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(finish_writer, key, writers[key]) for key in writers]
+        for future in futures:
+            try:
+                timings.append(future.result())
+            except Exception as e:
+                errors.append(e)
+
+    print(json.dumps({
+        'message': 'write formatted log',
+        'key': object_key,
+        'partitions': len(writers),
+        'failed': len(errors),
+        'elapsed': round(time.time() - started_at, 3),
+        'writes': timings
+    }))
+    if errors:
+        # closed writers have nothing to abort
+        for key in writers:
+            writers[key].abort()
+        raise errors[0]
+
+
+def log_objects(message):
+    # S3 event notification -> [(bucket, key, size)], test events have no records
+    objects = []
+    for record in message.get('Records', []):
+        if record['eventName'] != 'ObjectCreated:Put':
             continue
-        data = str.rstrip().split('\t')
-        record_data = {
-            'x_edge_location': data[2],
-            'sc_bytes': data[3],
-            'c_ip': data[4],
-            'cs_method': data[5],
-            'cs_host': data[6],
-            'cs_uri_stem': data[7],
-            'cs_status': data[8],
-            'cs_referer': data[9],
-            'cs_user_agent': data[10],
-            'cs_uri_query': data[11],
-            'cs_cookie': data[12],
-            'cs_x_edge_result_type': data[13],
-            'cs_x_edge_request_id': data[14],
-            'x_host_header': data[15],
-            'cs_protocol': data[16],
-            'cs_bytes': data[17],
-            'time_taken': data[18],
-            'x_forwarded_for': data[19],
-            'ssl_protocol': data[20],
-            'ssl_cipher': data[21],
-            'x_edge_response_result_type': data[22],
-            'cs_protocol_version': data[23],
-            'fle_status': data[24],
-            'fle_encrypted_fields': data[25]
-        }
-        url_query = urlparse.parse_qs(urlparse.unquote(record_data['cs_uri_query']))
-        qs_json = {}
-        for key in url_query:
-            qs_json[key] = url_query[key][0]
-
-        record_data['qs'] = qs_json
-
-        tid = 'null'
-        if 'tid' in qs_json:
-            tid = qs_json['tid']
-
-        org = 'root'
-        if 'org' in qs_json:
-            org = qs_json['org']
-
-        ts = datetime.strptime(data[0] + ' ' + data[1], '%Y-%m-%d %H:%M:%S')
-        record_data['datetime'] = ts.strftime('%Y-%m-%d %H:%M:%S')
-        prefix = "org=%s/tid=%s/%s" % (org, tid, ts.strftime('year=%Y/month=%-m/day=%-d'))
-        new_key = "%s/%s" % (prefix, file_name)
-
-        if new_key not in result:
-            result[new_key] = []
-
-        if new_key not in record_count:
-            record_count[new_key] = 0
-
-        result[new_key].append(json.dumps(record_data))
-        record_count[new_key] += 1
-
-    for key in result:
-        obj = s3.Object(os.environ.get('OTM_REFORM_S3_BUCKET'), os.environ.get('OTM_REFORM_LOG_PREFIX') + key)
-        obj.put(Body=gzip.compress('\n'.join(result[key]).encode('utf-8')))
-
-    for key in record_count:
-        file_name = os.path.splitext(key)[0]
-        obj = s3.Object(os.environ.get('OTM_STAT_S3_BUCKET'), os.environ.get('OTM_STAT_LOG_PREFIX') + file_name + '.json')
-        obj.put(Body=json.dumps({'type': 'collect', 'size': record_count[key]}))
+        objects.append((record['s3']['bucket']['name'], record['s3']['object']['key'],
+                        record['s3']['object'].get('size', 0)))
+    return objects
+
+
+def format_logs(message):
+    targets = [(bucket_name, object_key) for bucket_name, object_key, _ in log_objects(message)]
+
+    if not targets:
+        return None
+
+    # log objects are independent, so they are processed concurrently with the bounded pool
+    workers = min(len(targets), int(os.environ.get('OTM_FORMATTER_WORKERS') or 4))
+    errors = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [(executor.submit(format_log, bucket_name, object_key), object_key)
+                   for bucket_name, object_key in targets]
+        for future, object_key in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(json.dumps({'message': 'failed to format log', 'key': object_key, 'error': repr(e)}))
+                errors.append(e)
+
+    print(json.dumps({'message': 'formatted logs', 'count': len(targets), 'failed': len(errors)}))
+    if errors:
+        # let the invocation be retried, the output keys are deterministic
+        raise errors[0]
+
+
+def receive_batch(queue_url, max_bytes, deadline):
+    """
+    Receive S3 event messages until the total size of the log objects reaches `max_bytes`.
+    """
+    messages = []
+    objects = []
+    size = 0
+    while size < max_bytes and time.time() < deadline:
+        received = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10,
+                                              WaitTimeSeconds=1).get('Messages', [])
+        if not received:
+            break
+        for message in received:
+            messages.append(message)
+            for bucket_name, object_key, object_size in log_objects(json.loads(message['Body'])):
+                objects.append((bucket_name, object_key))
+                size += object_size
+    return messages, objects, size
+
+
+def delete_messages(queue_url, messages):
+    # DeleteMessageBatch accepts up to 10 messages
+    for i in range(0, len(messages), 10):
+        delete_message_batch(queue_url, messages[i:i + 10])
+
+
+def delete_message_batch(queue_url, messages):
+    """
+    Delete the messages, the failed entries are retried.
+    A message that is not deleted is received again and its batch is formatted again (to the same output keys).
+    """
+    handles = {str(index): message['ReceiptHandle'] for index, message in enumerate(messages)}
+    for attempt in range(DELETE_ATTEMPTS):
+        if attempt:
+            time.sleep(0.2 * 2 ** attempt)
+        response = sqs_client.delete_message_batch(QueueUrl=queue_url, Entries=[
+            {'Id': key, 'ReceiptHandle': handle} for key, handle in handles.items()
+        ])
+        failed = response.get('Failed') or []
+        if not failed:
+            return
+        print(json.dumps({'message': 'failed to delete messages', 'attempt': attempt + 1, 'failed': failed}))
+        handles = {x['Id']: handles[x['Id']] for x in failed}
+    raise Exception('Cannot delete messages: %s' % json.dumps(failed))
+
+
+def batch_file_name(objects):
+    # same objects make same output keys, so the retry of a batch overwrites its own output
+    digest = hashlib.sha1('\n'.join(sorted(key for _, key in objects)).encode('utf-8')).hexdigest()
+    return 'batch-%s.gz' % digest[:20]
+
+
+def drain_queue(queue_url):
+    """
+    Format the queued log objects in batches, up to OTM_BATCH_MAX_BYTES of log per batch.
+    A new batch is not started after OTM_BATCH_MAX_SECONDS.
+    """
+    started_at = time.time()
+    max_bytes = int(os.environ.get('OTM_BATCH_MAX_BYTES') or 64 * 1024 * 1024)
+    deadline = started_at + int(os.environ.get('OTM_BATCH_MAX_SECONDS') or 300)
+    batches = 0
+    while time.time() < deadline:
+        messages, objects, size = receive_batch(queue_url, max_bytes, deadline)
+        if not messages:
+            break
+        if objects:
+            format_objects(objects, batch_file_name(objects))
+        # messages stay in the queue when the formatting fails, and they are received again
+        delete_messages(queue_url, messages)
+        batches += 1
+        print(json.dumps({'message': 'formatted batch', 'messages': len(messages), 'objects': len(objects),
+                          'bytes': size}))
+
+    print(json.dumps({'message': 'drained queue', 'batches': batches,
+                      'elapsed': round(time.time() - started_at, 3)}))
+
+
+if os.environ.get('OTM_LOG_QUEUE_URL'):
+    # micro-batch mode: S3 events are queued (SNS -> SQS) and drained periodically
+    @app.schedule(Rate(int(os.environ.get('OTM_BATCH_INTERVAL') or 5), unit=Rate.MINUTES))
+    def batch_handler(event):
+        drain_queue(os.environ.get('OTM_LOG_QUEUE_URL'))
+else:
+    @app.on_sns_message(topic=os.environ.get('OTM_LOG_SNS'))
+    def handler(event):
+        format_logs(json.loads(event.message))
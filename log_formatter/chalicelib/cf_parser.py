@@ -0,0 +1,168 @@
+"""
+CloudFront access log parser
+
+Columns are mapped by the `#Fields:` header of the log file,
+so that the fields that are added by CloudFront don't shift the positions of the other fields.
+"""
+from urllib.parse import unquote
+from datetime import datetime
+from . import collect_columns
+
+# CloudFront field name -> formatted record key
+FIELD_KEYS = {
+    'x-edge-location': 'x_edge_location',
+    'sc-bytes': 'sc_bytes',
+    'c-ip': 'c_ip',
+    'cs-method': 'cs_method',
+    'cs(Host)': 'cs_host',
+    'cs-uri-stem': 'cs_uri_stem',
+    'sc-status': 'cs_status',
+    'cs(Referer)': 'cs_referer',
+    'cs(User-Agent)': 'cs_user_agent',
+    'cs-uri-query': 'cs_uri_query',
+    'cs(Cookie)': 'cs_cookie',
+    'x-edge-result-type': 'cs_x_edge_result_type',
+    'x-edge-request-id': 'cs_x_edge_request_id',
+    'x-host-header': 'x_host_header',
+    'cs-protocol': 'cs_protocol',
+    'cs-bytes': 'cs_bytes',
+    'time-taken': 'time_taken',
+    'x-forwarded-for': 'x_forwarded_for',
+    'ssl-protocol': 'ssl_protocol',
+    'ssl-cipher': 'ssl_cipher',
+    'x-edge-response-result-type': 'x_edge_response_result_type',
+    'cs-protocol-version': 'cs_protocol_version',
+    'fle-status': 'fle_status',
+    'fle-encrypted-fields': 'fle_encrypted_fields'
+}
+
+# fields of the standard log (version 1.0), used until `#Fields:` header is found
+DEFAULT_FIELDS = [
+    'date', 'time', 'x-edge-location', 'sc-bytes', 'c-ip', 'cs-method', 'cs(Host)', 'cs-uri-stem', 'sc-status',
+    'cs(Referer)', 'cs(User-Agent)', 'cs-uri-query', 'cs(Cookie)', 'x-edge-result-type', 'x-edge-request-id',
+    'x-host-header', 'cs-protocol', 'cs-bytes', 'time-taken', 'x-forwarded-for', 'ssl-protocol', 'ssl-cipher',
+    'x-edge-response-result-type', 'cs-protocol-version', 'fle-status', 'fle-encrypted-fields'
+]
+
+FIELDS_HEADER = '#Fields:'
+
+# per-second / per-partition caches are dropped when they exceed this size
+CACHE_SIZE = 4096
+
+
+def parse_query(query):
+    """
+    Decode the query string of CloudFront log in a single pass.
+
+    Same as `{k: v[0] for k, v in parse_qs(unquote(query)).items()}`:
+    the first value of each key is used and blank values are dropped.
+    """
+    result = {}
+    if not query or query == '-':
+        return result
+
+    if '%' in query:
+        query = unquote(query)
+
+    for pair in query.split('&'):
+        name, sep, value = pair.partition('=')
+        if not sep or not value:
+            continue
+        if '+' in name or '%' in name:
+            name = _unquote_plus(name)
+        if name in result:
+            continue
+        if '+' in value or '%' in value:
+            value = _unquote_plus(value)
+        result[name] = value
+    return result
+
+
+# URLs, titles and states are repeated in a log file, so decoded values are cached
+_decoded = {}
+
+
+def _unquote_plus(value):
+    decoded = _decoded.get(value)
+    if decoded is None:
+        if len(_decoded) >= CACHE_SIZE:
+            _decoded.clear()
+        decoded = unquote(value.replace('+', ' '))
+        _decoded[value] = decoded
+    return decoded
+
+
+class CloudFrontLogParser:
+    def __init__(self, fields=None):
+        self._timestamps = {}
+        self._partitions = {}
+        # lines with less fields than the header, they are dropped
+        self.short_lines = 0
+        self.set_fields(fields or DEFAULT_FIELDS)
+
+    def set_fields(self, fields):
+        self.fields = fields
+        self._size = len(fields)
+        self._columns = [(index, FIELD_KEYS[name]) for index, name in enumerate(fields) if name in FIELD_KEYS]
+        self._date = fields.index('date')
+        self._time = fields.index('time')
+        self._query = fields.index('cs-uri-query')
+
+    def parse_header(self, line):
+        if line.startswith(FIELDS_HEADER):
+            self.set_fields(line[len(FIELDS_HEADER):].split())
+
+    def timestamp(self, value):
+        """
+        `datetime` of 'YYYY-MM-DD HH:MM:SS' string, cached by second
+        """
+        ts = self._timestamps.get(value)
+        if ts is None:
+            if len(self._timestamps) >= CACHE_SIZE:
+                self._timestamps.clear()
+            ts = datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+            self._timestamps[value] = ts
+        return ts
+
+    def partition(self, org, tid, date):
+        """
+        partition prefix `org=xxx/tid=xxx/year=YYYY/month=M/day=D`, cached by org, tid and date
+        """
+        key = (org, tid, date)
+        prefix = self._partitions.get(key)
+        if prefix is None:
+            if len(self._partitions) >= CACHE_SIZE:
+                self._partitions.clear()
+            year, month, day = date.split('-')
+            prefix = 'org=%s/tid=%s/year=%d/month=%d/day=%d' % (org, tid, int(year), int(month), int(day))
+            self._partitions[key] = prefix
+        return prefix
+
+    def parse_line(self, line):
+        """
+        Parse a log line (str).
+        Returns a tuple of (record, partition prefix) or None for comments and malformed lines.
+        """
+        if not line or line[0] == '#':
+            if line:
+                self.parse_header(line.rstrip())
+            return None
+
+        data = line.rstrip('\r\n').split('\t')
+        if len(data) < self._size:
+            self.short_lines += 1
+            return None
+
+        record = {key: data[index] for index, key in self._columns}
+        qs = parse_query(data[self._query])
+        record['qs'] = qs
+        record.update(collect_columns.promote(qs))
+
+        date = data[self._date]
+        datetime_value = date + ' ' + data[self._time]
+        # validate the format
+        self.timestamp(datetime_value)
+        record['datetime'] = datetime_value
+
+        prefix = self.partition(qs.get('org', 'root'), qs.get('tid', 'null'), date)
+        return record, prefix
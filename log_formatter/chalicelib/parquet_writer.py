@@ -0,0 +1,155 @@
+from datetime import datetime
+from functools import lru_cache
+import io
+import json
+
+# column name, parquet type name
+# The order and the types must be matched with `otm_collect_parquet` table definition (infra/common/main.tf)
+COLUMNS = [
+    ('datetime', 'timestamp'),
+    ('x_edge_location', 'string'),
+    ('sc_bytes', 'int64'),
+    ('c_ip', 'string'),
+    ('cs_method', 'string'),
+    ('cs_host', 'string'),
+    ('cs_uri_stem', 'string'),
+    ('cs_status', 'int32'),
+    ('cs_referer', 'string'),
+    ('cs_user_agent', 'string'),
+    ('cs_uri_query', 'string'),
+    ('cs_cookie', 'string'),
+    ('cs_x_edge_result_type', 'string'),
+    ('cs_x_edge_request_id', 'string'),
+    ('x_host_header', 'string'),
+    ('cs_protocol', 'string'),
+    ('cs_bytes', 'int64'),
+    ('time_taken', 'float64'),
+    ('x_forwarded_for', 'string'),
+    ('ssl_protocol', 'string'),
+    ('ssl_cipher', 'string'),
+    ('x_edge_response_result_type', 'string'),
+    ('cs_protocol_version', 'string'),
+    ('fle_status', 'string'),
+    ('fle_encrypted_fields', 'string'),
+    ('qs', 'string'),
+    ('o_s', 'string'),
+    ('dl', 'string'),
+    ('o_pl', 'string'),
+    ('cid', 'string'),
+    ('o_psid', 'string'),
+    ('el', 'string'),
+    ('dt', 'string'),
+    ('o_e_y', 'float64'),
+    ('plt', 'float64'),
+    ('norm_dl', 'string'),
+    ('norm_o_pl', 'string'),
+    ('o_s_kind', 'string')
+]
+
+FILE_EXTENSION = '.parquet'
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception('pyarrow is required to use parquet output format')
+    return pyarrow
+
+
+def _to_int(value):
+    if value is None or value == '-' or value == '':
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def _to_float(value):
+    if value is None or value == '-' or value == '':
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+def _to_str(value):
+    if value is None:
+        return None
+    if isinstance(value, dict):
+        return json.dumps(value)
+    return value
+
+
+@lru_cache(maxsize=4096)
+def _to_timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value
+    return datetime.strptime(value, '%Y-%m-%d %H:%M:%S')
+
+
+CONVERTERS = {
+    'timestamp': _to_timestamp,
+    'int64': _to_int,
+    'int32': _to_int,
+    'float64': _to_float,
+    'string': _to_str
+}
+
+
+def schema():
+    pa = _import_pyarrow()
+    types = {
+        'timestamp': pa.timestamp('ms'),
+        'int64': pa.int64(),
+        'int32': pa.int32(),
+        'float64': pa.float64(),
+        'string': pa.string()
+    }
+    return pa.schema([(name, types[t]) for name, t in COLUMNS])
+
+
+def to_columns(records):
+    columns = {name: [] for name, _ in COLUMNS}
+    for record in records:
+        for name, t in COLUMNS:
+            columns[name].append(CONVERTERS[t](record.get(name)))
+    return columns
+
+
+def encode(records):
+    """
+    Encode formatted records (dict) to parquet file bytes.
+    """
+    pa = _import_pyarrow()
+    table = pa.Table.from_pydict(to_columns(records), schema=schema())
+    buffer = io.BytesIO()
+    # INT96 timestamp is used for the compatibility with Athena (Hive)
+    pa.parquet.write_table(table, buffer, compression='snappy', use_deprecated_int96_timestamps=True)
+    return buffer.getvalue()
+
+
+class StreamWriter:
+    """
+    Write formatted records (dict) to a file-like object, one row group per `write` call.
+    """
+
+    def __init__(self, sink):
+        pa = _import_pyarrow()
+        self._pa = pa
+        self._schema = schema()
+        # INT96 timestamp is used for the compatibility with Athena (Hive)
+        self._writer = pa.parquet.ParquetWriter(sink, self._schema, compression='snappy',
+                                                use_deprecated_int96_timestamps=True)
+
+    def write(self, records):
+        table = self._pa.Table.from_pydict(to_columns(records), schema=self._schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        self._writer.close()
@@ -0,0 +1,86 @@
+"""
+Registration of the partitions that are written by log_formatter
+
+OTM_PARTITION_MODE selects how the partitions of the formatted log table are maintained:
+
+- msck (default): nothing is done here, data_retriever runs `MSCK REPAIR TABLE`
+- register: written partitions are added to the Glue table by BatchCreatePartition
+- projection: the table uses partition projection, nothing has to be registered
+"""
+import copy
+import json
+import os
+import threading
+import boto3
+from retrying import retry
+
+# BatchCreatePartition accepts up to 100 partitions
+BATCH_SIZE = 100
+PARTITION_KEYS = ['org', 'tid', 'year', 'month', 'day']
+
+glue = boto3.client('glue')
+
+# partitions that are known to exist, kept while the Lambda container is warm
+_known = set()
+_lock = threading.Lock()
+_storage_descriptor = {}
+
+
+def partition_mode():
+    return os.environ.get('OTM_PARTITION_MODE') or 'msck'
+
+
+def values(prefix):
+    """
+    partition values of `org=xxx/tid=xxx/year=YYYY/month=M/day=D`
+    """
+    parts = dict(x.split('=', 1) for x in prefix.strip('/').split('/'))
+    return [parts[key] for key in PARTITION_KEYS]
+
+
+def _table_storage_descriptor(database, table):
+    with _lock:
+        if table not in _storage_descriptor:
+            _storage_descriptor[table] = glue.get_table(DatabaseName=database, Name=table)['Table']['StorageDescriptor']
+        return _storage_descriptor[table]
+
+
+def _partition_input(storage_descriptor, prefix):
+    descriptor = copy.deepcopy(storage_descriptor)
+    descriptor['Location'] = '%s/%s' % (storage_descriptor['Location'].rstrip('/'), prefix)
+    return {'Values': values(prefix), 'StorageDescriptor': descriptor}
+
+
+@retry(stop_max_attempt_number=5,
+       wait_exponential_multiplier=200,
+       wait_exponential_max=5000)
+def _batch_create(database, table, inputs):
+    response = glue.batch_create_partition(DatabaseName=database, TableName=table, PartitionInputList=inputs)
+    errors = [x for x in response.get('Errors', [])
+              if x['ErrorDetail']['ErrorCode'] != 'AlreadyExistsException']
+    if errors:
+        raise Exception('Cannot create partition: %s' % json.dumps(errors))
+
+
+def register(prefixes):
+    """
+    Add the partitions (prefix of the formatted log) that are not known yet.
+    """
+    if partition_mode() != 'register':
+        return
+
+    database = os.environ.get('OTM_GLUE_DATABASE')
+    table = os.environ.get('OTM_GLUE_TABLE')
+    with _lock:
+        new_prefixes = sorted(set(prefixes) - _known)
+    if not new_prefixes:
+        return
+
+    storage_descriptor = _table_storage_descriptor(database, table)
+    for i in range(0, len(new_prefixes), BATCH_SIZE):
+        batch = new_prefixes[i:i + BATCH_SIZE]
+        _batch_create(database, table, [_partition_input(storage_descriptor, prefix) for prefix in batch])
+        with _lock:
+            _known.update(batch)
+
+    print(json.dumps({'message': 'register partitions', 'table': table, 'partitions': new_prefixes}))
@@ -0,0 +1,170 @@
+"""
+Streaming writers of the formatted log partitions
+
+Records are compressed as they arrive and uploaded to S3 by multipart upload part by part,
+so that the memory is bounded by (open partitions x part size), not by the size of the log file.
+Outputs smaller than a part are uploaded by a single PutObject.
+"""
+import io
+import json
+import os
+import zlib
+from retrying import retry
+from . import parquet_writer
+
+# S3 multipart upload requires at least 5MB for every part except the last one
+MIN_PART_SIZE = 5 * 1024 * 1024
+PARQUET_ROW_GROUP_SIZE = 10000
+
+# S3 requests are retried with exponential backoff (0.2s, 0.4s, ... up to 5s)
+RETRY = {
+    'stop_max_attempt_number': 5,
+    'wait_exponential_multiplier': 200,
+    'wait_exponential_max': 5000
+}
+
+
+def part_size():
+    size = int(os.environ.get('OTM_REFORM_PART_SIZE') or MIN_PART_SIZE)
+    return max(size, MIN_PART_SIZE)
+
+
+class S3Upload:
+    """
+    Buffer the written bytes and upload them as a part of multipart upload when the buffer is filled.
+    """
+
+    def __init__(self, client, bucket, key, size=None):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.part_size = size or part_size()
+        self.buffer = bytearray()
+        self.upload_id = None
+        self.parts = []
+        self.bytes = 0
+
+    def write(self, data):
+        self.buffer += data
+        self.bytes += len(data)
+        if len(self.buffer) >= self.part_size:
+            self._upload_part()
+        return len(data)
+
+    @retry(**RETRY)
+    def _upload_part(self):
+        if self.upload_id is None:
+            self.upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key)['UploadId']
+        number = len(self.parts) + 1
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                           PartNumber=number, Body=bytes(self.buffer))
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': number})
+        self.buffer = bytearray()
+
+    @retry(**RETRY)
+    def _put(self):
+        self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self.buffer))
+
+    @retry(**RETRY)
+    def _complete(self):
+        self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                              MultipartUpload={'Parts': self.parts})
+
+    def close(self):
+        if self.upload_id is None:
+            self._put()
+        else:
+            if self.buffer:
+                self._upload_part()
+            self._complete()
+            self.upload_id = None
+        self.buffer = bytearray()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            self.upload_id = None
+        self.buffer = bytearray()
+
+
+class GzipPartitionWriter:
+    """
+    JSON lines (separated by '\\n') in a gzip file
+    """
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.count = 0
+        self.compressor = zlib.compressobj(9, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def write(self, record):
+        line = json.dumps(record)
+        if self.count:
+            line = '\n' + line
+        self.count += 1
+        data = self.compressor.compress(line.encode('utf-8'))
+        if data:
+            self.upload.write(data)
+
+    def close(self):
+        self.upload.write(self.compressor.flush())
+        self.upload.close()
+
+    def abort(self):
+        self.upload.abort()
+
+
+class _UploadSink(io.RawIOBase):
+    # file-like object for pyarrow, which writes into S3Upload
+    def __init__(self, upload):
+        self.upload = upload
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        size = self.upload.write(bytes(data))
+        self.position += size
+        return size
+
+    def tell(self):
+        return self.position
+
+
+class ParquetPartitionWriter:
+    """
+    Parquet file, records are buffered and written by row group
+    """
+
+    def __init__(self, upload, row_group_size=PARQUET_ROW_GROUP_SIZE):
+        self.upload = upload
+        self.count = 0
+        self.records = []
+        self.row_group_size = row_group_size
+        self.writer = parquet_writer.StreamWriter(_UploadSink(upload))
+
+    def write(self, record):
+        self.records.append(record)
+        self.count += 1
+        if len(self.records) >= self.row_group_size:
+            self.writer.write(self.records)
+            self.records = []
+
+    def close(self):
+        if self.records:
+            self.writer.write(self.records)
+            self.records = []
+        self.writer.close()
+        self.upload.close()
+
+    def abort(self):
+        self.records = []
+        self.upload.abort()
+
+
+def open_writer(output_format, client, bucket, key):
+    upload = S3Upload(client, bucket, key)
+    if output_format == 'parquet':
+        return ParquetPartitionWriter(upload)
+    return GzipPartitionWriter(upload)
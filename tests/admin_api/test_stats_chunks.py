@@ -0,0 +1,177 @@
+import datetime
+import boto3
+import pandas as pd
+import pytest
+from moto import mock_aws
+from chalicelib import stats_chunks
+
+ONE_SECOND = datetime.timedelta(seconds=1)
+COLUMNS = ['datetime', 'url', 'count']
+
+
+def query(org, tid, stime, etime):
+    return 'SELECT url, count FROM collect_log WHERE datetime BETWEEN %s AND %s' % (stime, etime)
+
+
+def chunked(stime, etime):
+    return stats_chunks.ChunkedQuery('org1', 'tid1', 'url_table', stime, etime, query, 'datetime')
+
+
+def rows(chunks):
+    # a row at the start of each chunk, `count` is the index of the chunk
+    return pd.DataFrame([{'datetime': x[0].strftime('%Y-%m-%d %H:%M:%S.000'), 'url': 'https://example.com/',
+                          'count': i} for i, x in enumerate(chunks)], columns=COLUMNS)
+
+
+@pytest.fixture
+def bucket(monkeypatch):
+    monkeypatch.setenv('OTM_STATS_BUCKET', 'stats-bucket')
+    monkeypatch.delenv('STATS_CHUNKS_DISABLED', raising=False)
+    with mock_aws():
+        boto3.client('s3').create_bucket(Bucket='stats-bucket')
+        yield 'stats-bucket'
+
+
+def stored_keys(bucket):
+    return [x['Key'] for x in boto3.client('s3').list_objects_v2(Bucket=bucket).get('Contents', [])]
+
+
+def test_split_days_and_hours():
+    stime = datetime.datetime(2020, 1, 1, 22, 30)
+    etime = datetime.datetime(2020, 1, 3, 1, 14, 59)
+    assert stats_chunks.split(stime, etime) == [
+        (datetime.datetime(2020, 1, 1, 22, 30), datetime.datetime(2020, 1, 1, 22, 59, 59)),
+        (datetime.datetime(2020, 1, 1, 23), datetime.datetime(2020, 1, 1, 23, 59, 59)),
+        (datetime.datetime(2020, 1, 2), datetime.datetime(2020, 1, 2, 23, 59, 59)),
+        (datetime.datetime(2020, 1, 3), datetime.datetime(2020, 1, 3, 0, 59, 59)),
+        (datetime.datetime(2020, 1, 3, 1), datetime.datetime(2020, 1, 3, 1, 14, 59)),
+    ]
+
+
+@pytest.mark.parametrize('stime, etime', [
+    (datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 31, 23, 59, 59)),
+    (datetime.datetime(2020, 1, 1, 0, 0, 1), datetime.datetime(2020, 1, 1, 0, 0, 1)),
+    (datetime.datetime(2020, 2, 28, 13, 5, 7), datetime.datetime(2020, 3, 1, 8, 0, 0)),
+])
+def test_split_covers_the_window(stime, etime):
+    chunks = stats_chunks.split(stime, etime)
+    assert chunks[0][0] == stime and chunks[-1][1] == etime
+    for (_, end), (start, _) in zip(chunks, chunks[1:]):
+        assert start == end + ONE_SECOND
+    for start, end in chunks:
+        # a chunk never crosses a day, and a part of a day is within an hour
+        assert start.date() == end.date()
+        assert stats_chunks.is_day((start, end)) or start.hour == end.hour
+
+
+def test_chunk_of():
+    query = chunked(datetime.datetime(2020, 1, 1, 22, 30), datetime.datetime(2020, 1, 2, 23, 59, 59))
+    # the time column is the hour of the row
+    assert query.chunk_of('2020-01-01 21:00:00.000') is None
+    assert query.chunk_of('2020-01-01 22:00:00.000') == query.chunks[0]
+    assert query.chunk_of('2020-01-02 13:00:00.000') == query.chunks[2]
+    assert query.chunk_of('2020-01-03 00:00:00.000') is None
+    assert query.chunk_of(None) is None
+    assert query.chunk_of('x') is None
+
+
+def test_merge_stores_closed_chunks(bucket):
+    stime = datetime.datetime(2020, 1, 1, 22)
+    etime = datetime.datetime(2020, 1, 3, 23, 59, 59)
+    query = chunked(stime, etime)
+    assert query.span_start() == stime
+    merged = query.merge(rows(query.chunks))
+    assert merged['count'].tolist() == [0, 1, 2, 3]
+    assert len(stored_keys(bucket)) == 4
+
+    # every chunk is stored, nothing is queried again
+    query = chunked(stime, etime)
+    assert query.span_start() is None
+    assert query.merge()['count'].tolist() == [0, 1, 2, 3]
+
+
+def test_merge_reads_the_stored_chunks_before_the_span(bucket):
+    stime = datetime.datetime(2020, 1, 1)
+    query = chunked(stime, datetime.datetime(2020, 1, 2, 23, 59, 59))
+    query.merge(rows(query.chunks))
+
+    # the window is extended by a day, only the new day is queried
+    query = chunked(stime, datetime.datetime(2020, 1, 3, 23, 59, 59))
+    assert query.span_start() == datetime.datetime(2020, 1, 3)
+    merged = query.merge(rows(query.chunks).iloc[2:], query.span_start())
+    assert merged['count'].tolist() == [0, 1, 2]
+
+
+def test_open_chunks_are_not_stored(bucket):
+    etime = datetime.datetime.utcnow().replace(microsecond=0)
+    stime = datetime.datetime(etime.year, etime.month, etime.day) - datetime.timedelta(days=1)
+    query = chunked(stime, etime)
+    query.merge(rows(query.chunks))
+    closed = [x for x in query.chunks if query.is_closed(x)]
+    assert len(closed) < len(query.chunks)
+    assert len(stored_keys(bucket)) == len(closed)
+    assert chunked(stime, etime).span_start() == query.chunks[len(closed)][0]
+
+
+def test_missing_stored_chunk_is_an_error(bucket):
+    stime = datetime.datetime(2020, 1, 1)
+    etime = datetime.datetime(2020, 1, 2, 23, 59, 59)
+    query = chunked(stime, etime)
+    query.merge(rows(query.chunks))
+    boto3.client('s3').delete_object(Bucket=bucket, Key=query.key(query.chunks[0]))
+    with pytest.raises(Exception, match='Stored chunk is missing'):
+        chunked(stime, etime).merge(rows(query.chunks).iloc[1:], datetime.datetime(2020, 1, 2))
+
+
+def test_disabled(bucket, monkeypatch):
+    monkeypatch.setenv('STATS_CHUNKS_DISABLED', '1')
+    query = chunked(datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 2, 23, 59, 59))
+    pd_data = rows(query.chunks)
+    assert query.merge(pd_data) is pd_data
+    assert stored_keys(bucket) == []
+
+
+def merge_counts(merged, frame):
+    # merge of stats_rows.merge_*: the counts are summed by the keys
+    if frame.empty:
+        return merged
+    data = frame if merged is None else pd.concat([merged, frame], ignore_index=True)
+    return data.groupby(['datetime', 'url'], as_index=False, sort=False)['count'].sum()
+
+
+def test_stream_stores_the_queried_chunks(bucket):
+    stime = datetime.datetime(2020, 1, 1, 22)
+    etime = datetime.datetime(2020, 1, 3, 23, 59, 59)
+    query = chunked(stime, etime)
+    pd_data = pd.concat([rows(query.chunks)] * 3, ignore_index=True)
+    # the rows of a chunk are in more than one frame
+    frames = [pd_data.iloc[i:i + 5] for i in range(0, len(pd_data), 5)]
+    merged = query.stream(iter(frames), merge_counts)
+    assert merged['count'].tolist() == [0, 3, 6, 9]
+    assert len(stored_keys(bucket)) == 4
+
+    # the stored chunks are the merged rows, merge() and stream() read them
+    query = chunked(stime, etime)
+    assert query.span_start() is None
+    assert query.merge()['count'].tolist() == [0, 3, 6, 9]
+    assert query.stream(iter([]), merge_counts)['count'].tolist() == [0, 3, 6, 9]
+
+
+def test_stream_skips_the_rows_before_the_span(bucket):
+    stime = datetime.datetime(2020, 1, 1)
+    query = chunked(stime, datetime.datetime(2020, 1, 2, 23, 59, 59))
+    query.merge(rows(query.chunks))
+
+    query = chunked(stime, datetime.datetime(2020, 1, 3, 23, 59, 59))
+    # the rows of the stored chunks are read from the stored chunks, not from the result
+    merged = query.stream(iter([rows(query.chunks)]), merge_counts, query.span_start())
+    assert merged['count'].tolist() == [0, 1, 2]
+
+
+def test_stream_disabled(bucket, monkeypatch):
+    monkeypatch.setenv('STATS_CHUNKS_DISABLED', '1')
+    query = chunked(datetime.datetime(2020, 1, 1), datetime.datetime(2020, 1, 2, 23, 59, 59))
+    merged = query.stream(iter([rows(query.chunks), rows(query.chunks)]), merge_counts)
+    assert merged['count'].tolist() == [0, 2]
+    assert stored_keys(bucket) == []
+    assert query.stream(iter([]), merge_counts).empty
@@ -0,0 +1,248 @@
+import io
+import json
+import random
+import pandas as pd
+import pytest
+from chalicelib import stats_rows
+from chalicelib.collect_columns import normalize_url
+
+STATES = ['pageview', 'scroll_25', 'click_widget_id=menu', 'leave']
+
+
+def generate_url(rnd):
+    return 'https://example.com/page/%d?ref=%d' % (rnd.randint(0, 5), rnd.randint(0, 3))
+
+
+def optional(rnd, value):
+    # LEFT OUTER JOIN makes empty columns
+    return value if rnd.random() < 0.8 else None
+
+
+def url_table_data(rnd, rows=300):
+    return [{
+        'datetime': '2020-05-%02d %02d:00:00.000' % (rnd.randint(1, 2), rnd.randint(0, 2)),
+        'url': generate_url(rnd),
+        'title': 'Example page %d' % rnd.randint(0, 3),
+        'p_url': optional(rnd, generate_url(rnd)),
+        'count': rnd.randint(1, 100),
+        'session_count': rnd.randint(1, 50),
+        'user_count': rnd.randint(1, 30),
+        's_count': optional(rnd, rnd.randint(0, 20)),
+        'sum_scroll_y': optional(rnd, rnd.random() * 100000),
+        'max_scroll_y': optional(rnd, rnd.randint(0, 5000)),
+        'event_count': optional(rnd, rnd.randint(0, 300)),
+        'w_click_count': optional(rnd, rnd.randint(0, 10)),
+        't_click_count': optional(rnd, rnd.randint(0, 10)),
+        'plt_count': optional(rnd, rnd.randint(0, 20)),
+        'sum_plt': optional(rnd, rnd.randint(0, 200000)),
+        'max_plt': optional(rnd, rnd.randint(0, 30000)),
+    } for _ in range(rows)]
+
+
+def event_table_data(rnd, rows=300):
+    return [{
+        'url': generate_url(rnd),
+        'title': 'Example page %d' % rnd.randint(0, 3),
+        'state': rnd.choice(STATES),
+        'label': optional(rnd, rnd.choice(['menu', 'footer link'])),
+        'count': rnd.randint(1, 100)
+    } for _ in range(rows)]
+
+
+def url_links_data(rnd, rows=300):
+    return [{
+        'url': generate_url(rnd),
+        'p_url': optional(rnd, generate_url(rnd)),
+        'title': 'Example page %d' % rnd.randint(0, 3),
+        'count': rnd.randint(1, 100)
+    } for _ in range(rows)]
+
+
+def to_result(data):
+    # the Athena result is read from CSV
+    return pd.read_csv(io.StringIO(pd.DataFrame(data).to_csv(index=False)), encoding='utf-8')
+
+
+# the merges of the rows one by one before stats_rows
+
+def legacy_url_table(pd_data):
+    table_result = []
+    for index, row in pd_data.iterrows():
+        url = normalize_url(row['url'])
+        p_url = normalize_url(row['p_url'])
+        rj = json.loads(row.to_json())
+        r = [d for d in table_result if d['url'] == url and d['p_url'] == p_url and d['datetime'] == rj['datetime']]
+        if len(r) > 0:
+            for key in stats_rows.URL_TABLE_SUM_COLUMNS:
+                r[0][key] += rj[key] or 0
+            r[0]['max_scroll_y'] = max(r[0]['max_scroll_y'], rj['max_scroll_y'] or 0)
+        else:
+            rj['url'] = url
+            rj['p_url'] = p_url
+            for key in stats_rows.URL_TABLE_SUM_COLUMNS + stats_rows.URL_TABLE_MAX_COLUMNS:
+                rj[key] = rj[key] or 0
+            table_result.append(rj)
+    for t_result in table_result:
+        t_result['avg_scroll_y'] = t_result['sum_scroll_y'] / t_result['s_count'] if t_result['s_count'] else None
+        t_result['avg_plt'] = t_result['sum_plt'] / t_result['plt_count'] if t_result['plt_count'] else None
+    return table_result
+
+
+def legacy_event_table(pd_data):
+    event_table_result = []
+    for index, row in pd_data.iterrows():
+        event = json.loads(row.to_json())
+        url = normalize_url(event['url'])
+        r = [d for d in event_table_result if d['url'] == url and d['state'] == event['state']]
+        if r:
+            r[0]['count'] += event['count']
+        else:
+            event['url'] = url
+            event_table_result.append(event)
+    return event_table_result
+
+
+def legacy_url_links(pd_data):
+    urls = []
+    url_links_map = {}
+    for index, row in pd_data.iterrows():
+        event = json.loads(row.to_json())
+        url = normalize_url(event['url'])
+        p_url = normalize_url(event['p_url'])
+        if url and url not in urls:
+            urls.append(url)
+        if p_url and p_url not in urls:
+            urls.append(p_url)
+        key = "{0}-{1}".format(url, p_url)
+        if key in url_links_map:
+            url_links_map[key]['count'] += event['count']
+        else:
+            url_links_map[key] = {'count': event['count'], 'url': url, 'p_url': p_url, 'title': event['title']}
+    return urls, list(url_links_map.values())
+
+
+def assert_same(a, b):
+    # compared as JSON values, 1 and 1.0 are the same for the client
+    if isinstance(a, float) or isinstance(b, float):
+        assert a == pytest.approx(b, rel=1e-9)
+    elif isinstance(a, dict):
+        assert a.keys() == b.keys()
+        for key in a:
+            assert_same(a[key], b[key])
+    elif isinstance(a, (list, tuple)):
+        assert len(a) == len(b)
+        for x, y in zip(a, b):
+            assert_same(x, y)
+    else:
+        assert a == b
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_url_table_is_legacy_merge(seed):
+    pd_data = to_result(url_table_data(random.Random(seed)))
+    assert_same(stats_rows.url_table(pd_data), legacy_url_table(pd_data))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_event_table_is_legacy_merge(seed):
+    pd_data = to_result(event_table_data(random.Random(seed)))
+    assert_same(stats_rows.event_table(pd_data), legacy_event_table(pd_data))
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_url_links_is_legacy_merge(seed):
+    pd_data = to_result(url_links_data(random.Random(seed)))
+    assert_same(stats_rows.url_links(pd_data), legacy_url_links(pd_data))
+
+
+def test_empty_results():
+    assert stats_rows.url_table(pd.DataFrame()) == []
+    assert stats_rows.event_table(pd.DataFrame()) == []
+    assert stats_rows.url_links(pd.DataFrame()) == ([], [])
+    assert stats_rows.url_table_frames([]).empty
+
+
+def test_frames_are_merged_as_one_result():
+    pd_data = to_result(url_table_data(random.Random(3)))
+    frames = [pd_data.iloc[i:i + 37] for i in range(0, len(pd_data), 37)]
+    assert_same(list(stats_rows.iter_records(stats_rows.url_table_frames(frames), rows=50)),
+                stats_rows.url_table(pd_data))
+
+    pd_data = to_result(event_table_data(random.Random(3)))
+    frames = [pd_data.iloc[i:i + 37] for i in range(0, len(pd_data), 37)]
+    assert_same(list(stats_rows.iter_records(stats_rows.event_table_frames(frames))),
+                stats_rows.event_table(pd_data))
+
+    pd_data = to_result(url_links_data(random.Random(3)))
+    frames = [pd_data.iloc[i:i + 37] for i in range(0, len(pd_data), 37)]
+    urls, links = stats_rows.url_links_frames(iter(frames))
+    assert_same((urls, list(stats_rows.iter_records(links))), stats_rows.url_links(pd_data))
+
+
+def test_merged_rows_are_merged_again():
+    # the chunks of a streamed result are stored as their merged rows
+    pd_data = to_result(url_table_data(random.Random(4)))
+    first = stats_rows.merge_url_table(None, pd_data.iloc[:150])
+    second = stats_rows.merge_url_table(None, pd_data.iloc[150:])
+    table = stats_rows.url_table_frames([first, second])
+    assert_same(sorted(stats_rows.iter_records(table), key=json.dumps),
+                sorted(stats_rows.url_table(pd_data), key=json.dumps))
+
+
+def test_records_precision():
+    # same as row.to_json() of the legacy merge
+    assert stats_rows.url_table(to_result([dict(url_table_data(random.Random(0), 1)[0], sum_scroll_y=1 / 3,
+                                                s_count=1)]))[0]['sum_scroll_y'] == 0.3333333333
+
+
+def edge(url, p_url, count, state='pageview', label=None):
+    return {'url': url, 'p_url': p_url, 'title': url, 'state': state, 'p_state': 'pageview', 'label': label,
+            'a_id': None, 'xpath': None, 'class': None, 'count': count}
+
+
+def graph_nodes(graph):
+    return set(graph['url'].dropna()) | set(graph['p_url'].dropna())
+
+
+def test_event_graph_max_nodes(monkeypatch):
+    monkeypatch.setenv('STATS_EVENT_GRAPH_MAX_NODES', '3')
+    monkeypatch.setenv('STATS_EVENT_GRAPH_TOP_EDGES', '0')
+    # the nodes are a (100 + 50), b (100 + 20 + 10), c (50 + 5), d (20), e (10 + 5)
+    pd_data = to_result([edge('https://a/', None, 100), edge('https://b/', 'https://a/', 100),
+                         edge('https://c/', 'https://a/', 50), edge('https://d/', 'https://b/', 20),
+                         edge('https://e/', 'https://b/', 10), edge('https://e/', 'https://c/', 5)])
+    graph = stats_rows.compact_event_graph(stats_rows.merge_event_graph(None, pd_data))
+    assert graph_nodes(graph) == {'https://a/', 'https://b/', 'https://c/', stats_rows.OTHER}
+    assert graph['count'].sum() == pd_data['count'].sum()
+    # d and e from b are folded into one edge
+    folded = graph[(graph['url'] == stats_rows.OTHER) & (graph['p_url'] == 'https://b/')]
+    assert folded['count'].tolist() == [30]
+    assert graph['count'].tolist() == sorted(graph['count'], reverse=True)
+
+
+def test_event_graph_top_edges(monkeypatch):
+    monkeypatch.setenv('STATS_EVENT_GRAPH_MAX_NODES', '0')
+    monkeypatch.setenv('STATS_EVENT_GRAPH_TOP_EDGES', '2')
+    pd_data = to_result([edge('https://b/', 'https://a/', 5 - i, state='click_%d' % i) for i in range(5)] +
+                        [edge('https://c/', 'https://b/', 1)])
+    graph = stats_rows.compact_event_graph(stats_rows.merge_event_graph(None, pd_data))
+    # the 3 smallest edges from a are folded into one edge to OTHER
+    from_a = graph[graph['p_url'] == 'https://a/']
+    assert from_a['count'].tolist() == [6, 5, 4]
+    assert from_a['url'].tolist() == [stats_rows.OTHER, 'https://b/', 'https://b/']
+    assert from_a['state'].tolist()[1:] == ['click_0', 'click_1']
+    assert graph[graph['p_url'] == 'https://b/']['count'].tolist() == [1]
+
+
+def test_event_graph_without_limits(monkeypatch):
+    monkeypatch.setenv('STATS_EVENT_GRAPH_MAX_NODES', '0')
+    monkeypatch.setenv('STATS_EVENT_GRAPH_TOP_EDGES', '0')
+    rnd = random.Random(5)
+    pd_data = to_result([edge(generate_url(rnd), generate_url(rnd), rnd.randint(1, 9), state=rnd.choice(STATES))
+                         for _ in range(200)])
+    merged = stats_rows.merge_event_graph(None, pd_data)
+    records = stats_rows.event_graph(pd_data)
+    assert len(records) == len(merged)
+    assert sum(x['count'] for x in records) == pd_data['count'].sum()
+    assert stats_rows.OTHER not in graph_nodes(pd.DataFrame(records))
+    assert stats_rows.event_graph(pd.DataFrame()) == []
@@ -0,0 +1,140 @@
+import boto3
+import pytest
+from moto import mock_aws
+import athena_scheduler
+from athena_executor import AthenaExecutor
+
+
+class FakeAthena:
+    """
+    Athena client of the scheduler, the queries run until their state is changed by the test
+    """
+
+    def __init__(self):
+        self.queries = {}
+        self.stopped = []
+
+    def start_query_execution(self, **kwargs):
+        token = kwargs.get('ClientRequestToken')
+        for execution_id, query in self.queries.items():
+            if token and query['token'] == token:
+                return {'QueryExecutionId': execution_id}
+        execution_id = 'q%d' % (len(self.queries) + 1)
+        self.queries[execution_id] = {'token': token, 'state': 'RUNNING'}
+        return {'QueryExecutionId': execution_id}
+
+    def get_query_execution(self, QueryExecutionId):
+        return {'QueryExecution': {'QueryExecutionId': QueryExecutionId,
+                                   'Status': {'State': self.queries[QueryExecutionId]['state']}}}
+
+    def batch_get_query_execution(self, QueryExecutionIds):
+        return {'QueryExecutions': [self.get_query_execution(x)['QueryExecution'] for x in QueryExecutionIds]}
+
+    def stop_query_execution(self, QueryExecutionId):
+        self.stopped.append(QueryExecutionId)
+        self.queries[QueryExecutionId]['state'] = 'CANCELLED'
+
+
+@pytest.fixture
+def athena(monkeypatch):
+    monkeypatch.setenv('OTM_ATHENA_SCHEDULER_DYNAMODB_TABLE', 'athena-scheduler')
+    monkeypatch.setenv('ATHENA_SCHEDULER_ENABLED', '1')
+    monkeypatch.setenv('ATHENA_SCHEDULER_ORG_SLOTS', '2')
+    monkeypatch.setattr(athena_scheduler, '_table', None)
+    with mock_aws():
+        boto3.client('dynamodb').create_table(
+            TableName='athena-scheduler', BillingMode='PAY_PER_REQUEST',
+            KeySchema=[{'AttributeName': 'org', 'KeyType': 'HASH'}, {'AttributeName': 'entry', 'KeyType': 'RANGE'}],
+            AttributeDefinitions=[{'AttributeName': 'org', 'AttributeType': 'S'},
+                                  {'AttributeName': 'entry', 'AttributeType': 'S'}])
+        yield FakeAthena()
+
+
+@pytest.fixture
+def scheduler(athena):
+    return athena_scheduler.AthenaScheduler(AthenaExecutor(athena, {}))
+
+
+def running(org):
+    item = athena_scheduler.table().get_item(Key={'org': org, 'entry': 'slots'}, ConsistentRead=True).get('Item')
+    return int(item['running']) if item else 0
+
+
+def state(scheduler, org, execution_id):
+    return scheduler.execution(org, execution_id)['QueryExecution']['Status']['State']
+
+
+def test_submit_queues_beyond_the_slots(scheduler, athena):
+    assert scheduler.submit('org1', 'SELECT 1', 't1') == 'q1'
+    # an identical query in flight is shared
+    assert scheduler.submit('org1', 'SELECT  1', 't1') == 'q1'
+    assert scheduler.submit('org1', 'SELECT 2', 't2') == 'q2'
+    queued = scheduler.submit('org1', 'SELECT 3', 't3')
+    assert queued.startswith(athena_scheduler.QUEUED_PREFIX)
+    assert state(scheduler, 'org1', queued) == 'QUEUED'
+    # the other orgs have their own slots
+    assert scheduler.submit('org2', 'SELECT 3', 'u3') == 'q3'
+    assert running('org1') == 2
+
+    athena.queries['q1']['state'] = 'SUCCEEDED'
+    assert state(scheduler, 'org1', 'q1') == 'SUCCEEDED'
+    # the slot of q1 is given to the queued query
+    execution = scheduler.execution('org1', queued)['QueryExecution']
+    assert execution['QueryExecutionId'] == 'q4'
+    assert scheduler.submit('org1', 'SELECT 3', 't3') == 'q4'
+    assert running('org1') == 2
+
+
+def test_batch_waits_for_the_interactive_slot(scheduler):
+    assert scheduler.submit('org1', 'SELECT 1', 't1') == 'q1'
+    assert not scheduler.acquire('org1', athena_scheduler.BATCH)
+    assert scheduler.acquire('org1', athena_scheduler.INTERACTIVE)
+    assert running('org1') == 2
+
+
+def test_release_is_idempotent(scheduler):
+    lease = scheduler.wait('org1')
+    assert running('org1') == 1
+    scheduler.release('org1', lease)
+    scheduler.release('org1', lease)
+    assert running('org1') == 0
+
+
+def test_sweep_stops_the_abandoned_queries(scheduler, athena, monkeypatch):
+    scheduler.submit('org1', 'SELECT 1', 't1')
+    scheduler.submit('org1', 'SELECT 2', 't2')
+    queued = scheduler.submit('org1', 'SELECT 3', 't3')
+    monkeypatch.setenv('ATHENA_SCHEDULER_ABANDON_SECONDS', '-1')
+    scheduler.sweep()
+    assert sorted(athena.stopped) == ['q1', 'q2']
+    assert state(scheduler, 'org1', queued) == 'CANCELLED'
+    assert running('org1') == 0
+
+    # the stopped query gets a new execution, Athena would return the stopped one for the same token
+    monkeypatch.setenv('ATHENA_SCHEDULER_ABANDON_SECONDS', '60')
+    execution_id = scheduler.submit('org1', 'SELECT 1', 't1')
+    assert execution_id not in ['q1', 'q2']
+    assert athena.queries[execution_id]['token'] == 't1_1'
+
+
+def test_sweep_counts_the_slot_of_a_query_being_started(scheduler, athena):
+    pending = scheduler.acquire('org1', athena_scheduler.INTERACTIVE)
+    # the sweep between acquire() and _add_run() keeps the slot
+    scheduler.sweep()
+    assert running('org1') == 1
+    athena.queries['q9'] = {'token': None, 'state': 'RUNNING'}
+    scheduler._add_run('org1', 'q9', athena_scheduler.INTERACTIVE, pending)
+    scheduler.sweep()
+    assert running('org1') == 1
+    scheduler.release('org1', 'q9')
+    assert running('org1') == 0
+
+
+def test_sweep_gives_back_the_leaked_slots(scheduler, monkeypatch):
+    scheduler.submit('org1', 'SELECT 1', 't1')
+    # a request that died after acquire(), its pending entry expires
+    monkeypatch.setattr(athena_scheduler, 'pending_seconds', lambda: -10)
+    assert scheduler.acquire('org1', athena_scheduler.INTERACTIVE)
+    assert running('org1') == 2
+    scheduler.sweep()
+    assert running('org1') == 1
@@ -0,0 +1,42 @@
+"""
+The tests of each app are in the directory of the same name (tests/admin_api, tests/log_formatter, tests/common),
+they import the modules from the directory of the app as the app does.
+
+    python -m pytest tests
+
+admin_api and log_formatter have their own `chalicelib` package, so `chalicelib` is imported again
+when the tests of another app are collected.
+"""
+import os
+import sys
+import pytest
+# the boto3 clients made by the apps are mocked only when moto is imported before them
+import moto  # noqa: F401
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS = os.path.join(ROOT, 'tests')
+
+# the apps make the boto3 clients when they are imported
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'testing')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'testing')
+os.environ.setdefault('OTM_COGNITO_USER_POOL_ARN', 'arn:aws:cognito-idp:us-east-1:123456789012:userpool/test')
+
+_app = [None]
+
+
+def _use_app(name):
+    if _app[0] == name:
+        return
+    for path in [os.path.join(ROOT, x) for x in os.listdir(TESTS)]:
+        if path in sys.path:
+            sys.path.remove(path)
+    sys.path.insert(0, os.path.join(ROOT, name))
+    for module in [x for x in sys.modules if x == 'chalicelib' or x.startswith('chalicelib.')]:
+        del sys.modules[module]
+    _app[0] = name
+
+
+def pytest_collectstart(collector):
+    if isinstance(collector, pytest.Module):
+        _use_app(os.path.relpath(str(collector.path), TESTS).split(os.sep)[0])
@@ -0,0 +1,109 @@
+from urllib import parse as urlparse
+from urllib.parse import quote
+from datetime import datetime
+import random
+import pytest
+from chalicelib import cf_parser
+
+# record keys of the parser before the header-driven parser, by the position of the standard log
+LEGACY_KEYS = [
+    'x_edge_location', 'sc_bytes', 'c_ip', 'cs_method', 'cs_host', 'cs_uri_stem', 'cs_status', 'cs_referer',
+    'cs_user_agent', 'cs_uri_query', 'cs_cookie', 'cs_x_edge_result_type', 'cs_x_edge_request_id', 'x_host_header',
+    'cs_protocol', 'cs_bytes', 'time_taken', 'x_forwarded_for', 'ssl_protocol', 'ssl_cipher',
+    'x_edge_response_result_type', 'cs_protocol_version', 'fle_status', 'fle_encrypted_fields'
+]
+
+EXTRA_FIELDS = ['c-port', 'time-to-first-byte', 'x-edge-detailed-result-type', 'sc-content-type', 'sc-content-len',
+                'sc-range-start', 'sc-range-end']
+
+QUERIES = [
+    '-',
+    '',
+    'v=1&tid=abc&org=org1',
+    # CloudFront encodes the query string again
+    quote('dl=https%3A%2F%2Fexample.com%2Fa%3Fq%3D1&dt=Example+page&o_s=pageview', safe='=&'),
+    'dt=%25E3%2581%2582&el=a%2Bb+c',
+    'tid=a&tid=b',
+    'tid=&org=x',
+    'blank&tid=a',
+    '=x&tid=a',
+    'a+b=1&a%20b=2',
+    'bad=%zz&ok=%41',
+]
+
+
+def legacy_parse_query(query):
+    return {k: v[0] for k, v in urlparse.parse_qs(urlparse.unquote(query)).items()}
+
+
+def legacy_parse_line(line):
+    data = line.rstrip().split('\t')
+    record = dict(zip(LEGACY_KEYS, data[2:]))
+    record['qs'] = legacy_parse_query(record['cs_uri_query'])
+    ts = datetime.strptime(data[0] + ' ' + data[1], '%Y-%m-%d %H:%M:%S')
+    record['datetime'] = ts.strftime('%Y-%m-%d %H:%M:%S')
+    prefix = 'org=%s/tid=%s/%s' % (record['qs'].get('org', 'root'), record['qs'].get('tid', 'null'),
+                                   ts.strftime('year=%Y/month=%-m/day=%-d'))
+    return record, prefix
+
+
+def log_line(query, ts='2020-05-01 09:08:07', extra=True):
+    date, time = ts.split(' ')
+    fields = [date, time, 'NRT12-C1', '1234', '192.0.2.1', 'GET', 'd111111abcdef8.cloudfront.net', '/collect', '200',
+              'https://example.com/', 'Mozilla/5.0%20(X11)', query, '-', 'Hit', 'id', 'collect.example.com', 'https',
+              '512', '0.001', '-', 'TLSv1.2', 'ECDHE-RSA-AES128-GCM-SHA256', 'Hit', 'HTTP/2.0', '-', '-']
+    if extra:
+        fields += ['54321', '0.001', 'Hit', 'text/html', '1024', '-', '-']
+    return '\t'.join(fields) + '\n'
+
+
+def random_query(rnd):
+    alphabet = ['a', 'b', '=', '&', '%', '+', '2', '5', 'B', 'F', 'E3', '%25', '%3D', '%26', '%2B', ' ', '-']
+    return ''.join(rnd.choice(alphabet) for _ in range(rnd.randint(0, 20)))
+
+
+@pytest.mark.parametrize('query', QUERIES)
+def test_parse_query_is_parse_qs_of_unquote(query):
+    assert cf_parser.parse_query(query) == legacy_parse_query(query)
+
+
+def test_parse_query_random():
+    rnd = random.Random(0)
+    for _ in range(5000):
+        query = random_query(rnd)
+        assert cf_parser.parse_query(query) == legacy_parse_query(query), query
+
+
+@pytest.mark.parametrize('extra', [False, True])
+def test_parse_line_is_legacy_record(extra):
+    parser = cf_parser.CloudFrontLogParser()
+    parser.parse_line('#Version: 1.0\n')
+    fields = cf_parser.DEFAULT_FIELDS + (EXTRA_FIELDS if extra else [])
+    parser.parse_line('#Fields: %s\n' % ' '.join(fields))
+    for query in QUERIES:
+        line = log_line(query, extra=extra)
+        record, prefix = parser.parse_line(line)
+        legacy_record, legacy_prefix = legacy_parse_line(line)
+        assert prefix == legacy_prefix
+        # the promoted columns are added to the legacy record
+        assert {k: record[k] for k in legacy_record} == legacy_record
+
+
+def test_parse_line_maps_fields_by_header():
+    parser = cf_parser.CloudFrontLogParser()
+    fields = ['time', 'date', 'cs-uri-query', 'c-ip']
+    parser.parse_line('#Fields: %s\n' % ' '.join(fields))
+    record, prefix = parser.parse_line('09:08:07\t2020-05-01\ttid=t1&org=o1\t192.0.2.1\n')
+    assert record['c_ip'] == '192.0.2.1'
+    assert record['datetime'] == '2020-05-01 09:08:07'
+    assert record['qs'] == {'tid': 't1', 'org': 'o1'}
+    assert prefix == 'org=o1/tid=t1/year=2020/month=5/day=1'
+
+
+def test_short_lines_are_counted():
+    parser = cf_parser.CloudFrontLogParser()
+    assert parser.parse_line('#Fields: %s\n' % ' '.join(cf_parser.DEFAULT_FIELDS)) is None
+    assert parser.parse_line('2020-05-01\t09:08:07\tNRT12-C1\n') is None
+    assert parser.parse_line('\n') is None
+    assert parser.parse_line(log_line('tid=a', extra=False)) is not None
+    assert parser.short_lines == 2